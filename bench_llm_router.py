@@ -0,0 +1,106 @@
+"""Tail latency and error rate of the LLM router against fake backends.
+
+Each backend is a FakeProvider whose time to first token is usually
+short but occasionally stalls, and which sometimes fails outright, like
+a busy model server. The same stream of concurrent chat requests is sent
+to:
+
+  single  one backend
+  router  RouterProvider over all backends, with hedging and failover
+
+Requests are hedged at a backend's p95 time to first token, so stalls
+only stop showing in the tail while they are rarer than one in twenty.
+The router never hedges sooner than ROUTER_HEDGE_MIN_DELAY, which is
+meant for real model servers and far above the simulated latencies, so
+the benchmark lowers it (--hedge-min-ms). Latency percentiles are over
+successful replies; a failed request counts only as an error.
+
+Usage: python bench_llm_router.py [--requests 200] [--concurrency 4] [--backends 3]
+"""
+import time
+import random
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import llm_providers
+from llm_providers import FakeProvider, LLMError, RouterProvider
+
+MESSAGES = [{"role": "user", "content": "How is the market today?"}]
+
+
+class FlakyBackend(FakeProvider):
+    """FakeProvider with a jittered first-token delay that sometimes stalls"""
+
+    def __init__(self, base_delay, stall_rate, stall_delay, **kwargs):
+        super().__init__(**kwargs)
+        self.base_delay = base_delay
+        self.stall_rate = stall_rate
+        self.stall_delay = stall_delay
+
+    def stream_completion(self, messages):
+        stalled = self._random.random() < self.stall_rate
+        time.sleep(self.stall_delay if stalled else self.base_delay * self._random.uniform(0.5, 1.5))
+        yield from super().stream_completion(messages)
+
+
+def make_backends(count, args):
+    return [
+        FlakyBackend(base_delay=args.base_ms / 1000, stall_rate=args.stall_rate, stall_delay=args.stall_ms / 1000,
+                     failure_rate=args.failure_rate, token_delay=0.001, seed=i)
+        for i in range(count)
+    ]
+
+
+def run(provider, requests, concurrency):
+    """Send requests chat turns through provider; returns (latencies in ms, errors)"""
+    def one(_):
+        start = time.perf_counter()
+        stream = provider.stream_completion(MESSAGES)
+        try:
+            first = next(stream, "")
+            latency = (time.perf_counter() - start) * 1000
+            reply = first + "".join(stream)
+        except LLMError:
+            return (time.perf_counter() - start) * 1000, True
+        return latency, not reply
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(one, range(requests)))
+    return sorted(latency for latency, failed in results if not failed), sum(failed for _, failed in results)
+
+
+def percentile(values, q):
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--backends", type=int, default=3)
+    parser.add_argument("--base-ms", type=float, default=40, help="typical time to first token")
+    parser.add_argument("--stall-ms", type=float, default=1500, help="time to first token when a backend stalls")
+    parser.add_argument("--stall-rate", type=float, default=0.02)
+    parser.add_argument("--failure-rate", type=float, default=0.03)
+    parser.add_argument("--hedge-min-ms", type=float, default=0, help="floor on the delay before hedging")
+    args = parser.parse_args()
+    llm_providers.ROUTER_HEDGE_MIN_DELAY = args.hedge_min_ms / 1000
+
+    random.seed(0)
+    providers = {
+        "single": make_backends(1, args)[0],
+        "router": RouterProvider(make_backends(args.backends, args)),
+    }
+
+    print(f"{'':>6}  {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for name, provider in providers.items():
+        latencies, errors = run(provider, args.requests, args.concurrency)
+        print(f"{name:>6}  {percentile(latencies, 0.5):>8.1f} {percentile(latencies, 0.95):>8.1f} "
+              f"{percentile(latencies, 0.99):>8.1f} {errors:>7}")
+    for backend in providers["router"].stats():
+        print(f"  backend p50 {backend['p50_ms']}ms p95 {backend['p95_ms']}ms, {backend['requests']} requests, "
+              f"{backend['failures']} failures, {backend['hedges']} hedges")
+
+
+if __name__ == "__main__":
+    main()
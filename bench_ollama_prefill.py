@@ -0,0 +1,172 @@
+"""Prompt prefill benchmark for the chatbot's Ollama requests.
+
+Runs against a local stub server that models Ollama's prompt cache: the
+chat template is applied (system messages first, as Ollama's templates
+do), and a request only pays prefill for the tokens after the longest
+prefix it shares with the previous request's prompt and reply, at a
+fixed cost per token. The same multi-turn conversation is replayed with:
+
+  before  messages flattened into one /api/generate prompt, with the
+          per-turn context in the system message
+  after   OllamaProvider on /api/chat with the prompt_builder layout
+
+Usage: python bench_ollama_prefill.py [--turns 12] [--ms-per-token 0.5]
+"""
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from llm_providers import OllamaProvider, OLLAMA_KEEP_ALIVE
+from prompt_builder import build_prompt
+
+SYSTEM_PROMPT = (
+    "You are StockSphere AI Assistant, a financial advisor chatbot built into the StockSphere trading "
+    "platform. You help users understand their portfolio, provide trading insights, and answer questions "
+    "about stocks and investing. Use the user's portfolio data to provide personalized insights when "
+    "available. Keep your responses concise, informative, and focused on financial topics. Avoid making "
+    "definitive trading recommendations - instead, present options and their potential implications."
+)
+HOLDINGS = ["AAPL", "MSFT", "NVDA", "AMZN", "JPM", "XOM", "JNJ", "V"]
+INDICES = ["S&P 500", "Dow Jones", "NASDAQ", "Russell 2000"]
+QUESTIONS = [
+    "How is my portfolio doing today?",
+    "Which of my holdings is the most volatile?",
+    "Should I be worried about my tech exposure?",
+    "What would diversifying into energy look like?",
+    "How did NVDA move compared to the NASDAQ?",
+    "Summarize the risks in my current allocation.",
+]
+
+
+def tokenize(text):
+    return re.findall(r"\w+|[^\w\s]", text)
+
+
+class StubOllama(BaseHTTPRequestHandler):
+    """Answers /api/chat and /api/generate, charging prefill only for uncached tokens"""
+    protocol_version = "HTTP/1.1"
+    ms_per_token = 0.5
+    cached = []  # Tokens of the previous prompt and reply
+    evaluated = []  # Prefill tokens of each request
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        if self.path == "/api/chat":
+            messages = body["messages"]
+        else:
+            messages = [{"role": "user", "content": body["prompt"]}]
+
+        # Like Ollama's templates, gather system messages ahead of the conversation
+        system = "\n".join(m["content"] for m in messages if m["role"] == "system")
+        text = f"<|system|>\n{system}\n" if system else ""
+        text += "".join(f"<|{m['role']}|>\n{m['content']}\n" for m in messages if m["role"] != "system")
+        prompt = tokenize(text + "<|assistant|>\n")
+
+        reply = f"Looking at your question about {tokenize(messages[-1]['content'])[-3]}, " * 4
+        with StubOllama.lock:
+            shared = 0
+            for cached_token, token in zip(StubOllama.cached, prompt):
+                if cached_token != token:
+                    break
+                shared += 1
+            evaluated = len(prompt) - shared
+            time.sleep(evaluated * self.ms_per_token / 1000)
+            StubOllama.cached = prompt + tokenize(reply)
+            StubOllama.evaluated.append(evaluated)
+
+        result = {"done": True, "prompt_eval_count": evaluated,
+                  "prompt_eval_duration": int(evaluated * self.ms_per_token * 1e6)}
+        if self.path == "/api/chat":
+            result["message"] = {"role": "assistant", "content": reply}
+        else:
+            result["response"] = reply
+        payload = json.dumps(result).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class GenerateProvider(OllamaProvider):
+    """The provider before the chat API: one flattened /api/generate prompt"""
+
+    def generate_completion(self, messages):
+        prompt = "".join(f"{m['role'].capitalize()}: {m['content']}\n\n" for m in messages) + "Assistant: "
+        response = self.session.post(
+            f"{self.base_url}/api/generate",
+            json={"model": self.model_name, "prompt": prompt, "keep_alive": OLLAMA_KEEP_ALIVE, "stream": False},
+            timeout=self.timeout
+        )
+        return response.json()["response"]
+
+
+def market_context(rng):
+    """Portfolio and market context whose prices move every turn"""
+    lines = ["User Portfolio:"]
+    for symbol in HOLDINGS:
+        lines.append(f"- {symbol}: 10 shares at avg. price $150.00, current price ${rng.uniform(50, 500):.2f}, "
+                     f"total value ${rng.uniform(500, 5000):.2f}")
+    lines.append("\nCurrent Market Conditions:")
+    for index in INDICES:
+        lines.append(f"- {index}: {rng.uniform(2000, 40000):.2f} ({rng.uniform(-3, 3):.2f}%)")
+    return "\n".join(lines)
+
+
+def replay(provider, layout, turns, seed=7):
+    """Run a conversation through provider; returns (prefill tokens, wall ms) per turn"""
+    rng = random.Random(seed)
+    StubOllama.cached = []
+    StubOllama.evaluated = []
+    history, results = [], []
+    for turn in range(turns):
+        history.append({"role": "user", "content": QUESTIONS[turn % len(QUESTIONS)]})
+        context = market_context(rng)
+        if layout == "before":
+            messages = [{"role": "system", "content": f"{SYSTEM_PROMPT}\n\nContext Information:\n{context}"}] + history
+        else:
+            messages, _, _ = build_prompt(SYSTEM_PROMPT, context, "", history)
+
+        start = time.perf_counter()
+        reply = provider.generate_completion(messages)
+        wall_ms = (time.perf_counter() - start) * 1000
+        history.append({"role": "assistant", "content": reply})
+        results.append((StubOllama.evaluated[-1], wall_ms))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=12)
+    parser.add_argument("--ms-per-token", type=float, default=0.5, help="simulated prefill cost")
+    args = parser.parse_args()
+
+    StubOllama.ms_per_token = args.ms_per_token
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubOllama)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    results = {
+        "before": replay(GenerateProvider(base_url=base_url), "before", args.turns),
+        "after": replay(OllamaProvider(base_url=base_url), "after", args.turns),
+    }
+
+    print(f"{'turn':>4}  {'before tokens':>13} {'before ms':>10}  {'after tokens':>12} {'after ms':>9}")
+    for turn, (before, after) in enumerate(zip(results["before"], results["after"]), 1):
+        print(f"{turn:>4}  {before[0]:>13} {before[1]:>10.1f}  {after[0]:>12} {after[1]:>9.1f}")
+    for layout, turns in results.items():
+        print(f"{layout:>6}: {sum(t for t, _ in turns)} tokens prefilled, "
+              f"{sum(ms for _, ms in turns):.0f}ms over {args.turns} turns")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Throughput of triggering resting limit/stop orders on quote ticks.
+
+Rests a random book of limit and stop orders across many symbols, then
+replays a random-walk stream of quotes through:
+
+  scan  every resting order of the ticked symbol checked on each tick
+  heap  OrderBook, which pops only the orders a tick crosses
+
+Both trigger exactly the same orders. Settlement is not included; it runs
+on its own thread in batched transactions.
+
+Usage: python bench_order_book.py [--orders 50000] [--symbols 500] [--ticks 100000]
+"""
+import time
+import random
+import argparse
+
+from order_book import OrderBook, fires_on_fall
+
+
+class ScanBook:
+    """Resting orders in a list per symbol, all checked on every tick"""
+
+    def __init__(self):
+        self.orders = {}
+
+    def add(self, order_id, symbol, order_type, kind, trigger_price, quantity):
+        self.orders.setdefault(symbol, []).append(
+            (order_id, fires_on_fall(order_type, kind), trigger_price))
+
+    def on_quote(self, symbol, price):
+        resting = self.orders.get(symbol, [])
+        triggered = [order for order in resting if (price <= order[2] if order[1] else price >= order[2])]
+        if triggered:
+            self.orders[symbol] = [order for order in resting if order not in triggered]
+        return triggered
+
+
+def make_orders(count, symbols, rng):
+    for order_id in range(1, count + 1):
+        symbol = rng.choice(symbols)
+        order_type, kind = rng.choice(["BUY", "SELL"]), rng.choice(["LIMIT", "STOP"])
+        # Triggers sit 2-30% away from the starting price of 100, on the side they wait for
+        offset = rng.uniform(0.02, 0.3) * 100
+        trigger = 100 - offset if fires_on_fall(order_type, kind) else 100 + offset
+        yield order_id, symbol, order_type, kind, round(trigger, 2), 10
+
+
+def make_ticks(count, symbols, rng):
+    prices = dict.fromkeys(symbols, 100.0)
+    for _ in range(count):
+        symbol = rng.choice(symbols)
+        prices[symbol] *= 1 + rng.gauss(0, 0.01)
+        yield symbol, prices[symbol]
+
+
+def run(book, orders, ticks):
+    start = time.perf_counter()
+    for order in orders:
+        book.add(*order)
+    added = time.perf_counter()
+    triggered = sum(len(book.on_quote(symbol, price)) for symbol, price in ticks)
+    done = time.perf_counter()
+    return added - start, done - added, triggered
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=50000)
+    parser.add_argument("--symbols", type=int, default=500)
+    parser.add_argument("--ticks", type=int, default=100000)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    symbols = [f"SYM{i}" for i in range(args.symbols)]
+    orders = list(make_orders(args.orders, symbols, rng))
+    ticks = list(make_ticks(args.ticks, symbols, rng))
+
+    book = OrderBook()
+    # Keep the benchmark off the quote refresher
+    book._watch = book._unwatch = lambda symbol: None
+
+    print(f"{args.orders} resting orders over {args.symbols} symbols, {args.ticks} ticks")
+    for name, candidate in (("scan", ScanBook()), ("heap", book)):
+        add_s, tick_s, triggered = run(candidate, orders, ticks)
+        print(f"{name:>5}: add {args.orders / add_s:>10,.0f} orders/s  "
+              f"tick {args.ticks / tick_s:>10,.0f} ticks/s  ({tick_s / args.ticks * 1e6:.1f}us/tick)  "
+              f"{triggered} triggered")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""Throughput and correctness of concurrent market orders.
+
+Several threads place random market BUY and SELL orders through the
+/api/place_order route for a handful of users at once, so orders from the
+same user constantly race. Two implementations are compared:
+
+  rmw     funds and position read into Python, changed and written back
+  atomic  the route, with conditional UPDATE ... RETURNING and an upsert
+
+Afterwards every user's funds and positions are checked against the
+orders that were recorded as completed; any difference is a lost update.
+
+Runs against DATABASE_URL, or a fresh SQLite file if it isn't set. Use a
+scratch database: the benchmark's users and their orders are replaced.
+
+Usage: python bench_order_placement.py [--orders 2000] [--threads 8] [--users 4]
+"""
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+import tempfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+STARTING_FUNDS = 100000.0
+PRICES = {"AAPL": 190, "MSFT": 410, "NVDA": 120, "AMZN": 180}  # whole dollars, so totals are exact
+
+
+def place_order_read_modify_write():
+    """place_order before it used atomic statements, for comparison"""
+    from flask import jsonify, request
+    from flask_login import current_user
+    from app import db
+    from models import Order, Portfolio, User
+
+    data = request.json
+    symbol, order_type = data["symbol"], data["order_type"]
+    quantity, price = int(data["quantity"]), float(data["price"])
+    user = db.session.get(User, current_user.id)
+    portfolio_item = Portfolio.query.filter_by(user_id=user.id, symbol=symbol).first()
+
+    if order_type == "BUY":
+        if user.funds < price * quantity:
+            return jsonify({"success": False, "message": "Insufficient funds"}), 400
+        user.funds -= price * quantity
+        if portfolio_item:
+            total_value = portfolio_item.average_price * portfolio_item.quantity + price * quantity
+            portfolio_item.quantity += quantity
+            portfolio_item.average_price = total_value / portfolio_item.quantity
+        else:
+            db.session.add(Portfolio(user_id=user.id, symbol=symbol, quantity=quantity, average_price=price))
+    else:
+        if not portfolio_item or portfolio_item.quantity < quantity:
+            return jsonify({"success": False, "message": "Insufficient stocks to sell"}), 400
+        user.funds += price * quantity
+        portfolio_item.quantity -= quantity
+        if portfolio_item.quantity == 0:
+            db.session.delete(portfolio_item)
+
+    db.session.add(Order(user_id=user.id, symbol=symbol, order_type=order_type, quantity=quantity,
+                         price=price, status="COMPLETED"))
+    db.session.commit()
+    return jsonify({"success": True})
+
+
+def reset_users(app, db, count):
+    from models import Order, Portfolio, User
+
+    with app.app_context():
+        names = [f"bench{i}" for i in range(count)]
+        ids = [user_id for (user_id,) in db.session.query(User.id).filter(User.username.in_(names))]
+        Order.query.filter(Order.user_id.in_(ids)).delete(synchronize_session=False)
+        Portfolio.query.filter(Portfolio.user_id.in_(ids)).delete(synchronize_session=False)
+        for name in names:
+            user = User.query.filter_by(username=name).first()
+            if user is None:
+                user = User(username=name, email=f"{name}@bench.local")
+                user.set_password(name)
+                db.session.add(user)
+            user.funds = STARTING_FUNDS
+        db.session.commit()
+        return names
+
+
+def place_orders(app, username, count, seed):
+    rng = random.Random(seed)
+    client = app.test_client()
+    client.post("/login", data={"username": username, "password": username})
+    outcomes = Counter()
+    for _ in range(count):
+        symbol = rng.choice(list(PRICES))
+        order = {"symbol": symbol, "order_type": rng.choice(["BUY", "SELL"]),
+                 "quantity": rng.randint(1, 20), "price": PRICES[symbol]}
+        try:
+            status = client.post("/api/place_order", json=order).status_code
+        except Exception:
+            status = 500
+        outcomes[{200: "placed", 400: "rejected"}.get(status, "failed")] += 1
+    return outcomes
+
+
+def lost_updates(app, db, names):
+    """Users whose funds or positions don't match their completed orders"""
+    from models import Order, Portfolio, User
+
+    mismatched = []
+    with app.app_context():
+        db.session.expire_all()
+        for user in User.query.filter(User.username.in_(names)):
+            expected_funds = STARTING_FUNDS
+            expected = Counter()
+            for order in Order.query.filter_by(user_id=user.id, status="COMPLETED"):
+                sign = 1 if order.order_type == "BUY" else -1
+                expected_funds -= sign * order.price * order.quantity
+                expected[order.symbol] += sign * order.quantity
+            held = Counter({item.symbol: item.quantity for item in Portfolio.query.filter_by(user_id=user.id)})
+            if user.funds != expected_funds or +held != +expected:
+                mismatched.append(user.username)
+    return mismatched
+
+
+def run(app, db, names, args):
+    per_thread = args.orders // args.threads
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.threads) as pool:
+        results = pool.map(lambda i: place_orders(app, names[i % len(names)], per_thread, i),
+                           range(args.threads))
+        outcomes = sum(results, Counter())
+    return time.perf_counter() - start, per_thread * args.threads, outcomes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--users", type=int, default=4)
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix="bench_orders_")
+    os.environ.setdefault("DATABASE_URL", f"sqlite:///{scratch}/orders.db")
+    # Keep the app's background work and on-disk caches out of the way
+    for name, value in (("QUOTE_REFRESHER", "0"), ("LLM_WARM_UP", "0"), ("EMBEDDING_BACKFILL", "0"),
+                        ("VECTOR_INDEX_PATH", f"{scratch}/vectors.npy"),
+                        ("HISTORY_DB_PATH", f"{scratch}/history.sqlite3")):
+        os.environ.setdefault(name, value)
+    logging.disable(logging.CRITICAL)
+
+    from app import app, db
+    atomic_view = app.view_functions["place_order"]
+    with app.app_context():
+        dialect = db.engine.dialect.name
+
+    print(f"{args.orders} market orders from {args.threads} threads for {args.users} users "
+          f"on {dialect}")
+    for name, view in (("rmw", place_order_read_modify_write), ("atomic", atomic_view)):
+        names = reset_users(app, db, args.users)
+        app.view_functions["place_order"] = view
+        elapsed, total, outcomes = run(app, db, names, args)
+        mismatched = lost_updates(app, db, names)
+        print(f"{name:>6}: {total / elapsed:>8,.0f} orders/s  placed {outcomes['placed']:>5}  "
+              f"rejected {outcomes['rejected']:>5}  failed {outcomes['failed']:>5}  "
+              f"users with lost updates {len(mismatched)}/{len(names)}")
+    app.view_functions["place_order"] = atomic_view
+
+
+if __name__ == "__main__":
+    sys.exit(main())
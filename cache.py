@@ -0,0 +1,291 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, Optional, Tuple
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# An entry is stored as (value, expires_at) where expires_at is a time.time() timestamp.
+# Expired entries are kept until they are evicted or overwritten.
+Entry = Tuple[Any, float]
+
+
+class MemoryBackend:
+    """In-process LRU store bounded by number of entries"""
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Hashable, Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Entry]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                self._data.move_to_end(key)
+            return entry
+
+    def set(self, key: Hashable, entry: Entry) -> int:
+        """Store an entry and return the number of entries evicted"""
+        with self._lock:
+            self._data[key] = entry
+            self._data.move_to_end(key)
+            evicted = 0
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                evicted += 1
+            return evicted
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SQLiteBackend:
+    """LRU store in a local SQLite file, shared by every worker process on the host.
+
+    Keys are stored as text and values as JSON, so only JSON-serializable
+    values can be cached.
+    """
+
+    def __init__(self, path: str, maxsize: int = 4096, table: str = "cache"):
+        self.path = path
+        self.maxsize = maxsize
+        self.table = table
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            conn.execute(
+                f"CREATE INDEX IF NOT EXISTS ix_{self.table}_accessed_at ON {self.table} (accessed_at)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        # sqlite3 connections must not be shared between threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: Hashable) -> Optional[Entry]:
+        conn = self._connect()
+        row = conn.execute(
+            f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (str(key),)
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute(
+            f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?", (time.time(), str(key))
+        )
+        return json.loads(row[0]), row[1]
+
+    def set(self, key: Hashable, entry: Entry) -> int:
+        """Store an entry and return the number of entries evicted"""
+        value, expires_at = entry
+        conn = self._connect()
+        conn.execute(
+            f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (str(key), json.dumps(value), expires_at, time.time()),
+        )
+        overflow = conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0] - self.maxsize
+        if overflow <= 0:
+            return 0
+        conn.execute(
+            f"DELETE FROM {self.table} WHERE key IN "
+            f"(SELECT key FROM {self.table} ORDER BY accessed_at LIMIT ?)",
+            (overflow,),
+        )
+        return overflow
+
+    def delete(self, key: Hashable) -> None:
+        self._connect().execute(f"DELETE FROM {self.table} WHERE key = ?", (str(key),))
+
+    def clear(self) -> None:
+        self._connect().execute(f"DELETE FROM {self.table}")
+
+    def __len__(self) -> int:
+        return self._connect().execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+
+class TTLCache:
+    """Size-bounded TTL cache with per-key single-flight loading.
+
+    Only one loader call is in flight per key within a process; concurrent
+    callers for the same key wait for it and share its result.
+    """
+
+    def __init__(self, ttl: float, backend=None):
+        self.ttl = ttl
+        self.backend = backend if backend is not None else MemoryBackend()
+        self._key_locks: Dict[Hashable, list] = {}  # key -> [lock, waiter count]
+        self._key_locks_guard = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "loads": 0, "coalesced": 0,
+                       "stale_hits": 0}
+
+    def _count(self, name: str, n: int = 1) -> None:
+        with self._stats_lock:
+            self._stats[name] += n
+
+    def _fresh(self, key: Hashable) -> Optional[Any]:
+        entry = self.backend.get(key)
+        if entry is not None and time.time() < entry[1]:
+            return entry[0]
+        return None
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return the cached value if it is still fresh, else None"""
+        value = self._fresh(key)
+        self._count("hits" if value is not None else "misses")
+        return value
+
+    def get_many(self, keys: Iterable[Hashable], max_stale: float = 0.0,
+                 revalidate: Optional[Callable[[Hashable], None]] = None) -> Dict[Hashable, Any]:
+        """Return cached values for the given keys, skipping misses.
+
+        Stale entries are handled as in get_or_load. Only hits are counted
+        here; misses are counted when the caller goes on to load them
+        through get_or_load.
+        """
+        found = {}
+        now = time.time()
+        for key in keys:
+            entry = self.backend.get(key)
+            if entry is None:
+                continue
+            if now < entry[1]:
+                self._count("hits")
+                found[key] = entry[0]
+            elif revalidate is not None and now < entry[1] + max_stale:
+                self._count("stale_hits")
+                revalidate(key)
+                found[key] = entry[0]
+        return found
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        evicted = self.backend.set(key, (value, expires_at))
+        if evicted:
+            self._count("evictions", evicted)
+
+    def delete(self, key: Hashable) -> None:
+        self.backend.delete(key)
+
+    def clear(self) -> None:
+        self.backend.clear()
+
+    def peek(self, key: Hashable) -> Optional[Entry]:
+        """Return the raw (value, expires_at) entry, fresh or stale, without counting it"""
+        return self.backend.get(key)
+
+    def _acquire_slot(self, key: Hashable) -> list:
+        with self._key_locks_guard:
+            slot = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            slot[1] += 1
+            return slot
+
+    def _release_slot(self, key: Hashable, slot: list) -> None:
+        with self._key_locks_guard:
+            slot[1] -= 1
+            if slot[1] == 0:
+                self._key_locks.pop(key, None)
+
+    def get_or_load(self, key: Hashable, loader: Callable[[Hashable], Any],
+                    max_stale: float = 0.0, revalidate: Optional[Callable[[Hashable], None]] = None) -> Any:
+        """Return the cached value for key, calling loader(key) on a miss.
+
+        If revalidate is given, an entry that expired less than max_stale
+        seconds ago is returned as-is and revalidate(key) is called so the
+        caller can refresh it in the background.
+        Exceptions raised by the loader propagate and nothing is cached.
+        """
+        entry = self.backend.get(key)
+        if entry is not None:
+            now = time.time()
+            if now < entry[1]:
+                self._count("hits")
+                return entry[0]
+            if revalidate is not None and now < entry[1] + max_stale:
+                self._count("stale_hits")
+                revalidate(key)
+                return entry[0]
+        self._count("misses")
+
+        slot = self._acquire_slot(key)
+        try:
+            with slot[0]:
+                # Another caller may have loaded the key while we waited
+                value = self._fresh(key)
+                if value is not None:
+                    self._count("coalesced")
+                    return value
+                self._count("loads")
+                value = loader(key)
+                self.set(key, value)
+                return value
+        finally:
+            self._release_slot(key, slot)
+
+    def refresh(self, key: Hashable, loader: Callable[[Hashable], Any]) -> bool:
+        """Reload key unconditionally unless a load for it is already in flight.
+
+        Returns False if the refresh was skipped. Exceptions raised by the
+        loader propagate and the existing entry is left untouched.
+        """
+        slot = self._acquire_slot(key)
+        try:
+            if not slot[0].acquire(blocking=False):
+                return False
+            try:
+                self._count("loads")
+                self.set(key, loader(key))
+                return True
+            finally:
+                slot[0].release()
+        finally:
+            self._release_slot(key, slot)
+
+    def stats(self) -> Dict[str, int]:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["size"] = len(self.backend)
+        return stats
+
+
+def make_backend(name: str = "", maxsize: int = 1024, path: str = "", table: str = "cache"):
+    """Build a cache backend from configuration.
+
+    name defaults to the CACHE_BACKEND environment variable ("sqlite" or
+    "memory"); path defaults to CACHE_SQLITE_PATH. sqlite is the default so
+    every worker on the host sees what the background refresher loads;
+    memory keeps entries private to the process.
+    """
+    name = (name or os.environ.get("CACHE_BACKEND", "sqlite")).lower()
+    if name == "sqlite":
+        path = path or os.environ.get("CACHE_SQLITE_PATH", "/tmp/stocksphere_cache.sqlite3")
+        try:
+            return SQLiteBackend(path, maxsize=maxsize, table=table)
+        except sqlite3.Error as e:
+            logger.error(f"Could not open SQLite cache at {path}, using memory cache: {e}")
+    elif name != "memory":
+        logger.warning(f"Unknown cache backend {name}, using memory as fallback")
+    return MemoryBackend(maxsize=maxsize)
@@ -0,0 +1,278 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from sqlalchemy import delete, func, select, update
+
+from app import app, db
+from models import ChatJob, Portfolio, User
+from chatbot import generate_response
+from llm_providers import ERROR_REPLY_PREFIX, LLMError
+
+# Set up logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+CHAT_WORKERS = int(os.environ.get("CHAT_WORKERS", "2"))  # Chat turns generated at once per process
+CHAT_JOBS_PER_USER = 2  # Queued or running turns allowed per user
+CHAT_QUEUE_MAX = 100  # Queued turns across all users before new ones are refused
+CHAT_JOB_TTL = 600  # Seconds a job stays available after it last made progress
+CHAT_JOB_STALE = 300  # Seconds without a heartbeat or output after which an unfinished job counts as abandoned
+CHAT_JOB_HEARTBEAT = 30  # Seconds between touches of the unfinished jobs a process owns
+CHAT_JOB_FLUSH_INTERVAL = 0.1  # Seconds of generated text gathered into each write to the job's row
+CHAT_JOB_POLL_INTERVAL = 0.1  # Seconds between reads while waiting on a job generated by another process
+CHAT_MESSAGE_TIMEOUT = 60  # Seconds /chatbot/message waits for a reply before handing back the job instead
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+ABANDONED_ERROR = f"{ERROR_REPLY_PREFIX}: the assistant stopped responding. Please try again."
+
+
+class ChatJobRejected(Exception):
+    """Raised when a chat turn cannot be queued"""
+
+
+class ChatJobQueue:
+    """Runs chat turns on a small worker pool so web workers aren't held by generation.
+
+    Jobs are rows of the chat_job table, so a client's polls and streams
+    can land on any worker and the limits hold across processes: each user
+    may have a few turns queued or running at once, and the total backlog
+    is bounded. The process that accepts a turn generates it, appending
+    the text to the job's row as it arrives. Until the job finishes, that
+    process also touches its row every CHAT_JOB_HEARTBEAT seconds, however
+    long it waits for a worker or for the model's first token. A job whose
+    process died stops being touched and is reported failed after
+    CHAT_JOB_STALE seconds. Jobs are deleted CHAT_JOB_TTL seconds after
+    their last update.
+    """
+
+    def __init__(self, workers: int = CHAT_WORKERS, per_user: int = CHAT_JOBS_PER_USER,
+                 max_queued: int = CHAT_QUEUE_MAX, job_ttl: float = CHAT_JOB_TTL,
+                 stale_after: float = CHAT_JOB_STALE, heartbeat_interval: float = CHAT_JOB_HEARTBEAT,
+                 flush_interval: float = CHAT_JOB_FLUSH_INTERVAL, poll_interval: float = CHAT_JOB_POLL_INTERVAL):
+        self.workers = workers
+        self.per_user = per_user
+        self.max_queued = max_queued
+        self.job_ttl = job_ttl
+        self.stale_after = stale_after
+        self.heartbeat_interval = heartbeat_interval
+        self.flush_interval = flush_interval
+        self.poll_interval = poll_interval
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chat-worker")
+        self._changed = threading.Condition()  # Notified when a job in this process writes output
+        self._lock = threading.Lock()
+        self._owned = set()  # Unfinished jobs this process accepted, kept live by the heartbeat
+        self._heartbeat = None
+        self._stats = Counter()
+        self._wait_time = 0.0
+        self._run_time = 0.0
+
+    def _live(self, now: datetime):
+        """Jobs that are queued or running and still making progress"""
+        return ChatJob.status.in_((QUEUED, RUNNING)) & (ChatJob.updated_at > now - timedelta(seconds=self.stale_after))
+
+    def submit(self, user_id: int, session_id: int, message: str) -> str:
+        """Queue a chat turn and return its job id, raising ChatJobRejected if a limit is reached.
+
+        Must be called inside an application context.
+        """
+        now = datetime.utcnow()
+        try:
+            # Also takes SQLite's write lock, so submissions are checked one at a time there
+            db.session.execute(delete(ChatJob).where(ChatJob.updated_at < now - timedelta(seconds=self.job_ttl)))
+            # Two workers can't both pass one user's limit (PostgreSQL)
+            db.session.execute(select(User.id).where(User.id == user_id).with_for_update())
+            active = db.session.scalar(select(func.count()).select_from(ChatJob).where(
+                ChatJob.user_id == user_id, self._live(now)))
+            if active >= self.per_user:
+                raise ChatJobRejected("Please wait for your previous message to be answered.")
+            queued = db.session.scalar(select(func.count()).select_from(ChatJob).where(
+                ChatJob.status == QUEUED, self._live(now)))
+            if queued >= self.max_queued:
+                raise ChatJobRejected("The assistant is busy right now. Please try again shortly.")
+
+            job_id = uuid.uuid4().hex
+            db.session.add(ChatJob(id=job_id, user_id=user_id, session_id=session_id, message=message,
+                                   status=QUEUED, response="", created_at=now, updated_at=now))
+            db.session.commit()
+        except ChatJobRejected:
+            db.session.rollback()
+            with self._lock:
+                self._stats["rejected"] += 1
+            raise
+
+        with self._lock:
+            self._stats["submitted"] += 1
+            self._owned.add(job_id)
+            if self._heartbeat is None or not self._heartbeat.is_alive():
+                self._heartbeat = threading.Thread(target=self._beat, name="chat-heartbeat", daemon=True)
+                self._heartbeat.start()
+        self._executor.submit(self._run, job_id, user_id, session_id, message, time.monotonic())
+        return job_id
+
+    def _beat(self) -> None:
+        """Touch the unfinished jobs this process owns so they aren't taken for abandoned"""
+        while True:
+            time.sleep(self.heartbeat_interval)
+            with self._lock:
+                owned = list(self._owned)
+            if not owned:
+                continue
+            try:
+                now = datetime.utcnow()
+                with app.app_context(), db.engine.begin() as conn:
+                    conn.execute(update(ChatJob).where(
+                        ChatJob.id.in_(owned), self._live(now)).values(updated_at=now))
+            except Exception as e:
+                logger.error(f"Chat job heartbeat failed: {str(e)}", exc_info=True)
+
+    def get(self, job_id: str, offset: int = 0) -> Optional[Dict[str, Any]]:
+        """The job's state, or None if there is no such job.
+
+        response holds the text from character offset on and length the
+        whole response's length, so pollers can fetch only what is new.
+        position is the job's 1-based place in the queue, or 0 once started.
+        """
+        now = datetime.utcnow()
+        with db.engine.connect() as conn:
+            row = conn.execute(select(
+                ChatJob.user_id, ChatJob.status, ChatJob.error, ChatJob.created_at, ChatJob.updated_at,
+                func.substr(ChatJob.response, offset + 1), func.length(ChatJob.response),
+            ).where(ChatJob.id == job_id)).first()
+            if row is None:
+                return None
+            user_id, status, error, created_at, updated_at, response, length = row
+            position = 0
+            if status == QUEUED:
+                position = 1 + conn.scalar(select(func.count()).select_from(ChatJob).where(
+                    ChatJob.status == QUEUED, self._live(now), ChatJob.created_at < created_at))
+
+        if status in (QUEUED, RUNNING) and updated_at <= now - timedelta(seconds=self.stale_after):
+            status, error, position = FAILED, ABANDONED_ERROR, 0
+        return {
+            "job_id": job_id,
+            "user_id": user_id,
+            "status": status,
+            "finished": status in (DONE, FAILED),
+            "response": response or "",
+            "length": length or 0,
+            "error": error,
+            "position": position,
+        }
+
+    def wait(self, job_id: str, offset: int = 0, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """Block until the job has text past offset or finishes, or timeout passes; returns get()"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            state = self.get(job_id, offset)
+            if state is None or state["response"] or state["finished"]:
+                return state
+            remaining = self.poll_interval if deadline is None else min(deadline - time.monotonic(), self.poll_interval)
+            if remaining <= 0:
+                return state
+            # Output written in this process wakes us straight away; other processes' is polled for
+            with self._changed:
+                self._changed.wait(remaining)
+
+    def result(self, job_id: str, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """Block until the job finishes or timeout passes; returns get() with the whole response"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        length = 0
+        while True:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            state = self.wait(job_id, length, remaining)
+            if state is None or state["finished"] or remaining == 0:
+                return self.get(job_id)
+            length = state["length"]
+
+    def _write(self, job_id: str, text: str = "", live_only: bool = False, **values: Any) -> int:
+        """Append text to the job's response and set values in one statement; returns rows updated.
+
+        With live_only, an abandoned job is left alone.
+        """
+        now = datetime.utcnow()
+        values["updated_at"] = now
+        if text:
+            values["response"] = ChatJob.response + text
+        where = (ChatJob.id == job_id) & self._live(now) if live_only else ChatJob.id == job_id
+        with db.engine.begin() as conn:
+            updated = conn.execute(update(ChatJob).where(where).values(**values)).rowcount
+        with self._changed:
+            self._changed.notify_all()
+        return updated
+
+    def _run(self, job_id: str, user_id: int, session_id: int, message: str, submitted: float) -> None:
+        started = time.monotonic()
+        status = FAILED
+        try:
+            with app.app_context():
+                # Jobs that sat here until they were given up on aren't run after all
+                claimed = self._write(job_id, live_only=True, status=RUNNING, started_at=datetime.utcnow())
+                if not claimed:
+                    logger.warning(f"Chat job {job_id} was abandoned before it started")
+                    return
+
+                pending, streamed, last_write = [], False, 0.0
+
+                def on_token(text: str) -> None:
+                    nonlocal streamed, last_write
+                    pending.append(text)
+                    streamed = True
+                    if time.monotonic() - last_write >= self.flush_interval:
+                        self._write(job_id, "".join(pending))
+                        pending.clear()
+                        last_write = time.monotonic()
+
+                error = None
+                try:
+                    portfolio_items = Portfolio.query.filter_by(user_id=user_id).all()
+                    response_text, _ = generate_response(message, portfolio_items, session_id, on_token=on_token)
+                except LLMError as e:
+                    # Whatever was streamed before the failure is kept; the job still fails
+                    response_text, error = "", str(e)
+                except Exception as e:
+                    logger.error(f"Chat job {job_id} failed: {str(e)}", exc_info=True)
+                    response_text, error = "", f"{ERROR_REPLY_PREFIX}: {str(e)}"
+                status = FAILED if error else DONE
+                self._write(job_id, "".join(pending) if streamed else response_text,
+                            status=status, error=error, finished_at=datetime.utcnow())
+        except Exception as e:
+            logger.error(f"Chat job {job_id} could not be updated: {str(e)}", exc_info=True)
+        finally:
+            with self._lock:
+                self._owned.discard(job_id)
+                self._stats["completed" if status == DONE else "failed"] += 1
+                self._wait_time += started - submitted
+                self._run_time += time.monotonic() - started
+
+    def stats(self) -> Dict[str, Any]:
+        """Queue depth across processes, and this process's throughput counters.
+
+        Must be called inside an application context.
+        """
+        now = datetime.utcnow()
+        counts = dict(db.session.execute(
+            select(ChatJob.status, func.count()).where(self._live(now)).group_by(ChatJob.status)
+        ).all())
+        with self._lock:
+            finished = self._stats["completed"] + self._stats["failed"]
+            return {
+                "workers": self.workers,
+                "queued": counts.get(QUEUED, 0),
+                "running": counts.get(RUNNING, 0),
+                "submitted": self._stats["submitted"],
+                "completed": self._stats["completed"],
+                "failed": self._stats["failed"],
+                "rejected": self._stats["rejected"],
+                "avg_wait_ms": round(self._wait_time / finished * 1000, 1) if finished else 0.0,
+                "avg_run_ms": round(self._run_time / finished * 1000, 1) if finished else 0.0,
+            }
+
+
+chat_job_queue = ChatJobQueue()
@@ -1,11 +1,25 @@
 import os
+import re
 import logging
 import json
-import requests
+import hashlib
+import time
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import datetime
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Callable, Hashable, Optional, Tuple
+
+import numpy as np
+
 from models import ChatSession, ChatMessage, StockMetadata, Portfolio
-from app import db
+from app import app, db
+from cache import TTLCache, MemoryBackend
+from llm_providers import ERROR_REPLY_PREFIX, LLMError, LLMProvider, get_llm_provider
+from prompt_builder import build_prompt
+from symbol_index import symbol_index
+from vector_index import vector_index
+from process_lock import is_background_process
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
@@ -27,123 +41,251 @@ Base your advice on the following data when available:
 When the user asks about a specific stock in their portfolio, provide detailed analysis.
 """
 
-# Default model configuration
-DEFAULT_CONFIG = {
-    "temperature": 0.2,
-    "top_p": 0.95,
-    "max_tokens": 1024,
-}
+# Retrieval settings
+RAG_TOP_K = 5  # Related companies pulled into the context per question
+RAG_MIN_SIMILARITY = 0.3  # Cosine similarity below which a company is not considered related
+QUERY_EMBEDDING_TIMEOUT = 1.0  # Seconds to wait for the question's embedding before skipping retrieval
+EMBEDDING_BATCH_SIZE = 32  # Texts per embedding request during backfill
+EMBEDDING_WORKERS = 4  # Concurrent embedding requests during backfill
+EMBEDDING_BACKFILL_INTERVAL = 300  # Seconds between backfill passes, which pick up other processes' rows
+
+# Context sections are cached by their inputs, so follow-up questions reuse them
+CONTEXT_CACHE_TTL = 300  # seconds
+CONTEXT_CACHE_SIZE = 1024  # entries
+context_cache = TTLCache(CONTEXT_CACHE_TTL, MemoryBackend(maxsize=CONTEXT_CACHE_SIZE))
+
+# Answers are reused for near-identical questions asked against the same data
+RESPONSE_CACHE_TTL = 600  # seconds
+RESPONSE_CACHE_SIZE = 512  # entries
+RESPONSE_CACHE_MIN_SIMILARITY = 0.95  # Cosine similarity at which two questions count as the same
+PORTFOLIO_TERMS = {"i", "me", "my", "mine", "own", "portfolio", "holdings", "position", "positions", "shares"}
+FOLLOW_UP_TERMS = {"it", "its", "that", "this", "these", "those", "they", "them", "above", "previous",
+                   "earlier", "again", "else", "more"}
+
+# Conversation history
+HISTORY_MAX_MESSAGES = 50  # Unsummarized messages loaded per turn before fitting them to the token budget
+SUMMARY_PROMPT = """
+You maintain a running summary of a conversation between a user and a financial assistant.
+Update the summary with the new turns. Keep facts the assistant may need later: the user's goals,
+holdings and stocks discussed, questions asked and conclusions reached. Reply with the summary only,
+in at most 200 words.
+"""
+
+
+def _fingerprint(rows: Any) -> str:
+    """Short stable hash of rows for use in cache keys"""
+    return hashlib.sha1(repr(rows).encode()).hexdigest()
 
-class LLMProvider:
-    """Base class for LLM providers"""
+
+_query_embedding_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="query-embed")
+
+
+def normalize_question(text: str) -> str:
+    """Lowercase text and reduce it to words, so trivially different questions compare equal"""
+    return " ".join(re.findall(r"[a-z0-9]+", text.lower()))
+
+
+class ResponseCache:
+    """Earlier answers, found by exact or embedding similarity match on the question.
     
-    def __init__(self, model_name: str = "default", **kwargs):
-        self.model_name = model_name
-        self.config = DEFAULT_CONFIG.copy()
-        self.config.update(kwargs)
+    Each entry is stored under a scope naming the data the answer was based
+    on, such as the market quote version or a user's holdings, and is only
+    found by lookups in that scope. Entries expire after ttl seconds and
+    the least recently used are evicted beyond maxsize.
+    """
     
-    def generate_embedding(self, text: str) -> List[float]:
-        """Generate embeddings for the given text"""
-        # Should be implemented by subclasses
-        raise NotImplementedError
+    def __init__(self, ttl: float = RESPONSE_CACHE_TTL, maxsize: int = RESPONSE_CACHE_SIZE,
+                 min_similarity: float = RESPONSE_CACHE_MIN_SIMILARITY):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.min_similarity = min_similarity
+        # (scope, question) -> [unit embedding or None, response, expires], least recently used first
+        self._entries: "OrderedDict[Tuple[Hashable, str], list]" = OrderedDict()
+        self._scopes: Dict[Hashable, set] = {}  # scope -> questions stored under it
+        self._lock = threading.Lock()
+        self._stats = Counter()
     
-    def generate_completion(self, messages: List[Dict[str, str]]) -> str:
-        """Generate a completion for the given messages"""
-        # Should be implemented by subclasses
-        raise NotImplementedError
-
-
-class OllamaProvider(LLMProvider):
-    """Provider for Ollama API"""
+    @staticmethod
+    def _unit(embedding: Optional[List[float]]) -> Optional[np.ndarray]:
+        if embedding is None or not len(embedding):
+            return None
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
     
-    def __init__(self, model_name: str = "llama3.2:latest", base_url: str = "http://localhost:11434", **kwargs):
-        super().__init__(model_name, **kwargs)
-        self.base_url = base_url
-        # Connect to the Ollama API
-        try:
-            # Test connection
-            response = requests.get(f"{self.base_url}/api/version")
-            if response.status_code == 200:
-                logger.info(f"Connected to Ollama API: {response.json()}")
-            else:
-                logger.warning(f"Could not connect to Ollama API: {response.status_code}")
-        except Exception as e:
-            logger.error(f"Error connecting to Ollama API: {str(e)}")
+    def _remove(self, key: Tuple[Hashable, str]) -> None:
+        del self._entries[key]
+        questions = self._scopes[key[0]]
+        questions.discard(key[1])
+        if not questions:
+            del self._scopes[key[0]]
     
-    def generate_embedding(self, text: str) -> List[float]:
-        """Generate embeddings using Ollama"""
-        try:
-            response = requests.post(
-                f"{self.base_url}/api/embeddings",
-                json={"model": self.model_name, "prompt": text}
-            )
-            if response.status_code == 200:
-                return response.json().get("embedding", [])
-            else:
-                logger.error(f"Embedding error: {response.status_code} - {response.text}")
-                return []
-        except Exception as e:
-            logger.error(f"Error generating embedding with Ollama: {str(e)}")
-            return []
+    def get(self, scopes: List[Hashable], question: str,
+            embed: Callable[[str], Optional[List[float]]]) -> Tuple[Optional[str], Optional[List[float]]]:
+        """Find an answer to question stored under any of scopes.
+        
+        question is normalized before matching. embed is called with the
+        normalized question only when there is no exact match. Returns the
+        answer (None on a miss) and the embedding, if one was made, so the
+        caller can reuse it and pass it to set().
+        """
+        question = normalize_question(question)
+        now = time.time()
+        with self._lock:
+            for scope in scopes:
+                entry = self._entries.get((scope, question))
+                if entry is not None and entry[2] > now:
+                    self._entries.move_to_end((scope, question))
+                    self._stats["exact_hits"] += 1
+                    return entry[1], None
+        
+        embedding = embed(question)
+        vector = self._unit(embedding)
+        if vector is not None:
+            with self._lock:
+                candidates = [
+                    (scope, other) for scope in scopes for other in self._scopes.get(scope, ())
+                    if self._entries[(scope, other)][0] is not None and self._entries[(scope, other)][2] > now
+                    and len(self._entries[(scope, other)][0]) == len(vector)
+                ]
+                if candidates:
+                    similarities = np.stack([self._entries[key][0] for key in candidates]) @ vector
+                    best = int(np.argmax(similarities))
+                    if similarities[best] >= self.min_similarity:
+                        self._entries.move_to_end(candidates[best])
+                        self._stats["semantic_hits"] += 1
+                        return self._entries[candidates[best]][1], embedding
+        
+        with self._lock:
+            self._stats["misses"] += 1
+        return None, embedding
     
-    def generate_completion(self, messages: List[Dict[str, str]]) -> str:
-        """Generate a completion using Ollama"""
-        try:
-            # Format messages for Ollama
-            prompt = ""
-            for message in messages:
-                role = message.get("role", "user")
-                content = message.get("content", "")
-                
-                if role == "system":
-                    prompt += f"System: {content}\n\n"
-                elif role == "user":
-                    prompt += f"User: {content}\n\n"
-                elif role == "assistant":
-                    prompt += f"Assistant: {content}\n\n"
-            
-            # Add the final assistant prompt
-            prompt += "Assistant: "
-            
-            response = requests.post(
-                f"{self.base_url}/api/generate",
-                json={
-                    "model": self.model_name,
-                    "prompt": prompt,
-                    "temperature": self.config.get("temperature", 0.2),
-                    "top_p": self.config.get("top_p", 0.95),
-                    "max_tokens": self.config.get("max_tokens", 1024),
-                    "stream": False
-                }
-            )
+    def set(self, scope: Hashable, question: str, embedding: Optional[List[float]], response: str) -> None:
+        key = (scope, normalize_question(question))
+        now = time.time()
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = [self._unit(embedding), response, now + self.ttl]
+            self._scopes.setdefault(scope, set()).add(key[1])
+            self._stats["stores"] += 1
             
-            if response.status_code == 200:
-                return response.json().get("response", "")
-            else:
-                logger.error(f"Completion error: {response.status_code} - {response.text}")
-                return "Sorry, I encountered an error generating a response."
-        except Exception as e:
-            logger.error(f"Error generating completion with Ollama: {str(e)}")
-            return f"Sorry, I encountered an error: {str(e)}"
+            # Drop expired entries from the old end, then the least recently used beyond maxsize
+            while self._entries:
+                oldest = next(iter(self._entries))
+                if len(self._entries) > self.maxsize:
+                    self._stats["evictions"] += 1
+                elif self._entries[oldest][2] <= now:
+                    self._stats["expirations"] += 1
+                else:
+                    break
+                self._remove(oldest)
+    
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._scopes.clear()
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = {name: self._stats[name] for name in
+                     ("exact_hits", "semantic_hits", "misses", "stores", "evictions", "expirations")}
+            stats["size"] = len(self._entries)
+        lookups = stats["exact_hits"] + stats["semantic_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["exact_hits"] + stats["semantic_hits"]) / lookups, 3) if lookups else 0.0
+        return stats
 
 
-# You can add other providers here in the future
-# class OpenAIProvider(LLMProvider):
-#     def __init__(self, api_key, model_name="gpt-4o", **kwargs):
-#         super().__init__(model_name, **kwargs)
-#         # Implementation for OpenAI
+response_cache = ResponseCache()
 
 
-# Factory function to get the right provider
-def get_llm_provider(provider_name: str = "ollama", **kwargs) -> LLMProvider:
-    """Get the appropriate LLM provider based on configuration"""
-    if provider_name.lower() == "ollama":
-        return OllamaProvider(**kwargs)
-    # elif provider_name.lower() == "openai":
-    #     return OpenAIProvider(**kwargs)
-    else:
-        logger.warning(f"Unknown provider {provider_name}, using Ollama as fallback")
-        return OllamaProvider(**kwargs)
+class EmbeddingBackfill:
+    """Generates StockMetadata embeddings in the background.
+    
+    Each pass converts rows still holding JSON embeddings to binary and
+    embeds rows without one, in batches sent concurrently to the provider.
+    New embeddings are committed per batch and added to the vector index.
+    schedule() wakes the worker; request handlers never wait on it.
+    
+    Only the background process (see process_lock) runs the worker, so
+    rows are embedded once per host. It also makes a pass every
+    EMBEDDING_BACKFILL_INTERVAL seconds to embed rows created by other
+    processes, whose schedule() calls do nothing.
+    """
+    
+    def __init__(self, batch_size: int = EMBEDDING_BATCH_SIZE, workers: int = EMBEDDING_WORKERS):
+        self.batch_size = batch_size
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="embedding-backfill")
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+    
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+    
+    def schedule(self) -> None:
+        """Start the worker if needed and ask it for another pass"""
+        if not is_background_process():
+            return
+        with self._lock:
+            if not self.running:
+                self._thread = threading.Thread(target=self._run, name="embedding-backfill", daemon=True)
+                self._thread.start()
+        self._wake.set()
+    
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(EMBEDDING_BACKFILL_INTERVAL)
+            self._wake.clear()
+            try:
+                with app.app_context():
+                    self.run_once()
+            except Exception as e:
+                logger.error(f"Embedding backfill pass failed: {str(e)}", exc_info=True)
+    
+    def run_once(self) -> int:
+        """Backfill every row missing a binary embedding; returns the number stored.
+        
+        Must be called inside an application context.
+        """
+        stored = 0
+        
+        # Rows written before binary storage only need re-encoding
+        legacy = StockMetadata.query.filter(StockMetadata.embedding_vector.is_(None),
+                                            StockMetadata.embedding.isnot(None)).all()
+        for metadata in legacy:
+            metadata.set_embedding(metadata.get_embedding())
+        if legacy:
+            db.session.commit()
+            stored += len(legacy)
+        
+        pending = StockMetadata.query.filter(StockMetadata.embedding_vector.is_(None)).all()
+        if not pending:
+            return stored
+        
+        provider = get_llm_provider()
+        batches = [pending[i:i + self.batch_size] for i in range(0, len(pending), self.batch_size)]
+        start = time.perf_counter()
+        # Requests run concurrently; results are written from this thread, which owns the session
+        results = self._executor.map(
+            provider.generate_embeddings,
+            [[metadata.embedding_text() for metadata in batch] for batch in batches]
+        )
+        embedded_count = 0
+        for batch, embeddings in zip(batches, results):
+            embedded = [(metadata, embedding) for metadata, embedding in zip(batch, embeddings) if len(embedding)]
+            for metadata, embedding in embedded:
+                metadata.set_embedding(embedding)
+            db.session.commit()
+            vector_index.add_many((metadata.symbol, embedding) for metadata, embedding in embedded)
+            embedded_count += len(embedded)
+        
+        logger.info(f"Embedded {embedded_count} of {len(pending)} stock metadata rows in {time.perf_counter() - start:.1f}s")
+        return stored + embedded_count
+
+
+embedding_backfill = EmbeddingBackfill()
 
 
 class RAGEngine:
@@ -170,13 +312,12 @@ class RAGEngine:
                     description=stock_info.get('description', '')
                 )
                 
-                # Generate and store embedding
-                if metadata.description:
-                    embedding = self.llm_provider.generate_embedding(metadata.description)
-                    metadata.set_embedding(embedding)
-                
                 db.session.add(metadata)
                 db.session.commit()
+                symbol_index.add(metadata.symbol, metadata.name)
+                
+                # Embed it in the background rather than on the user's request
+                embedding_backfill.schedule()
                 logger.debug(f"Created new stock metadata for {symbol}")
             except Exception as e:
                 logger.error(f"Error fetching stock metadata for {symbol}: {str(e)}")
@@ -184,38 +325,40 @@ class RAGEngine:
         
         return metadata
     
+    def get_stock_metadata_bulk(self, symbols: List[str]) -> Dict[str, StockMetadata]:
+        """Get metadata for many symbols with one query, creating any that are missing"""
+        found = {row.symbol: row for row in StockMetadata.query.filter(StockMetadata.symbol.in_(symbols)).all()}
+        for symbol in symbols:
+            if symbol not in found:
+                metadata = self.get_stock_metadata(symbol)
+                if metadata:
+                    found[symbol] = metadata
+        return found
+    
     def format_portfolio_for_context(self, portfolio_data: List[Portfolio]) -> str:
         """Format portfolio data as context for the chatbot"""
-        portfolio_context = "User Portfolio:\n"
-        
         if not portfolio_data:
             return "User Portfolio: No stocks in portfolio."
         
-        # Format the portfolio data
-        total_value = 0
-        for item in portfolio_data:
-            try:
-                from stock_data import get_stock_data
-                stock_info = get_stock_data(item.symbol)
-                current_price = stock_info.get('price', item.average_price)
-                position_value = item.quantity * current_price
-                total_value += position_value
-                
-                # Get additional metadata
-                metadata = self.get_stock_metadata(item.symbol)
-                company_name = metadata.name if metadata else ""
-                sector = metadata.sector if metadata else ""
-                
-                portfolio_context += (
-                    f"- {item.symbol} ({company_name}): {item.quantity} shares at avg. price "
-                    f"${item.average_price:.2f}, current price ${current_price:.2f}, "
-                    f"total value ${position_value:.2f}, sector: {sector}\n"
-                )
-            except Exception as e:
-                logger.error(f"Error formatting portfolio item {item.symbol}: {str(e)}")
-                portfolio_context += f"- {item.symbol}: {item.quantity} shares at avg. price ${item.average_price:.2f}\n"
+        # Make sure every holding has metadata, then value them all at once
+        self.get_stock_metadata_bulk([item.symbol for item in portfolio_data])
+        from portfolio_valuation import portfolio_valuator
+        valuation = portfolio_valuator.value(portfolio_data[0].user_id, portfolio_data)
         
-        portfolio_context += f"\nTotal Portfolio Value: ${total_value:.2f}"
+        portfolio_context = "User Portfolio:\n" + "".join(
+            f"- {position['symbol']} ({position['company_name']}): {position['quantity']} shares at avg. price "
+            f"${position['average_price']:.2f}, current price ${position['current_price']:.2f}, "
+            f"total value ${position['current_value']:.2f}, P&L ${position['profit_loss']:.2f} "
+            f"({position['profit_loss_percentage']:.2f}%), weight {position['weight'] * 100:.1f}%, "
+            f"sector: {position['sector']}\n"
+            for position in valuation.records()
+        )
+        portfolio_context += (
+            f"\nTotal Portfolio Value: ${valuation.total_value:.2f} "
+            f"(P&L ${valuation.profit_loss:.2f}, {valuation.profit_loss_percentage:.2f}%)\n"
+            "Sector Allocation: " + ", ".join(
+                f"{sector} {weight * 100:.1f}%" for sector, weight in valuation.sector_allocation.items())
+        )
         return portfolio_context
 
     def get_relevant_market_data(self) -> str:
@@ -227,23 +370,40 @@ class RAGEngine:
                 return ""
             
             market_context = "Current Market Conditions:\n"
-            # Make sure market_data is a dictionary
-            if isinstance(market_data, dict):
-                for index, data in market_data.items():
-                    market_context += f"- {index}: {data.get('price', 0):.2f} ({data.get('change', 0):.2f}%)\n"
+            for data in market_data:
+                market_context += (
+                    f"- {data.get('name', data.get('symbol'))}: {data.get('price', 0):.2f} "
+                    f"({data.get('change_percent', 0):.2f}%)\n"
+                )
             
             return market_context
         except Exception as e:
             logger.error(f"Error getting market data: {str(e)}")
             return ""
     
-    def build_context(self, user_id: int, portfolio_data: List[Portfolio], query: str) -> str:
-        """Build context for RAG from portfolio and market data"""
-        # Get portfolio context
-        portfolio_context = self.format_portfolio_for_context(portfolio_data)
+    def build_context(self, user_id: int, portfolio_data: List[Portfolio], query: str,
+                      query_embedding: Optional[List[float]] = None) -> str:
+        """Build context for RAG from portfolio and market data
+        
+        query_embedding is the question's embedding if the caller already has it.
+        """
+        # Embed the question while the rest of the context is gathered
+        embedding_future = None
+        if len(vector_index) and query_embedding is None:
+            embedding_future = _query_embedding_executor.submit(self.llm_provider.generate_embedding, query)
+        
+        from stock_data import quote_version, MARKET_INDICES
+        
+        # Each section is rebuilt only when its holdings or the quotes it uses change
+        holdings = sorted((item.symbol, item.quantity, item.average_price) for item in portfolio_data)
+        portfolio_key = ("portfolio", user_id, _fingerprint(holdings),
+                         quote_version([symbol for symbol, _, _ in holdings]))
+        portfolio_context = context_cache.get_or_load(
+            portfolio_key, lambda _: self.format_portfolio_for_context(portfolio_data))
         
         # Get market context
-        market_context = self.get_relevant_market_data()
+        market_context = context_cache.get_or_load(
+            ("market", quote_version(MARKET_INDICES)), lambda _: self.get_relevant_market_data())
         
         # Combined context
         context = f"{portfolio_context}\n\n{market_context}"
@@ -251,12 +411,45 @@ class RAGEngine:
         # If query mentions specific stocks, add more details
         mentioned_symbols = self.extract_stock_symbols(query, portfolio_data)
         if mentioned_symbols:
-            stock_details = self.get_stock_details(mentioned_symbols)
+            stock_details = context_cache.get_or_load(
+                ("details", tuple(mentioned_symbols), quote_version(mentioned_symbols)),
+                lambda _: self.get_stock_details(mentioned_symbols))
             if stock_details:
                 context += f"\n\nDetailed Stock Information:\n{stock_details}"
         
+        # Add companies semantically related to the question beyond what the user holds
+        related = []
+        if embedding_future is not None:
+            try:
+                query_embedding = embedding_future.result(timeout=QUERY_EMBEDDING_TIMEOUT)
+            except FutureTimeoutError:
+                logger.warning("Question embedding timed out; answering without related companies")
+        if query_embedding is not None and len(vector_index):
+            related = self.find_related_stocks(query_embedding, [item.symbol for item in portfolio_data] + mentioned_symbols)
+        if related:
+            context += "\n\nRelated Companies:\n" + "".join(
+                f"- {metadata.symbol} ({metadata.name}): sector {metadata.sector or 'N/A'}, "
+                f"industry {metadata.industry or 'N/A'}\n"
+                for metadata in related
+            )
+        
         return context
     
+    def find_related_stocks(self, query_embedding: List[float], exclude: List[str]) -> List[StockMetadata]:
+        """Find stocks whose embeddings are closest to the question's embedding"""
+        if not len(query_embedding):
+            return []
+        
+        start = time.perf_counter()
+        matches = vector_index.search(query_embedding, k=RAG_TOP_K, exclude=exclude)
+        logger.debug(f"Vector top-{RAG_TOP_K} over {len(vector_index)} rows took {(time.perf_counter() - start) * 1000:.2f}ms")
+        
+        symbols = [symbol for symbol, score in matches if score >= RAG_MIN_SIMILARITY]
+        if not symbols:
+            return []
+        rows = {row.symbol: row for row in StockMetadata.query.filter(StockMetadata.symbol.in_(symbols)).all()}
+        return [rows[symbol] for symbol in symbols if symbol in rows]
+    
     def extract_stock_symbols(self, query: str, portfolio_data: List[Portfolio]) -> List[str]:
         """Extract stock symbols mentioned in the query"""
         # Simple extraction based on portfolio items
@@ -271,11 +464,14 @@ class RAGEngine:
         """Get detailed information about specific stocks"""
         stock_details = ""
         
+        from stock_data import get_stock_data_bulk
+        quotes = get_stock_data_bulk(symbols)
+        metadata_by_symbol = self.get_stock_metadata_bulk(symbols)
+        
         for symbol in symbols:
             try:
-                from stock_data import get_stock_data
-                stock_info = get_stock_data(symbol)
-                metadata = self.get_stock_metadata(symbol)
+                stock_info = quotes.get(symbol)
+                metadata = metadata_by_symbol.get(symbol)
                 
                 if stock_info and metadata:
                     stock_details += f"Stock: {symbol} ({metadata.name})\n"
@@ -323,17 +519,185 @@ def store_message(session_id: int, is_user: bool, content: str, model_name: str
     return message
 
 
-def generate_response(user_message: str, portfolio_data: List[Portfolio] = [], session_id: int = 0) -> Tuple[str, int]:
-    """Generate a response using RAG and the LLM"""
+def _session_state(chat_session: ChatSession) -> Dict[str, Any]:
+    """Running summary of a session and the id of the last message it covers"""
+    state = {"summary": "", "summarized_through": 0}
+    if chat_session.context_data:
+        try:
+            state.update(json.loads(chat_session.context_data))
+        except ValueError:
+            logger.warning(f"Ignoring malformed context data on chat session {chat_session.id}")
+    return state
+
+
+def _prepare_turn(user_message: str, portfolio_data: List[Portfolio], chat_session: ChatSession,
+                  llm_provider: LLMProvider,
+                  query_embedding: Optional[List[float]] = None) -> Tuple[List[Dict[str, str]], int]:
+    """Store the user's message and build the LLM messages for this turn.
+    
+    Returns the messages and the id of the newest message that no longer
+    fits in the prompt (0 if all fit), which should be summarized.
+    """
+    rag_engine = RAGEngine(llm_provider)
+    
+    # Update session timestamp
+    chat_session.last_updated = datetime.utcnow()
+    db.session.commit()
+    
+    # Store user message
+    store_message(chat_session.id, True, user_message)
+    
+    # Build context with RAG
+    context = rag_engine.build_context(chat_session.user_id, portfolio_data, user_message, query_embedding)
+    
+    # Get the messages not yet rolled into the session's running summary
+    state = _session_state(chat_session)
+    previous_messages = ChatMessage.query.filter(
+        ChatMessage.session_id == chat_session.id,
+        ChatMessage.id > state["summarized_through"]
+    ).order_by(ChatMessage.id.desc()).limit(HISTORY_MAX_MESSAGES).all()
+    previous_messages.reverse()  # Get in chronological order
+    history = [
+        {"id": msg.id, "role": "user" if msg.is_user else "assistant", "content": msg.content}
+        for msg in previous_messages
+    ]
+    
+    # Fit context, summary and as much recent history as the token budget allows
+    messages, dropped, _ = build_prompt(SYSTEM_PROMPT, context, state["summary"], history)
+    return messages, dropped[-1]["id"] if dropped else 0
+
+
+_summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-summary")
+_summaries_pending = set()
+_summaries_lock = threading.Lock()
+
+
+def schedule_summary(session_id: int, through_id: int) -> None:
+    """Roll a session's messages up to through_id into its running summary in the background"""
+    if not through_id:
+        return
+    with _summaries_lock:
+        if session_id in _summaries_pending:
+            return
+        _summaries_pending.add(session_id)
+    _summary_executor.submit(_update_summary, session_id, through_id)
+
+
+def _update_summary(session_id: int, through_id: int) -> None:
+    try:
+        with app.app_context():
+            chat_session = db.session.get(ChatSession, session_id)
+            state = _session_state(chat_session)
+            if through_id <= state["summarized_through"]:
+                return
+            
+            turns = ChatMessage.query.filter(
+                ChatMessage.session_id == session_id,
+                ChatMessage.id > state["summarized_through"],
+                ChatMessage.id <= through_id
+            ).order_by(ChatMessage.id).all()
+            transcript = "\n".join(f"{'User' if msg.is_user else 'Assistant'}: {msg.content}" for msg in turns)
+            
+            start = time.perf_counter()
+            summary = get_llm_provider().generate_completion([
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": f"Current summary:\n{state['summary'] or '(none)'}\n\nNew turns:\n{transcript}"}
+            ]).strip()
+            if not summary or summary.startswith(ERROR_REPLY_PREFIX):
+                logger.warning(f"Could not summarize chat session {session_id}")
+                return
+            
+            chat_session.context_data = json.dumps({"summary": summary, "summarized_through": through_id})
+            db.session.commit()
+            logger.debug(f"Summarized {len(turns)} messages of chat session {session_id} "
+                         f"in {time.perf_counter() - start:.1f}s")
+    except Exception as e:
+        logger.error(f"Error summarizing chat session {session_id}: {str(e)}", exc_info=True)
+    finally:
+        with _summaries_lock:
+            _summaries_pending.discard(session_id)
+
+
+def _embed_question(llm_provider: LLMProvider, question: str) -> Optional[List[float]]:
+    try:
+        return _query_embedding_executor.submit(llm_provider.generate_embedding, question).result(
+            timeout=QUERY_EMBEDDING_TIMEOUT)
+    except FutureTimeoutError:
+        logger.warning("Question embedding timed out; matching cached answers exactly only")
+        return None
+
+
+def _response_scopes(user_id: int, portfolio_data: List[Portfolio]) -> Tuple[Hashable, Hashable]:
+    """Cache scopes for answers based on the current market data alone, and on it and one user's data"""
+    from stock_data import quote_version, MARKET_INDICES
+    
+    market_scope = ("market", quote_version(MARKET_INDICES))
+    holdings = sorted((item.symbol, item.quantity, item.average_price) for item in portfolio_data)
+    user_scope = market_scope + ("user", user_id, _fingerprint(holdings),
+                                 quote_version([symbol for symbol, _, _ in holdings]))
+    return market_scope, user_scope
+
+
+def _lookup_response(user_message: str, portfolio_data: List[Portfolio], chat_session: ChatSession,
+                     llm_provider: LLMProvider) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+    """Look for a cached answer to this turn's question.
+    
+    Returns the cached answer, if any, and the lookup to pass to
+    _remember_response once a new answer is generated, which is None when
+    the question refers back to the conversation and shouldn't be cached.
+    """
+    words = set(normalize_question(user_message).split())
+    has_history = ChatMessage.query.filter_by(session_id=chat_session.id).first() is not None
+    if words & FOLLOW_UP_TERMS and has_history:
+        return None, None
+    
+    market_scope, user_scope = _response_scopes(chat_session.user_id, portfolio_data)
+    # Only answers to prompts without any holdings or conversation are shared between users
+    shared = not portfolio_data and not has_history
+    about_portfolio = bool(words & PORTFOLIO_TERMS) or any(item.symbol.lower() in words for item in portfolio_data)
+    
+    scopes = [user_scope] if about_portfolio else [user_scope, market_scope]
+    cached, embedding = response_cache.get(scopes, user_message, lambda question: _embed_question(llm_provider, question))
+    lookup = {"user_id": chat_session.user_id, "portfolio_data": portfolio_data,
+              "shared": shared, "embedding": embedding}
+    return cached, lookup
+
+
+def _remember_response(user_message: str, response_text: str, lookup: Optional[Dict[str, Any]]) -> None:
+    """Cache a newly generated answer under the scope of the data its prompt carried"""
+    if lookup is None or not response_text.strip() or response_text.startswith(ERROR_REPLY_PREFIX):
+        return
+    # Scopes are taken now since building the context may have refreshed quotes
+    market_scope, user_scope = _response_scopes(lookup["user_id"], lookup["portfolio_data"])
+    response_cache.set(market_scope if lookup["shared"] else user_scope, user_message,
+                       lookup["embedding"], response_text)
+
+
+def _reply_from_cache(user_message: str, response_text: str, chat_session: ChatSession, model_name: str) -> None:
+    """Record a turn answered from the response cache"""
+    logger.debug(f"Answered from the response cache in chat session {chat_session.id}")
+    chat_session.last_updated = datetime.utcnow()
+    store_message(chat_session.id, True, user_message)
+    store_message(chat_session.id, False, response_text, model_name)
+
+
+def generate_response(user_message: str, portfolio_data: List[Portfolio] = [], session_id: int = 0,
+                      on_token: Optional[Callable[[str], None]] = None) -> Tuple[str, int]:
+    """Generate a response using RAG and the LLM
+    
+    If on_token is given the completion is streamed and on_token is called
+    with each piece of text as it arrives.
+    
+    Raises LLMError if the model or anything else fails, even after some
+    text has been passed to on_token; the failed reply isn't stored in the
+    chat history.
+    """
     logger.debug(f"Starting generate_response with message: {user_message[:50]}...")
     
     try:
         # Get LLM provider
         llm_provider = get_llm_provider()
         
-        # Initialize RAG engine
-        rag_engine = RAGEngine(llm_provider)
-        
         # Get or create chat session if not provided
         if session_id > 0:
             chat_session = ChatSession.query.get(session_id)
@@ -347,38 +711,41 @@ def generate_response(user_message: str, portfolio_data: List[Portfolio] = [], s
             fallback_session = get_or_create_chat_session(1)  # Default to user ID 1
             return "Sorry, there was an error with the chat session.", fallback_session.id
         
-        # Update session timestamp
-        chat_session.last_updated = datetime.utcnow()
-        db.session.commit()
-        
-        # Store user message
-        store_message(chat_session.id, True, user_message)
-        
-        # Build context with RAG
-        context = rag_engine.build_context(chat_session.user_id, portfolio_data, user_message)
-        
-        # Get previous messages for context (limit to last 10)
-        previous_messages = ChatMessage.query.filter_by(session_id=chat_session.id).order_by(ChatMessage.timestamp.desc()).limit(10).all()
-        previous_messages.reverse()  # Get in chronological order
+        # Reuse the answer to an equivalent question asked against the same data
+        cached, lookup = _lookup_response(user_message, portfolio_data, chat_session, llm_provider)
+        if cached is not None:
+            _reply_from_cache(user_message, cached, chat_session, llm_provider.model_name)
+            if on_token is not None:
+                on_token(cached)
+            return cached, chat_session.id
         
-        # Build messages for LLM
-        messages = [
-            {"role": "system", "content": f"{SYSTEM_PROMPT}\n\nContext Information:\n{context}"}
-        ]
-        
-        # Add previous messages
-        for msg in previous_messages:
-            role = "user" if msg.is_user else "assistant"
-            messages.append({"role": role, "content": msg.content})
+        messages, summarize_through = _prepare_turn(user_message, portfolio_data, chat_session, llm_provider,
+                                                    lookup["embedding"] if lookup else None)
         
         # Generate response
-        response_text = llm_provider.generate_completion(messages)
+        if on_token is None:
+            response_text = llm_provider.generate_completion(messages)
+            if response_text.startswith(ERROR_REPLY_PREFIX):
+                raise LLMError(response_text)
+        else:
+            parts = []
+            for token in llm_provider.stream_completion(messages):
+                parts.append(token)
+                on_token(token)
+            response_text = "".join(parts)
         
         # Store AI response
         store_message(chat_session.id, False, response_text, llm_provider.model_name)
+        _remember_response(user_message, response_text, lookup)
+        
+        # Summarize turns that fell out of the prompt once the model is free
+        schedule_summary(chat_session.id, summarize_through)
         
         return response_text, chat_session.id
     
+    except LLMError as e:
+        logger.error(f"LLM failed to answer in chat session {session_id}: {str(e)}")
+        raise
     except Exception as e:
         logger.error(f"Error generating response: {str(e)}", exc_info=True)
-        return f"Sorry, I encountered an error: {str(e)}", session_id
\ No newline at end of file
+        raise LLMError(f"{ERROR_REPLY_PREFIX}: {str(e)}") from e
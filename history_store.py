@@ -0,0 +1,108 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+from typing import Dict, Optional, Tuple
+
+import pandas as pd
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+class HistoryStore:
+    """Local SQLite store of OHLCV bars keyed by (symbol, interval, timestamp).
+
+    Alongside the bars it records, per series, the earliest time that has
+    been requested from upstream and when the tail was last fetched, so
+    callers only need to download what is missing.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._series_locks: Dict[Tuple[str, str], threading.Lock] = {}
+        self._series_locks_guard = threading.Lock()
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS bars ("
+            "symbol TEXT NOT NULL, interval TEXT NOT NULL, ts INTEGER NOT NULL, "
+            "open REAL, high REAL, low REAL, close REAL, volume REAL, "
+            "PRIMARY KEY (symbol, interval, ts)) WITHOUT ROWID"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS series ("
+            "symbol TEXT NOT NULL, interval TEXT NOT NULL, "
+            "covered_from INTEGER NOT NULL, fetched_at REAL NOT NULL, "
+            "PRIMARY KEY (symbol, interval))"
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        # sqlite3 connections must not be shared between threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def lock(self, symbol: str, interval: str) -> threading.Lock:
+        """Lock serializing upstream fetches for one series within this process"""
+        with self._series_locks_guard:
+            return self._series_locks.setdefault((symbol, interval), threading.Lock())
+
+    def coverage(self, symbol: str, interval: str) -> Optional[Tuple[int, float, Optional[int]]]:
+        """Return (covered_from, fetched_at, last_ts) for a series, or None if never fetched"""
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT covered_from, fetched_at FROM series WHERE symbol = ? AND interval = ?",
+            (symbol, interval),
+        ).fetchone()
+        if row is None:
+            return None
+        last_ts = conn.execute(
+            "SELECT MAX(ts) FROM bars WHERE symbol = ? AND interval = ?", (symbol, interval)
+        ).fetchone()[0]
+        return row[0], row[1], last_ts
+
+    def append(self, symbol: str, interval: str, bars: pd.DataFrame, covered_from: int) -> None:
+        """Upsert bars (indexed by epoch seconds) and extend the series coverage"""
+        rows = zip(
+            [symbol] * len(bars), [interval] * len(bars), bars.index.tolist(),
+            bars["Open"].tolist(), bars["High"].tolist(), bars["Low"].tolist(),
+            bars["Close"].tolist(), bars["Volume"].tolist(),
+        )
+        conn = self._connect()
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO bars (symbol, interval, ts, open, high, low, close, volume) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            conn.execute(
+                "INSERT INTO series (symbol, interval, covered_from, fetched_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (symbol, interval) DO UPDATE SET "
+                "covered_from = MIN(covered_from, excluded.covered_from), fetched_at = excluded.fetched_at",
+                (symbol, interval, covered_from, time.time()),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def load(self, symbol: str, interval: str, start: int = 0) -> pd.DataFrame:
+        """Return bars at or after start as a DataFrame indexed by epoch seconds"""
+        return pd.read_sql_query(
+            "SELECT ts, open AS Open, high AS High, low AS Low, close AS Close, volume AS Volume "
+            "FROM bars WHERE symbol = ? AND interval = ? AND ts >= ? ORDER BY ts",
+            self._connect(),
+            params=(symbol, interval, start),
+            index_col="ts",
+        )
+
+
+history_store = HistoryStore(os.environ.get("HISTORY_DB_PATH", "/tmp/stocksphere_history.sqlite3"))
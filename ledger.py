@@ -0,0 +1,103 @@
+# Atomic updates to users' funds and positions. Each function is a single
+# conditional UPDATE or upsert, so a balance or quantity is never read and
+# then written back by Python where another request could interleave. They
+# run in the caller's transaction without committing, so an order and its
+# effects are committed together.
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import case, func, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app import db
+from models import Portfolio, User
+
+_UNSYNCHRONIZED = {"synchronize_session": False}
+
+# Shares held that no pending SELL order has claimed
+_reserved = func.coalesce(Portfolio.reserved_quantity, 0)
+_unreserved = Portfolio.quantity - _reserved
+
+
+def _released(quantity: int):
+    # Claims never go below zero, e.g. for orders placed before shares were claimed
+    return case((_reserved > quantity, _reserved - quantity), else_=0)
+
+
+def debit_funds(user_id: int, amount: float) -> Optional[float]:
+    """Take amount from a user's funds if they cover it; returns the new balance, or None if not"""
+    return db.session.execute(
+        update(User).where(User.id == user_id, User.funds >= amount)
+        .values(funds=User.funds - amount).returning(User.funds),
+        execution_options=_UNSYNCHRONIZED
+    ).scalar()
+
+
+def credit_funds(user_id: int, amount: float) -> None:
+    db.session.execute(update(User).where(User.id == user_id).values(funds=User.funds + amount),
+                       execution_options=_UNSYNCHRONIZED)
+
+
+def add_position(user_id: int, symbol: str, quantity: int, price: float) -> None:
+    """Add bought shares to a position, creating it if needed and averaging the price"""
+    insert = postgresql.insert if db.engine.dialect.name == "postgresql" else sqlite.insert
+    statement = insert(Portfolio).values(user_id=user_id, symbol=symbol, quantity=quantity,
+                                         average_price=price, reserved_quantity=0,
+                                         last_updated=datetime.utcnow())
+    new = statement.excluded
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=[Portfolio.user_id, Portfolio.symbol],
+        set_={
+            "average_price": (Portfolio.average_price * Portfolio.quantity + new.average_price * new.quantity)
+                             / (Portfolio.quantity + new.quantity),
+            "quantity": Portfolio.quantity + new.quantity,
+            "last_updated": new.last_updated,
+        }
+    ))
+
+
+def remove_position(user_id: int, symbol: str, quantity: int, reserved: bool = False) -> bool:
+    """Take sold shares out of a position; returns False if the user doesn't hold them.
+
+    reserved says the shares were claimed by a pending SELL order, which
+    releases its claim; otherwise only unclaimed shares can be sold.
+    Positions sold down to zero are deleted.
+    """
+    if reserved:
+        condition = Portfolio.quantity >= quantity
+        values = {"reserved_quantity": _released(quantity)}
+    else:
+        condition = _unreserved >= quantity
+        values = {}
+    remaining = db.session.execute(
+        update(Portfolio).where(Portfolio.user_id == user_id, Portfolio.symbol == symbol, condition)
+        .values(quantity=Portfolio.quantity - quantity, last_updated=datetime.utcnow(), **values)
+        .returning(Portfolio.quantity),
+        execution_options=_UNSYNCHRONIZED
+    ).scalar()
+    if remaining is None:
+        return False
+    if remaining == 0:
+        db.session.execute(
+            Portfolio.__table__.delete().where(Portfolio.user_id == user_id, Portfolio.symbol == symbol,
+                                               Portfolio.quantity == 0))
+    return True
+
+
+def reserve_shares(user_id: int, symbol: str, quantity: int) -> bool:
+    """Claim unclaimed shares for a pending SELL order; returns False if there aren't enough"""
+    return db.session.execute(
+        update(Portfolio).where(Portfolio.user_id == user_id, Portfolio.symbol == symbol, _unreserved >= quantity)
+        .values(reserved_quantity=_reserved + quantity)
+        .returning(Portfolio.id),
+        execution_options=_UNSYNCHRONIZED
+    ).scalar() is not None
+
+
+def release_shares(user_id: int, symbol: str, quantity: int) -> None:
+    """Return shares claimed by a SELL order that was cancelled"""
+    db.session.execute(
+        update(Portfolio).where(Portfolio.user_id == user_id, Portfolio.symbol == symbol)
+        .values(reserved_quantity=_released(quantity)),
+        execution_options=_UNSYNCHRONIZED
+    )
@@ -0,0 +1,585 @@
+import os
+import json
+import time
+import queue
+import random
+import hashlib
+import logging
+import threading
+from collections import deque
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import List, Dict, Any, Iterator, Optional, Tuple
+
+# Set up logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Replies that report a failure instead of model output start with this
+ERROR_REPLY_PREFIX = "Sorry, I encountered an error"
+
+
+class LLMError(Exception):
+    """Raised by stream_completion when a completion fails, possibly after some text was yielded.
+    
+    The message is a reply for the user, starting with ERROR_REPLY_PREFIX.
+    """
+
+# Default model configuration
+DEFAULT_CONFIG = {
+    "temperature": 0.2,
+    "top_p": 0.95,
+    "max_tokens": 1024,
+}
+
+class LLMProvider:
+    """Base class for LLM providers"""
+    
+    def __init__(self, model_name: str = "default", **kwargs):
+        self.model_name = model_name
+        self.config = DEFAULT_CONFIG.copy()
+        self.config.update(kwargs)
+    
+    def generate_embedding(self, text: str) -> List[float]:
+        """Generate embeddings for the given text"""
+        # Should be implemented by subclasses
+        raise NotImplementedError
+    
+    def generate_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """Generate embeddings for several texts; an empty list marks a failure"""
+        return [self.generate_embedding(text) for text in texts]
+    
+    def generate_completion(self, messages: List[Dict[str, str]]) -> str:
+        """Generate a completion for the given messages"""
+        # Should be implemented by subclasses
+        raise NotImplementedError
+    
+    def stream_completion(self, messages: List[Dict[str, str]]) -> Iterator[str]:
+        """Generate a completion for the given messages, yielding text as it is produced.
+        
+        Raises LLMError if the completion fails.
+        """
+        # Providers without streaming support yield the whole completion at once
+        completion = self.generate_completion(messages)
+        if completion.startswith(ERROR_REPLY_PREFIX):
+            raise LLMError(completion)
+        yield completion
+
+
+# Ollama connection settings
+OLLAMA_BASE_URL = os.environ.get("OLLAMA_BASE_URL", "http://localhost:11434")
+OLLAMA_MODEL = os.environ.get("OLLAMA_MODEL", "llama3.2:latest")
+OLLAMA_CONNECT_TIMEOUT = 3.05  # seconds
+OLLAMA_READ_TIMEOUT = 120  # seconds; generation on CPU can be slow
+OLLAMA_KEEP_ALIVE = "30m"  # How long Ollama keeps the model loaded after a request
+HEALTH_CHECK_TTL = 60  # Seconds to reuse the result of a health check
+
+
+def _make_session(pool_size: int = 10) -> requests.Session:
+    """Build a keep-alive session that retries connection errors and gateway failures.
+
+    Read errors are never retried: a generation that timed out may still be
+    running on the server, and retrying it would run it again and multiply
+    the wait by the number of attempts.
+    """
+    retry = Retry(
+        total=2,
+        connect=2,
+        read=0,
+        other=0,
+        backoff_factor=0.3,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(["GET", "POST"]),
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class OllamaProvider(LLMProvider):
+    """Provider for Ollama API"""
+    
+    def __init__(self, model_name: str = OLLAMA_MODEL, base_url: str = OLLAMA_BASE_URL, **kwargs):
+        super().__init__(model_name, **kwargs)
+        self.base_url = base_url
+        self.timeout = (OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT)
+        # Connections are pooled and reused across requests
+        self.session = _make_session()
+        self._health = None  # (healthy, checked_at)
+        self._health_lock = threading.Lock()
+    
+    def health_check(self, force: bool = False) -> bool:
+        """Check the Ollama API is reachable, reusing the last result for HEALTH_CHECK_TTL seconds"""
+        with self._health_lock:
+            if not force and self._health and time.time() - self._health[1] < HEALTH_CHECK_TTL:
+                return self._health[0]
+            healthy = False
+            try:
+                response = self.session.get(f"{self.base_url}/api/version", timeout=OLLAMA_CONNECT_TIMEOUT)
+                if response.status_code == 200:
+                    logger.info(f"Connected to Ollama API: {response.json()}")
+                    healthy = True
+                else:
+                    logger.warning(f"Could not connect to Ollama API: {response.status_code}")
+            except Exception as e:
+                logger.error(f"Error connecting to Ollama API: {str(e)}")
+            self._health = (healthy, time.time())
+            return healthy
+    
+    def warm_up(self) -> bool:
+        """Ask Ollama to load the model into memory so the first chat turn doesn't pay for it"""
+        if not self.health_check():
+            return False
+        try:
+            # A chat request without messages only loads the model
+            response = self.session.post(
+                f"{self.base_url}/api/chat",
+                json={"model": self.model_name, "messages": [], "keep_alive": OLLAMA_KEEP_ALIVE},
+                timeout=self.timeout
+            )
+            if response.status_code == 200:
+                logger.info(f"Preloaded Ollama model {self.model_name}")
+                return True
+            logger.warning(f"Could not preload Ollama model {self.model_name}: {response.status_code}")
+        except Exception as e:
+            logger.error(f"Error preloading Ollama model {self.model_name}: {str(e)}")
+        return False
+    
+    def generate_embedding(self, text: str) -> List[float]:
+        """Generate embeddings using Ollama"""
+        try:
+            response = self.session.post(
+                f"{self.base_url}/api/embeddings",
+                json={"model": self.model_name, "prompt": text},
+                timeout=self.timeout
+            )
+            if response.status_code == 200:
+                return response.json().get("embedding", [])
+            else:
+                logger.error(f"Embedding error: {response.status_code} - {response.text}")
+                return []
+        except Exception as e:
+            logger.error(f"Error generating embedding with Ollama: {str(e)}")
+            return []
+    
+    def generate_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """Generate embeddings for several texts in one request to /api/embed"""
+        try:
+            response = self.session.post(
+                f"{self.base_url}/api/embed",
+                json={"model": self.model_name, "input": texts, "keep_alive": OLLAMA_KEEP_ALIVE},
+                timeout=self.timeout
+            )
+            if response.status_code == 404:
+                # Ollama releases before /api/embed only embed one text per request
+                return super().generate_embeddings(texts)
+            if response.status_code == 200:
+                embeddings = response.json().get("embeddings", [])
+                if len(embeddings) == len(texts):
+                    return embeddings
+            logger.error(f"Batch embedding error: {response.status_code} - {response.text[:200]}")
+        except Exception as e:
+            logger.error(f"Error generating batch embeddings with Ollama: {str(e)}")
+        return [[] for _ in texts]
+    
+    def _chat_request(self, messages: List[Dict[str, str]], stream: bool) -> Dict[str, Any]:
+        # Messages are sent as-is so the server applies the model's chat template and
+        # can reuse its KV cache for the prefix shared with the previous turn
+        return {
+            "model": self.model_name,
+            "messages": [{"role": m["role"], "content": m["content"]} for m in messages],
+            "options": {
+                "temperature": self.config.get("temperature", 0.2),
+                "top_p": self.config.get("top_p", 0.95),
+                "num_predict": self.config.get("max_tokens", 1024),
+            },
+            "keep_alive": OLLAMA_KEEP_ALIVE,
+            "stream": stream
+        }
+    
+    def _log_prefill(self, result: Dict[str, Any]) -> None:
+        # Only tokens missing from the server's prompt cache are evaluated
+        if "prompt_eval_count" in result:
+            logger.debug(
+                f"Ollama prefill: {result['prompt_eval_count']} tokens in "
+                f"{result.get('prompt_eval_duration', 0) / 1e6:.0f}ms"
+            )
+    
+    def generate_completion(self, messages: List[Dict[str, str]]) -> str:
+        """Generate a completion using Ollama"""
+        try:
+            response = self.session.post(
+                f"{self.base_url}/api/chat",
+                json=self._chat_request(messages, stream=False),
+                timeout=self.timeout
+            )
+            
+            if response.status_code == 200:
+                result = response.json()
+                self._log_prefill(result)
+                return result.get("message", {}).get("content", "")
+            else:
+                logger.error(f"Completion error: {response.status_code} - {response.text}")
+                return f"{ERROR_REPLY_PREFIX} generating a response."
+        except Exception as e:
+            logger.error(f"Error generating completion with Ollama: {str(e)}")
+            return f"{ERROR_REPLY_PREFIX}: {str(e)}"
+    
+    def stream_completion(self, messages: List[Dict[str, str]]) -> Iterator[str]:
+        """Stream a completion from Ollama, yielding tokens as they arrive"""
+        try:
+            with self.session.post(
+                f"{self.base_url}/api/chat",
+                json=self._chat_request(messages, stream=True),
+                timeout=self.timeout,
+                stream=True
+            ) as response:
+                if response.status_code != 200:
+                    logger.error(f"Completion error: {response.status_code} - {response.text}")
+                    raise LLMError(f"{ERROR_REPLY_PREFIX} generating a response.")
+                
+                # Ollama streams one JSON object per line
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    chunk = json.loads(line)
+                    content = chunk.get("message", {}).get("content")
+                    if content:
+                        yield content
+                    if chunk.get("done"):
+                        self._log_prefill(chunk)
+                        break
+        except LLMError:
+            raise
+        except Exception as e:
+            logger.error(f"Error streaming completion with Ollama: {str(e)}")
+            raise LLMError(f"{ERROR_REPLY_PREFIX}: {str(e)}") from e
+
+
+class FakeProvider(LLMProvider):
+    """Local stand-in for a model server, for tests and benchmarks.
+    
+    Replies with a fixed text one word at a time after a simulated delay
+    to the first token, and embeds text as a deterministic hash vector.
+    failure_rate is the chance a request fails like a server error.
+    """
+    
+    def __init__(self, model_name: str = "fake", reply: str = "This is a reply from the fake model.",
+                 first_token_delay: float = 0.0, token_delay: float = 0.0, failure_rate: float = 0.0,
+                 dim: int = 16, seed: Optional[int] = None, **kwargs):
+        super().__init__(model_name, **kwargs)
+        self.reply = reply
+        self.first_token_delay = first_token_delay
+        self.token_delay = token_delay
+        self.failure_rate = failure_rate
+        self.dim = dim
+        self._random = random.Random(seed)
+    
+    def generate_embedding(self, text: str) -> List[float]:
+        digest = hashlib.sha256(text.encode()).digest()
+        return [byte / 255 - 0.5 for byte in (digest * (self.dim // len(digest) + 1))[:self.dim]]
+    
+    def generate_completion(self, messages: List[Dict[str, str]]) -> str:
+        try:
+            return "".join(self.stream_completion(messages))
+        except LLMError as e:
+            return str(e)
+    
+    def stream_completion(self, messages: List[Dict[str, str]]) -> Iterator[str]:
+        time.sleep(self.first_token_delay)
+        if self._random.random() < self.failure_rate:
+            raise LLMError(f"{ERROR_REPLY_PREFIX} generating a response.")
+        for i, word in enumerate(self.reply.split(" ")):
+            if i:
+                time.sleep(self.token_delay)
+            yield word if not i else " " + word
+
+
+# Router settings
+ROUTER_LATENCY_WINDOW = 50  # Recent requests per backend that latency percentiles are taken over
+ROUTER_HEDGE_MIN_DELAY = 0.5  # Seconds; never hedge sooner than this
+ROUTER_HEDGE_DEFAULT_DELAY = 5.0  # Seconds to wait before hedging a backend with no latency samples
+ROUTER_DEFAULT_LATENCY = ROUTER_HEDGE_DEFAULT_DELAY  # Seconds to first token assumed when ranking an unmeasured backend
+ROUTER_MAX_HEDGES = 1  # Extra backends raced against a slow one, on top of failover
+ROUTER_FAILURE_COOLDOWN = 30  # Seconds a backend is ranked last after a failure
+ROUTER_FIRST_TOKEN_TIMEOUT = OLLAMA_READ_TIMEOUT  # Seconds to wait for any backend to start answering
+
+_TOKEN, _DONE, _FAILED = "token", "done", "failed"
+
+
+class _BackendState:
+    """Rolling latency and load of one router backend; guarded by the router's lock"""
+    
+    def __init__(self, provider: LLMProvider, window: int = ROUTER_LATENCY_WINDOW):
+        self.provider = provider
+        self.latencies = deque(maxlen=window)  # Seconds to the first token of recent completions
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.hedges = 0
+        self.failed_at = 0.0
+    
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+    
+    def rank(self, now: float) -> Tuple[bool, float]:
+        # Backends that failed recently go last; otherwise the typical latency scaled
+        # by the requests already waiting on the backend, assuming ROUTER_DEFAULT_LATENCY
+        # until it has been measured so load spreads off an unmeasured backend too.
+        p50 = self.percentile(0.5)
+        latency = ROUTER_DEFAULT_LATENCY if p50 is None else p50
+        return now - self.failed_at < ROUTER_FAILURE_COOLDOWN, latency * (1 + self.in_flight)
+    
+    def hedge_delay(self) -> float:
+        p95 = self.percentile(0.95)
+        return ROUTER_HEDGE_DEFAULT_DELAY if p95 is None else max(p95, ROUTER_HEDGE_MIN_DELAY)
+
+
+class RouterProvider(LLMProvider):
+    """Spreads requests over several backends, such as multiple Ollama servers.
+    
+    Completions go to the backend with the lowest rolling median time to
+    first token, weighted by its in-flight requests. If it hasn't started
+    answering by its p95, the next backend is raced against it and the
+    first to produce text wins; the other is abandoned. A backend that
+    errors or returns an error reply before any text is replaced by the
+    next one and ranked last for a while.
+    
+    Embeddings only fail over between backends serving the same model as
+    the first backend, since vectors from different models don't compare.
+    """
+    
+    def __init__(self, backends: List[LLMProvider], **kwargs):
+        if not backends:
+            raise ValueError("RouterProvider needs at least one backend")
+        super().__init__(backends[0].model_name, **kwargs)
+        self.backends = [_BackendState(backend) for backend in backends]
+        self._lock = threading.Lock()
+    
+    def _ranked(self, states: Optional[List[_BackendState]] = None) -> List[_BackendState]:
+        now = time.time()
+        with self._lock:
+            return sorted(states or self.backends, key=lambda state: state.rank(now))
+    
+    def _record(self, state: _BackendState, latency: Optional[float] = None, failed: bool = False) -> None:
+        with self._lock:
+            if failed:
+                state.failures += 1
+                state.failed_at = time.time()
+            elif latency is not None:
+                state.latencies.append(latency)
+                state.failed_at = 0.0
+    
+    def _embedding_backends(self) -> List[_BackendState]:
+        return self._ranked([state for state in self.backends if state.provider.model_name == self.model_name])
+    
+    def generate_embedding(self, text: str) -> List[float]:
+        for state in self._embedding_backends():
+            embedding = state.provider.generate_embedding(text)
+            if len(embedding):
+                return embedding
+            self._record(state, failed=True)
+        return []
+    
+    def generate_embeddings(self, texts: List[str]) -> List[List[float]]:
+        embeddings = [[] for _ in texts]
+        for state in self._embedding_backends():
+            missing = [i for i, embedding in enumerate(embeddings) if not len(embedding)]
+            if not missing:
+                break
+            for i, embedding in zip(missing, state.provider.generate_embeddings([texts[i] for i in missing])):
+                embeddings[i] = embedding
+            if any(not len(embeddings[i]) for i in missing):
+                self._record(state, failed=True)
+        return embeddings
+    
+    def generate_completion(self, messages: List[Dict[str, str]]) -> str:
+        try:
+            return "".join(self.stream_completion(messages))
+        except LLMError as e:
+            return str(e)
+    
+    def _pump(self, state: _BackendState, messages: List[Dict[str, str]], events: queue.Queue,
+              race: Dict[str, Any]) -> None:
+        """Stream one backend's completion into events until it finishes or loses the race"""
+        start = time.perf_counter()
+        stream = state.provider.stream_completion(messages)
+        first = True
+        try:
+            for token in stream:
+                if first:
+                    first = False
+                    self._record(state, latency=time.perf_counter() - start)
+                if race["closed"] or race["winner"] not in (None, state):
+                    return
+                events.put((state, _TOKEN, token))
+            events.put((state, _DONE, None))
+        except Exception as e:
+            logger.error(f"Error streaming completion from {state.provider.model_name}: {str(e)}")
+            if first:
+                self._record(state, failed=True)
+            events.put((state, _FAILED, str(e) if isinstance(e, LLMError) else f"{ERROR_REPLY_PREFIX}: {str(e)}"))
+        finally:
+            stream.close()
+            with self._lock:
+                state.in_flight -= 1
+    
+    def _start(self, state: _BackendState, messages: List[Dict[str, str]], events: queue.Queue,
+               race: Dict[str, Any]) -> None:
+        with self._lock:
+            state.in_flight += 1
+            state.requests += 1
+        threading.Thread(target=self._pump, args=(state, messages, events, race),
+                         name="llm-router", daemon=True).start()
+    
+    def stream_completion(self, messages: List[Dict[str, str]]) -> Iterator[str]:
+        """Stream a completion from whichever backend starts answering first"""
+        waiting = self._ranked()
+        events = queue.Queue()
+        race = {"winner": None, "closed": False}
+        running, hedges = 0, 0
+        error = f"{ERROR_REPLY_PREFIX} generating a response."
+        give_up_at = time.monotonic() + ROUTER_FIRST_TOKEN_TIMEOUT
+        
+        primary = waiting.pop(0)
+        self._start(primary, messages, events, race)
+        running += 1
+        hedge_at = time.monotonic() + primary.hedge_delay()
+        try:
+            while race["winner"] is None:
+                can_hedge = waiting and hedges < ROUTER_MAX_HEDGES
+                deadline = min(hedge_at, give_up_at) if can_hedge else give_up_at
+                try:
+                    state, kind, value = events.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    if time.monotonic() >= give_up_at:
+                        logger.error("No LLM backend answered in time")
+                        raise LLMError(error)
+                    # The leading backend is slower than usual; race the next one against it
+                    backup = waiting.pop(0)
+                    logger.debug(f"Hedging a slow completion with {backup.provider.model_name}")
+                    with self._lock:
+                        backup.hedges += 1
+                    self._start(backup, messages, events, race)
+                    running += 1
+                    hedges += 1
+                    hedge_at = time.monotonic() + backup.hedge_delay()
+                    continue
+                
+                if kind == _FAILED:
+                    running -= 1
+                    error = value
+                    if waiting:
+                        # Fail over immediately rather than waiting for a hedge, and hedge the
+                        # failover backend in turn if it is slow to start
+                        failover = waiting.pop(0)
+                        self._start(failover, messages, events, race)
+                        running += 1
+                        hedge_at = time.monotonic() + failover.hedge_delay()
+                    elif not running:
+                        raise LLMError(error)
+                    continue
+                
+                race["winner"] = state
+                if kind == _DONE:
+                    return
+                yield value
+            
+            while True:
+                state, kind, value = events.get()
+                if state is not race["winner"]:
+                    continue
+                if kind == _DONE:
+                    return
+                # A failure after text has been sent can't be retried elsewhere
+                if kind == _FAILED:
+                    raise LLMError(value)
+                yield value
+        finally:
+            race["closed"] = True
+    
+    def warm_up(self) -> bool:
+        """Warm up every backend that supports it"""
+        results = [state.provider.warm_up() for state in self.backends if hasattr(state.provider, "warm_up")]
+        return any(results) if results else True
+    
+    def stats(self) -> List[Dict[str, Any]]:
+        """Latency and load per backend"""
+        with self._lock:
+            return [
+                {
+                    "model": state.provider.model_name,
+                    "base_url": getattr(state.provider, "base_url", None),
+                    "p50_ms": round(state.percentile(0.5) * 1000, 1) if state.latencies else None,
+                    "p95_ms": round(state.percentile(0.95) * 1000, 1) if state.latencies else None,
+                    "in_flight": state.in_flight,
+                    "requests": state.requests,
+                    "failures": state.failures,
+                    "hedges": state.hedges,
+                }
+                for state in self.backends
+            ]
+
+
+# You can add other providers here in the future
+# class OpenAIProvider(LLMProvider):
+#     def __init__(self, api_key, model_name="gpt-4o", **kwargs):
+#         super().__init__(model_name, **kwargs)
+#         # Implementation for OpenAI
+
+
+# Backends the default provider routes between, comma-separated as provider or provider=base_url,
+# e.g. "ollama=http://gpu1:11434,ollama=http://gpu2:11434". Empty uses the single Ollama server.
+LLM_BACKENDS = os.environ.get("LLM_BACKENDS", "")
+DEFAULT_PROVIDER = "router" if LLM_BACKENDS else "ollama"
+
+# Providers are created once per configuration and shared process-wide
+_providers: Dict[Tuple[str, Tuple], LLMProvider] = {}
+_providers_lock = threading.Lock()
+
+
+def _parse_backends(spec: str) -> List[LLMProvider]:
+    backends = []
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, base_url = entry.partition("=")
+        backends.append(_create_llm_provider(name.lower(), **({"base_url": base_url} if base_url else {})))
+    return backends
+
+
+def _create_llm_provider(provider_name: str, **kwargs) -> LLMProvider:
+    if provider_name == "ollama":
+        return OllamaProvider(**kwargs)
+    elif provider_name == "router":
+        backends = kwargs.pop("backends", None) or _parse_backends(LLM_BACKENDS) or [OllamaProvider()]
+        return RouterProvider(backends, **kwargs)
+    elif provider_name == "fake":
+        return FakeProvider(**kwargs)
+    # elif provider_name == "openai":
+    #     return OpenAIProvider(**kwargs)
+    else:
+        logger.warning(f"Unknown provider {provider_name}, using Ollama as fallback")
+        return OllamaProvider(**kwargs)
+
+
+# Factory function to get the right provider
+def get_llm_provider(provider_name: str = DEFAULT_PROVIDER, **kwargs) -> LLMProvider:
+    """Get the shared LLM provider for this configuration, creating it on first use"""
+    key = (provider_name.lower(), tuple(sorted(kwargs.items())))
+    with _providers_lock:
+        provider = _providers.get(key)
+        if provider is None:
+            provider = _providers[key] = _create_llm_provider(key[0], **kwargs)
+        return provider
+
+
+def warm_up_llm_provider() -> None:
+    """Preload the default provider's model in a background thread"""
+    provider = get_llm_provider()
+    if hasattr(provider, "warm_up"):
+        threading.Thread(target=provider.warm_up, name="llm-warm-up", daemon=True).start()
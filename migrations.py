@@ -0,0 +1,126 @@
+import logging
+from typing import Callable, Dict, List, Tuple, Union
+
+import sqlalchemy
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.engine import Connection, Engine
+
+# Set up logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+class MigrationError(Exception):
+    """Raised when the schema can't be brought up to date automatically"""
+
+
+def missing_schema(bind: Union[Engine, Connection],
+                   metadata: sqlalchemy.MetaData) -> Tuple[List[sqlalchemy.Column], List[sqlalchemy.Index]]:
+    """Columns and indexes of existing tables that the database doesn't have yet.
+
+    create_all() only creates missing tables, so these are what models
+    gained since their tables were created. Tables that don't exist at all
+    aren't reported; create_all() or upgrade() creates them whole.
+    """
+    inspector = sqlalchemy.inspect(bind)
+    tables = set(inspector.get_table_names())
+    columns, indexes = [], []
+    for table in metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        columns += [column for column in table.columns if column.name not in existing]
+        existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        indexes += [index for index in table.indexes if index.name not in existing_indexes]
+    return columns, indexes
+
+
+def _default_clause(column: sqlalchemy.Column, dialect: sqlalchemy.engine.Dialect) -> str:
+    """DEFAULT for a server default or a scalar Python default, rendered for dialect, so
+    existing rows get the value too; callables such as datetime.utcnow have no equivalent"""
+    if isinstance(column.server_default, sqlalchemy.DefaultClause):
+        value = column.server_default.arg
+        if isinstance(value, str):
+            value = sqlalchemy.literal(value)
+    elif column.default is not None and column.default.is_scalar:
+        value = sqlalchemy.literal(column.default.arg, column.type)
+    else:
+        return ""
+    return f" DEFAULT {value.compile(dialect=dialect, compile_kwargs={'literal_binds': True})}"
+
+
+def _add_column(conn: Connection, column: sqlalchemy.Column) -> None:
+    dialect = conn.dialect
+    quote = dialect.identifier_preparer.quote  # "order" is a reserved word
+    default = _default_clause(column, dialect)
+    if not column.nullable and not default:
+        raise MigrationError(f"Can't add NOT NULL column {column.table.name}.{column.name} without a default")
+    conn.execute(sqlalchemy.text(
+        f"ALTER TABLE {quote(column.table.name)} ADD COLUMN {quote(column.name)} "
+        f"{column.type.compile(dialect=dialect)}{default}{'' if column.nullable else ' NOT NULL'}"
+    ))
+
+
+def _merge_duplicate_positions(conn: Connection, portfolio: sqlalchemy.Table) -> List[str]:
+    """Fold each user's duplicate rows for a symbol into the oldest, so (user_id, symbol) can be unique.
+
+    Quantities and reserved quantities are summed and the average price
+    is weighted by quantity.
+    """
+    c = portfolio.c
+    duplicates = conn.execute(
+        select(c.user_id, c.symbol).group_by(c.user_id, c.symbol).having(func.count() > 1)
+    ).all()
+    changes = []
+    for user_id, symbol in duplicates:
+        rows = conn.execute(
+            select(c.id, c.quantity, c.average_price, c.reserved_quantity, c.last_updated)
+            .where(c.user_id == user_id, c.symbol == symbol).order_by(c.id)
+        ).all()
+        quantity = sum(row.quantity for row in rows)
+        cost = sum(row.quantity * row.average_price for row in rows)
+        updated = [row.last_updated for row in rows if row.last_updated is not None]
+        conn.execute(update(portfolio).where(c.id == rows[0].id).values(
+            quantity=quantity,
+            average_price=cost / quantity if quantity else rows[0].average_price,
+            reserved_quantity=sum(row.reserved_quantity or 0 for row in rows),
+            last_updated=max(updated) if updated else None,
+        ))
+        conn.execute(delete(portfolio).where(c.id.in_([row.id for row in rows[1:]])))
+        changes.append(f"Merged {len(rows)} {portfolio.name} rows for user {user_id}, {symbol}")
+    return changes
+
+
+# Run before creating an index, with the index's table, to make existing rows satisfy it
+INDEX_PREPARATIONS: Dict[str, Callable[[Connection, sqlalchemy.Table], List[str]]] = {
+    "ix_portfolio_user_symbol": _merge_duplicate_positions,
+}
+
+
+def upgrade(engine: Engine, metadata: sqlalchemy.MetaData) -> List[str]:
+    """Bring the database up to date with metadata in one transaction; returns what was changed.
+
+    Creates missing tables, then adds missing columns and indexes. Rows
+    that would violate a new index are fixed first where INDEX_PREPARATIONS
+    says how, e.g. duplicate positions are merged before the unique
+    ix_portfolio_user_symbol is built. Run it once per deploy
+    (flask --app main migrate-db) rather than from every worker at startup.
+    Errors propagate, leaving the schema unchanged where the database
+    supports transactional DDL.
+    """
+    changes = []
+    with engine.begin() as conn:
+        metadata.create_all(conn)
+        columns, indexes = missing_schema(conn, metadata)
+        for column in columns:
+            _add_column(conn, column)
+            changes.append(f"Added column {column.table.name}.{column.name}")
+        for index in indexes:
+            prepare = INDEX_PREPARATIONS.get(index.name)
+            if prepare is not None:
+                changes += prepare(conn, index.table)
+            index.create(conn)
+            changes.append(f"Created index {index.name}")
+    for change in changes:
+        logger.info(change)
+    return changes
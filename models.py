@@ -4,6 +4,7 @@ from app import db
 from flask_login import UserMixin  # noqa
 from werkzeug.security import generate_password_hash, check_password_hash
 import json
+import numpy as np
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -55,6 +56,11 @@ class Portfolio(db.Model):
     quantity = db.Column(db.Integer, nullable=False)
     average_price = db.Column(db.Float, nullable=False)
     last_updated = db.Column(db.DateTime, default=datetime.utcnow)
+    # Shares claimed by pending SELL orders
+    reserved_quantity = db.Column(db.Integer, nullable=True, default=0)
+    
+    # One position per user and symbol, so buys can upsert it
+    __table_args__ = (db.Index('ix_portfolio_user_symbol', 'user_id', 'symbol', unique=True),)
     
     def __repr__(self):
         return f'<Portfolio {self.symbol} - {self.quantity}>'
@@ -69,6 +75,12 @@ class Order(db.Model):
     price = db.Column(db.Float, nullable=False)
     status = db.Column(db.String(15), nullable=False, default='COMPLETED')  # PENDING, COMPLETED, CANCELLED
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    kind = db.Column(db.String(10), nullable=True, default='MARKET')  # MARKET, LIMIT or STOP
+    trigger_price = db.Column(db.Float, nullable=True)  # Limit or stop price of a resting order
+    filled_at = db.Column(db.DateTime, nullable=True)
+    
+    # Order history is read newest first per user, a page at a time; id breaks ties between equal timestamps
+    __table_args__ = (db.Index('ix_order_user_created', 'user_id', 'created_at', 'id'),)
     
     def __repr__(self):
         return f'<Order {self.symbol} {self.order_type} {self.quantity}>'
@@ -128,6 +140,30 @@ class ChatMessage(db.Model):
         return f'<ChatMessage {self.id} is_user={self.is_user}>'
 
 
+class ChatJob(db.Model):
+    """A queued chat turn; its response grows as it is generated so any worker can serve it"""
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    session_id = db.Column(db.Integer, db.ForeignKey('chat_session.id'), nullable=False)
+    message = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='queued')  # queued, running, done, failed
+    response = db.Column(db.Text, nullable=False, default='')
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    # Bumped whenever the job makes progress; jobs that stop being bumped are abandoned
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_chat_job_user_status', 'user_id', 'status'),
+        db.Index('ix_chat_job_status_created', 'status', 'created_at'),
+    )
+    
+    def __repr__(self):
+        return f'<ChatJob {self.id} {self.status}>'
+
+
 class StockMetadata(db.Model):
     """Store stock metadata for RAG context"""
     def __init__(self, symbol, name, sector, industry, description):
@@ -142,19 +178,35 @@ class StockMetadata(db.Model):
     sector = db.Column(db.String(100), nullable=True)
     industry = db.Column(db.String(100), nullable=True)
     description = db.Column(db.Text, nullable=True)
-    # Store precomputed embeddings as text (JSON serialized)
+    # Precomputed embedding as raw float32 bytes
+    embedding_vector = db.Column(db.LargeBinary, nullable=True)
+    # Embeddings stored before the binary column existed (JSON serialized)
     embedding = db.Column(db.Text, nullable=True)
     last_updated = db.Column(db.DateTime, default=datetime.utcnow)
     
     def set_embedding(self, embedding_vector):
-        """Store embedding vector as JSON string"""
-        self.embedding = json.dumps(embedding_vector)
+        """Store embedding vector as float32 bytes"""
+        self.embedding_vector = np.asarray(embedding_vector, dtype=np.float32).tobytes()
+        self.embedding = None
     
     def get_embedding(self):
-        """Return embedding vector from JSON string"""
+        """Return embedding vector as a float32 array"""
+        if self.embedding_vector:
+            return np.frombuffer(self.embedding_vector, dtype=np.float32)
         if self.embedding:
-            return json.loads(self.embedding)
+            return np.asarray(json.loads(self.embedding), dtype=np.float32)
         return None
     
+    def embedding_text(self):
+        """Text the embedding is generated from"""
+        parts = [f"{self.name or self.symbol} ({self.symbol})"]
+        if self.sector:
+            parts.append(f"Sector: {self.sector}")
+        if self.industry:
+            parts.append(f"Industry: {self.industry}")
+        if self.description:
+            parts.append(self.description)
+        return ". ".join(parts)
+    
     def __repr__(self):
         return f'<StockMetadata {self.symbol}>'
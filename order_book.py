@@ -0,0 +1,322 @@
+import time
+import heapq
+import queue
+import logging
+import threading
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+# Set up logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+RESTING_KINDS = ('LIMIT', 'STOP')  # Order kinds that wait in the book for their trigger price
+FILL_BATCH_SIZE = 500  # Fills settled per transaction
+FILL_BATCH_WAIT = 0.05  # Seconds to gather more fills before settling a batch
+COMPACT_MIN_GARBAGE = 64  # Cancelled heap entries tolerated per symbol before its heaps are rebuilt
+SYNC_INTERVAL = 5  # Seconds between reloads of pending orders placed or cancelled by other processes
+
+# (order id, symbol, BUY or SELL, LIMIT or STOP, trigger price, quantity)
+RestingOrder = Tuple[int, str, str, str, float, int]
+
+
+def fires_on_fall(order_type: str, kind: str) -> bool:
+    """Whether an order triggers when the price falls to its trigger (buy limits, sell stops)
+    rather than when it rises to it (sell limits, buy stops)"""
+    return (order_type == 'BUY') == (kind == 'LIMIT')
+
+
+class OrderBook:
+    """Resting limit and stop orders per symbol, in heaps keyed by trigger price.
+
+    Orders that fire on a fall are in a max-heap and the rest in a min-heap,
+    so a quote pops exactly the orders it crosses, in O(log n) each, without
+    looking at any other order. Cancelled orders are dropped lazily when
+    they surface. Triggered orders are queued for the settlement thread,
+    which fills them at the quote's price in batched transactions.
+
+    The book runs in one process (see process_lock). Orders placed or
+    cancelled in other processes reach it through sync(), every
+    SYNC_INTERVAL seconds; settlement only fills orders still PENDING in
+    the database, so an order synced back in while settling is harmless.
+    """
+
+    def __init__(self, batch_size: int = FILL_BATCH_SIZE, batch_wait: float = FILL_BATCH_WAIT,
+                 sync_interval: float = SYNC_INTERVAL):
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.sync_interval = sync_interval
+        self._on_fall: Dict[str, list] = {}  # symbol -> heap of (-trigger, order id)
+        self._on_rise: Dict[str, list] = {}  # symbol -> heap of (trigger, order id)
+        self._resting: Dict[int, RestingOrder] = {}
+        self._counts = Counter()  # symbol -> resting orders
+        self._lock = threading.Lock()
+        self._fills: "queue.Queue[Tuple[RestingOrder, float]]" = queue.Queue()
+        self._thread = None
+        self._stats = Counter()
+
+    def __len__(self) -> int:
+        return len(self._resting)
+
+    def __contains__(self, order_id: int) -> bool:
+        return order_id in self._resting
+
+    def add(self, order_id: int, symbol: str, order_type: str, kind: str, trigger_price: float,
+            quantity: int) -> None:
+        """Rest an order until a quote crosses its trigger price"""
+        order = (order_id, symbol, order_type, kind, trigger_price, quantity)
+        with self._lock:
+            if order_id in self._resting:
+                return
+            self._resting[order_id] = order
+            if fires_on_fall(order_type, kind):
+                heapq.heappush(self._on_fall.setdefault(symbol, []), (-trigger_price, order_id))
+            else:
+                heapq.heappush(self._on_rise.setdefault(symbol, []), (trigger_price, order_id))
+            self._counts[symbol] += 1
+            first = self._counts[symbol] == 1
+        if first:
+            self._watch(symbol)
+
+    def cancel(self, order_id: int) -> bool:
+        """Remove an order from the book; returns whether it was resting"""
+        with self._lock:
+            order = self._resting.get(order_id)
+            if order is None:
+                return False
+            symbol = self._forget(order)
+            self._compact(order[1])
+        if symbol:
+            self._unwatch(symbol)
+        return True
+
+    def _forget(self, order: RestingOrder) -> Optional[str]:
+        """Drop a resting order's bookkeeping; returns its symbol if no orders for it remain"""
+        del self._resting[order[0]]
+        symbol = order[1]
+        self._counts[symbol] -= 1
+        if self._counts[symbol]:
+            return None
+        del self._counts[symbol]
+        self._on_fall.pop(symbol, None)
+        self._on_rise.pop(symbol, None)
+        return symbol
+
+    def _compact(self, symbol: str) -> None:
+        # Rebuild a symbol's heaps once cancelled entries outnumber live ones
+        live = self._counts.get(symbol, 0)
+        heaps = [self._on_fall.get(symbol), self._on_rise.get(symbol)]
+        if sum(len(heap) for heap in heaps if heap) - live <= max(live, COMPACT_MIN_GARBAGE):
+            return
+        for heap in heaps:
+            if heap:
+                heap[:] = [entry for entry in heap if entry[1] in self._resting]
+                heapq.heapify(heap)
+
+    def on_quote(self, symbol: str, price: Optional[float]) -> List[RestingOrder]:
+        """Trigger every order the price crosses and queue them for settlement"""
+        if not price or price <= 0:
+            return []
+        triggered = []
+        with self._lock:
+            on_fall = self._on_fall.get(symbol)
+            while on_fall and -on_fall[0][0] >= price:
+                order = self._resting.get(heapq.heappop(on_fall)[1])
+                if order is not None:
+                    triggered.append(order)
+            on_rise = self._on_rise.get(symbol)
+            while on_rise and on_rise[0][0] <= price:
+                order = self._resting.get(heapq.heappop(on_rise)[1])
+                if order is not None:
+                    triggered.append(order)
+            emptied = [self._forget(order) for order in triggered]
+            self._stats["triggered"] += len(triggered)
+
+        for order in triggered:
+            self._fills.put((order, price))
+        for emptied_symbol in filter(None, emptied):
+            self._unwatch(emptied_symbol)
+        return triggered
+
+    def _on_quote_data(self, symbol: str, data: Dict[str, Any]) -> None:
+        self.on_quote(symbol, data.get('price'))
+
+    def check(self, symbol: str) -> List[RestingOrder]:
+        """Trigger orders against the symbol's cached quote, if it is still fresh"""
+        from stock_data import quote_cache
+        entry = quote_cache.peek(symbol)
+        if entry is None or entry[1] < time.time():
+            return []
+        return self.on_quote(symbol, entry[0].get('price'))
+
+    def _watch(self, symbol: str) -> None:
+        # Symbols with resting orders are refreshed by the quote refresher even without traffic
+        from stock_data import quote_refresher
+        quote_refresher.pin(symbol)
+
+    def _unwatch(self, symbol: str) -> None:
+        from stock_data import quote_refresher
+        quote_refresher.unpin(symbol)
+
+    def _pending_rows(self) -> List[RestingOrder]:
+        from models import Order
+        return Order.query.with_entities(
+            Order.id, Order.symbol, Order.order_type, Order.kind, Order.trigger_price, Order.quantity
+        ).filter(Order.status == 'PENDING', Order.kind.in_(RESTING_KINDS)).all()
+
+    def load(self) -> int:
+        """Rest every pending limit and stop order; must be called inside an application context"""
+        rows = self._pending_rows()
+        for row in rows:
+            self.add(*row)
+        logger.info(f"Loaded {len(rows)} resting orders into the order book")
+        return len(rows)
+
+    def sync(self) -> Tuple[int, int]:
+        """Match the book to the pending orders in the database.
+
+        Rests orders it doesn't have and drops ones no longer pending, then
+        checks new orders against cached quotes. Returns (added, dropped).
+        Must be called inside an application context.
+        """
+        # Snapshot first, so orders rested while the query runs aren't taken for stale ones
+        with self._lock:
+            resting = set(self._resting)
+        rows = {row[0]: row for row in self._pending_rows()}
+        added = [rows[order_id] for order_id in rows.keys() - resting]
+        dropped = [order_id for order_id in resting - rows.keys() if self.cancel(order_id)]
+        for row in added:
+            self.add(*row)
+        for symbol in {row[1] for row in added}:
+            self.check(symbol)
+        if added or dropped:
+            logger.debug(f"Order book sync: {len(added)} added, {len(dropped)} dropped")
+        return len(added), len(dropped)
+
+    def _sync_loop(self) -> None:
+        from app import app, db
+        while True:
+            time.sleep(self.sync_interval)
+            try:
+                with app.app_context():
+                    self.sync()
+            except Exception as e:
+                logger.error(f"Order book sync failed: {e}")
+                with app.app_context():
+                    db.session.rollback()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        """Load pending orders, trigger them from fetched quotes and start settling fills"""
+        if self.running:
+            return
+        from app import app
+        from stock_data import add_quote_listener
+        with app.app_context():
+            self.load()
+        add_quote_listener(self._on_quote_data)
+        self._thread = threading.Thread(target=self._run, name='order-settlement', daemon=True)
+        self._thread.start()
+        threading.Thread(target=self._sync_loop, name='order-book-sync', daemon=True).start()
+        for symbol in list(self._counts):
+            self.check(symbol)
+
+    def _next_batch(self) -> List[Tuple[RestingOrder, float]]:
+        batch = [self._fills.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._fills.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        from app import app, db
+        while True:
+            batch = self._next_batch()
+            try:
+                with app.app_context():
+                    filled, cancelled = settle_fills(batch)
+                with self._lock:
+                    self._stats["filled"] += filled
+                    self._stats["cancelled"] += cancelled
+                    self._stats["batches"] += 1
+            except Exception as e:
+                logger.error(f"Settling {len(batch)} fills failed: {e}", exc_info=True)
+                with app.app_context():
+                    db.session.rollback()
+                # Put the orders back so a later quote triggers them again
+                for order, _ in batch:
+                    self.add(*order)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = {name: self._stats[name] for name in ("triggered", "filled", "cancelled", "batches")}
+            stats["resting"] = len(self._resting)
+            stats["symbols"] = len(self._counts)
+        stats["unsettled"] = self._fills.qsize()
+        stats["running"] = self.running
+        return stats
+
+
+def settle_fills(fills: List[Tuple[RestingOrder, float]]) -> Tuple[int, int]:
+    """Fill triggered orders at their trigger quote's price in one transaction.
+
+    BUY orders had their funds reserved at the trigger price when placed;
+    the difference to the fill price is refunded or charged, and the order
+    is cancelled with a full refund if the user can't cover it. SELL orders
+    sell the shares they claimed, and are cancelled if the user no longer
+    holds them. Orders that are no longer pending, e.g. cancelled meanwhile,
+    are skipped. Returns the number of orders filled and cancelled. Must be
+    called inside an application context.
+    """
+    from app import db
+    from models import Order
+    from ledger import debit_funds, credit_funds, add_position, remove_position, release_shares
+
+    price_by_id = {order[0]: price for order, price in fills}
+    orders = Order.query.filter(Order.id.in_(price_by_id), Order.status == 'PENDING') \
+        .order_by(Order.id).with_for_update().all()
+    if not orders:
+        return 0, 0
+
+    filled = cancelled = 0
+    now = datetime.utcnow()
+    for order in orders:
+        price = price_by_id[order.id]
+        proceeds = price * order.quantity
+
+        if order.order_type == 'BUY':
+            reserved = order.trigger_price * order.quantity
+            if proceeds > reserved and debit_funds(order.user_id, proceeds - reserved) is None:
+                credit_funds(order.user_id, reserved)
+                order.status = 'CANCELLED'
+                cancelled += 1
+                continue
+            if proceeds < reserved:
+                credit_funds(order.user_id, reserved - proceeds)
+            add_position(order.user_id, order.symbol, order.quantity, price)
+        else:
+            if not remove_position(order.user_id, order.symbol, order.quantity, reserved=True):
+                release_shares(order.user_id, order.symbol, order.quantity)
+                order.status = 'CANCELLED'
+                cancelled += 1
+                continue
+            credit_funds(order.user_id, proceeds)
+
+        order.status = 'COMPLETED'
+        order.price = price
+        order.filled_at = now
+        filled += 1
+
+    db.session.commit()
+    logger.debug(f"Settled {len(orders)} triggered orders: {filled} filled, {cancelled} cancelled")
+    return filled, cancelled
+
+
+order_book = OrderBook()
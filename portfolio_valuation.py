@@ -0,0 +1,130 @@
+import hashlib
+import logging
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from app import db
+from cache import TTLCache, MemoryBackend
+from models import Portfolio, StockMetadata
+
+# Set up logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+VALUATION_CACHE_TTL = 300  # seconds; entries are also keyed by quote version, so this only bounds memory
+VALUATION_CACHE_SIZE = 1024  # entries
+
+
+class PortfolioValuation:
+    """A user's holdings valued at one quote snapshot.
+
+    positions has one row per holding with columns symbol, company_name,
+    sector, quantity, average_price, current_price, current_value,
+    cost_basis, profit_loss, profit_loss_percentage, weight and priced
+    (False where no quote was available and the average price was used).
+    """
+
+    def __init__(self, positions: pd.DataFrame):
+        self.positions = positions
+        self.total_value = float(positions["current_value"].sum())
+        self.total_investment = float(positions["cost_basis"].sum())
+        self.profit_loss = self.total_value - self.total_investment
+        self.profit_loss_percentage = (
+            self.profit_loss / self.total_investment * 100 if self.total_investment > 0 else 0.0
+        )
+        # Share of the portfolio's value in each sector, largest first
+        self.sector_allocation: Dict[str, float] = (
+            positions.groupby("sector")["weight"].sum().sort_values(ascending=False).to_dict()
+            if len(positions) else {}
+        )
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def records(self) -> List[Dict[str, Any]]:
+        """Positions as dicts of plain Python values, for templates and JSON"""
+        return self.positions.to_dict("records")
+
+
+class PortfolioValuator:
+    """Values portfolios with column operations over all holdings at once.
+
+    Holdings are loaded in one query, their quotes in one batch and their
+    metadata in one query. Results are memoized per user, holdings and
+    quote snapshot, so views rendered between quote refreshes share them.
+    """
+
+    def __init__(self, ttl: float = VALUATION_CACHE_TTL, maxsize: int = VALUATION_CACHE_SIZE):
+        self.cache = TTLCache(ttl, MemoryBackend(maxsize=maxsize))
+
+    def value(self, user_id: int, holdings: Optional[List[Portfolio]] = None) -> PortfolioValuation:
+        """Value a user's portfolio; holdings are the user's Portfolio rows if already loaded"""
+        from stock_data import quote_version
+
+        if holdings is None:
+            rows = db.session.query(Portfolio.symbol, Portfolio.quantity, Portfolio.average_price).filter(
+                Portfolio.user_id == user_id).all()
+        else:
+            rows = [(item.symbol, item.quantity, item.average_price) for item in holdings]
+        rows = sorted(tuple(row) for row in rows)
+        symbols = [symbol for symbol, _, _ in rows]
+
+        version = quote_version(symbols)
+        if None in version:
+            # Some quotes aren't cached yet, so there is no snapshot to key on
+            return self._value(rows)
+        key = (user_id, hashlib.sha1(repr(rows).encode()).hexdigest(), version)
+        return self.cache.get_or_load(key, lambda _: self._value(rows))
+
+    def _value(self, rows: List[tuple]) -> PortfolioValuation:
+        from stock_data import get_stock_data_bulk
+
+        positions = pd.DataFrame(rows, columns=["symbol", "quantity", "average_price"])
+        symbols = positions["symbol"].tolist()
+        quotes = get_stock_data_bulk(symbols) if symbols else {}
+        metadata = {
+            symbol: (name, sector) for symbol, name, sector in db.session.query(
+                StockMetadata.symbol, StockMetadata.name, StockMetadata.sector
+            ).filter(StockMetadata.symbol.in_(symbols)).all()
+        } if symbols else {}
+
+        quote_rows = [quotes.get(symbol) or {} for symbol in symbols]
+        # Failed lookups come back with an error and a price of 0; count them as unpriced
+        prices = np.array([
+            np.nan if quote.get("error") else quote.get("price", np.nan) for quote in quote_rows
+        ], dtype=np.float64)
+        prices[prices <= 0] = np.nan
+        quantity = positions["quantity"].to_numpy(dtype=np.float64)
+        average_price = positions["average_price"].to_numpy(dtype=np.float64)
+
+        priced = np.isfinite(prices)
+        if not priced.all():
+            logger.warning(f"No quote for {', '.join(np.array(symbols)[~priced])}; valuing at average price")
+        current_price = np.where(priced, prices, average_price)
+        current_value = current_price * quantity
+        cost_basis = average_price * quantity
+        profit_loss = current_value - cost_basis
+        total_value = current_value.sum()
+
+        positions["company_name"] = [
+            quote.get("name") or metadata.get(symbol, ("", ""))[0] or "Unknown"
+            for symbol, quote in zip(symbols, quote_rows)
+        ]
+        positions["sector"] = [
+            metadata.get(symbol, ("", ""))[1] or quote.get("sector") or "Unknown"
+            for symbol, quote in zip(symbols, quote_rows)
+        ]
+        positions["current_price"] = current_price
+        positions["current_value"] = current_value
+        positions["cost_basis"] = cost_basis
+        positions["profit_loss"] = profit_loss
+        positions["profit_loss_percentage"] = np.divide(
+            profit_loss * 100, cost_basis, out=np.zeros_like(profit_loss), where=cost_basis > 0)
+        positions["weight"] = current_value / total_value if total_value > 0 else 0.0
+        positions["priced"] = priced
+        return PortfolioValuation(positions)
+
+
+portfolio_valuator = PortfolioValuator()
@@ -0,0 +1,54 @@
+import os
+import fcntl
+import logging
+import threading
+from typing import Callable
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+BACKGROUND_LOCK_PATH = os.environ.get("BACKGROUND_LOCK_PATH", "/tmp/stocksphere_background.lock")
+
+_lock_file = None  # Held open while this process runs background work; closing it releases the lock
+
+
+def is_background_process() -> bool:
+    """Whether this process currently runs the app's background workers"""
+    return _lock_file is not None
+
+
+def _acquired(lock_file, start: Callable[[], None]) -> None:
+    global _lock_file
+    _lock_file = lock_file
+    logger.info(f"Running background workers in process {os.getpid()}")
+    start()
+
+
+def _wait_for_lock(lock_file, start: Callable[[], None]) -> None:
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        _acquired(lock_file, start)
+    except Exception as e:
+        logger.error(f"Taking over background workers failed: {e}", exc_info=True)
+
+
+def run_as_background_process(start: Callable[[], None]) -> None:
+    """Call start in one process per host.
+
+    Under gunicorn every worker imports the app, but refreshers, the order
+    book and the embedding backfill should run once. The first process to
+    take an exclusive lock on BACKGROUND_LOCK_PATH calls start right away
+    and keeps the lock until it exits. Every other process waits for the
+    lock on a daemon thread, so when the holder exits (a recycled worker,
+    or a flask command that imported the app) another one takes over.
+    """
+    lock_file = open(BACKGROUND_LOCK_PATH, "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        logger.info(f"Background workers run in another process holding {BACKGROUND_LOCK_PATH}")
+        threading.Thread(target=_wait_for_lock, args=(lock_file, start),
+                         name="background-lock", daemon=True).start()
+        return
+    _acquired(lock_file, start)
@@ -0,0 +1,91 @@
+import os
+import logging
+from typing import Dict, List, Tuple
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "3000"))  # Tokens the whole prompt may use
+CONTEXT_SHARE = 0.5  # Share of the budget left after the system prompt and question that context is guaranteed
+SUMMARY_MAX_TOKENS = 400  # Cap on the running summary of older turns
+MESSAGE_OVERHEAD = 4  # Tokens a chat template adds around each message
+
+
+def count_tokens(text: str) -> int:
+    """Approximate token count: about four characters per token for English text"""
+    return (len(text) + 3) // 4
+
+
+def message_tokens(message: Dict[str, str]) -> int:
+    return count_tokens(message["content"]) + MESSAGE_OVERHEAD
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut text to roughly max_tokens, preferring a line boundary"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+    cut = text[:max_tokens * 4]
+    newline = cut.rfind("\n")
+    if newline > len(cut) // 2:
+        cut = cut[:newline]
+    return cut + "\n[...]"
+
+
+def _fill_history(earlier: List[Dict], budget: int, kept: int = 0) -> Tuple[int, int]:
+    """Extend the kept suffix of earlier newest-first within budget; returns (kept, tokens used)"""
+    used = 0
+    while kept < len(earlier):
+        cost = message_tokens(earlier[-1 - kept])
+        if used + cost > budget:
+            break
+        used += cost
+        kept += 1
+    return kept, used
+
+
+def build_prompt(system_prompt: str, context: str, summary: str, history: List[Dict],
+                 budget: int = PROMPT_TOKEN_BUDGET) -> Tuple[List[Dict[str, str]], List[Dict], int]:
+    """Fit the system prompt, context, running summary and recent history into budget tokens.
+
+    history is chronological and ends with the current user message, which
+    is always kept. History messages may carry extra keys such as "id".
+    Returns (messages, dropped, tokens) where dropped are the oldest history
+    messages that did not fit, in chronological order.
+
+    The system message holds only the system prompt and the summary, and
+    the per-turn context is attached to the current question, so a prompt
+    starts with the previous turn's prompt up to its question and the
+    model server can reuse its prompt cache for that prefix.
+    """
+    current, earlier = history[-1], history[:-1]
+    summary = truncate_to_tokens(summary, SUMMARY_MAX_TOKENS) if summary else ""
+    system_content = system_prompt + (f"\n\nSummary of the earlier conversation:\n{summary}" if summary else "")
+    question = f"\n\nQuestion:\n{current['content']}"
+    context_header = "Context Information:\n"
+
+    remaining = (budget - count_tokens(system_content) - MESSAGE_OVERHEAD
+                 - count_tokens(context_header + question) - MESSAGE_OVERHEAD)
+
+    # History first takes what context isn't guaranteed, then context takes
+    # what it needs of the rest, and any leftover goes back to history
+    kept, history_used = _fill_history(earlier, int(max(remaining, 0) * (1 - CONTEXT_SHARE)))
+    context = truncate_to_tokens(context, remaining - history_used)
+    more, extra_used = _fill_history(earlier, remaining - history_used - count_tokens(context), kept)
+    kept, history_used = more, history_used + extra_used
+
+    recent = earlier[len(earlier) - kept:]
+    messages = (
+        [{"role": "system", "content": system_content}]
+        + [{"role": m["role"], "content": m["content"]} for m in recent]
+        + [{"role": current["role"], "content": context_header + context + question}]
+    )
+    dropped = earlier[:len(earlier) - kept]
+    tokens = sum(message_tokens(message) for message in messages)
+    logger.debug(
+        f"Prompt is ~{tokens} of {budget} tokens: context ~{count_tokens(context)}, "
+        f"summary ~{count_tokens(summary)}, {kept + 1} of {len(history)} messages"
+    )
+    return messages, dropped, tokens
@@ -1,10 +1,40 @@
-from flask import render_template, redirect, url_for, flash, request, jsonify, session
+from flask import render_template, redirect, url_for, flash, request, jsonify, session, make_response, stream_with_context
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash
 from app import app, db
 from models import User, Watchlist, WatchlistItem, Portfolio, Order, ChatSession, ChatMessage
+import asyncio
+import hashlib
+import json
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 import stock_data  # Import the entire module to avoid shadowing in local scope
-from stock_data import get_market_summary, search_stocks, get_stock_historical_data
+from stock_data import search_stocks, get_stock_historical_data, downsample_history
+from portfolio_valuation import portfolio_valuator
+from order_book import order_book, RESTING_KINDS
+from ledger import debit_funds, credit_funds, add_position, remove_position, reserve_shares, release_shares
+
+@contextmanager
+def _timed(timings, name):
+    """Record the wall time of a block in milliseconds under name."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = (time.perf_counter() - start) * 1000
+
+async def _timed_async(timings, name, coro):
+    """Await coro, recording its wall time in milliseconds under name."""
+    start = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        timings[name] = (time.perf_counter() - start) * 1000
+
+def _server_timing(timings):
+    """Format recorded timings as a Server-Timing header value."""
+    return ', '.join(f'{name};dur={duration:.1f}' for name, duration in timings.items())
 
 @app.route('/')
 def index():
@@ -85,34 +115,48 @@ def logout():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    # Get market summary
-    market_summary = get_market_summary()
-    
-    # Get user's watchlist
-    watchlists = current_user.watchlists
-    default_watchlist = None
-    if watchlists:
-        default_watchlist = watchlists[0]
+    timings = {}
+    
+    with _timed(timings, 'db'):
+        # Get user's watchlist
+        watchlists = current_user.watchlists
+        default_watchlist = None
+        if watchlists:
+            default_watchlist = watchlists[0]
+        watchlist_items = default_watchlist.stocks[:5] if default_watchlist else []
         
-    # Get portfolio value
-    portfolio = Portfolio.query.filter_by(user_id=current_user.id).all()
-    portfolio_value = 0
-    for item in portfolio:
-        current_price = stock_data.get_stock_data(item.symbol)['price']
-        portfolio_value += current_price * item.quantity
-    
-    # Make stock data functions available in the template
-    get_stock_data = stock_data.get_stock_data
-    get_top_gainers_losers = stock_data.get_top_gainers_losers
-    
-    return render_template('dashboard.html', 
-                           title='Dashboard', 
-                           market_summary=market_summary,
-                           default_watchlist=default_watchlist,
-                           portfolio_value=portfolio_value,
-                           available_funds=current_user.funds,
-                           get_stock_data=get_stock_data,
-                           get_top_gainers_losers=get_top_gainers_losers)
+        portfolio = Portfolio.query.filter_by(user_id=current_user.id).all()
+    
+    # Fetch every quote the page needs concurrently on the async data layer
+    symbols = [item.symbol for item in portfolio] + [item.symbol for item in watchlist_items]
+    
+    async def prefetch():
+        return await asyncio.gather(
+            _timed_async(timings, 'quotes', stock_data.async_get_stock_data_bulk(symbols)),
+            _timed_async(timings, 'market', stock_data.async_get_market_summary()),
+            _timed_async(timings, 'movers', stock_data.async_get_top_gainers_losers()),
+        )
+    
+    with _timed(timings, 'prefetch'):
+        quotes, market_summary, movers = stock_data.run_async(prefetch())
+    
+    # Get portfolio value; its quotes were just prefetched, so this is served from cache
+    portfolio_value = portfolio_valuator.value(current_user.id, portfolio).total_value
+    
+    watchlist_stocks = [quotes[item.symbol] for item in watchlist_items]
+    
+    with _timed(timings, 'render'):
+        html = render_template('dashboard.html', 
+                               title='Dashboard', 
+                               market_summary=market_summary,
+                               watchlist_stocks=watchlist_stocks,
+                               portfolio_value=portfolio_value,
+                               available_funds=current_user.funds,
+                               movers=movers)
+    
+    response = make_response(html)
+    response.headers['Server-Timing'] = _server_timing(timings)
+    return response
 
 @app.route('/watchlist')
 @login_required
@@ -130,9 +174,10 @@ def watchlist():
     stocks_data = []
     active_watchlist = watchlists[0]
     
+    quotes = stock_data.get_stock_data_bulk([item.symbol for item in active_watchlist.stocks])
     for item in active_watchlist.stocks:
         try:
-            stock_info = stock_data.get_stock_data(item.symbol)
+            stock_info = quotes[item.symbol]
             stocks_data.append(stock_info)
         except Exception as e:
             app.logger.error(f"Error fetching data for {item.symbol}: {e}")
@@ -219,54 +264,86 @@ def remove_from_watchlist():
 @app.route('/portfolio')
 @login_required
 def portfolio():
-    portfolio_items = Portfolio.query.filter_by(user_id=current_user.id).all()
-    
-    portfolio_data = []
-    total_value = 0
-    total_investment = 0
-    
-    for item in portfolio_items:
-        try:
-            stock_info = stock_data.get_stock_data(item.symbol)
-            current_price = stock_info['price']
-            current_value = current_price * item.quantity
-            investment = item.average_price * item.quantity
-            profit_loss = current_value - investment
-            profit_loss_percentage = (profit_loss / investment) * 100 if investment > 0 else 0
-            
-            portfolio_data.append({
-                'symbol': item.symbol,
-                'company_name': stock_info.get('name', 'Unknown'),
-                'quantity': item.quantity,
-                'average_price': item.average_price,
-                'current_price': current_price,
-                'current_value': current_value,
-                'profit_loss': profit_loss,
-                'profit_loss_percentage': profit_loss_percentage
-            })
-            
-            total_value += current_value
-            total_investment += investment
-        except Exception as e:
-            app.logger.error(f"Error fetching data for {item.symbol}: {e}")
-    
-    # Calculate overall profit/loss
-    overall_profit_loss = total_value - total_investment
-    overall_profit_loss_percentage = (overall_profit_loss / total_investment) * 100 if total_investment > 0 else 0
+    valuation = portfolio_valuator.value(current_user.id)
     
     return render_template('portfolio.html', 
                            title='Portfolio',
-                           portfolio_data=portfolio_data,
-                           total_value=total_value,
-                           overall_profit_loss=overall_profit_loss,
-                           overall_profit_loss_percentage=overall_profit_loss_percentage,
+                           portfolio_data=valuation.records(),
+                           total_value=valuation.total_value,
+                           overall_profit_loss=valuation.profit_loss,
+                           overall_profit_loss_percentage=valuation.profit_loss_percentage,
+                           sector_allocation=valuation.sector_allocation,
                            available_funds=current_user.funds)
 
 @app.route('/orders')
 @login_required
 def orders():
-    orders = Order.query.filter_by(user_id=current_user.id).order_by(Order.created_at.desc()).all()
-    return render_template('orders.html', title='Orders', orders=orders)
+    # Rows are loaded a page at a time from /api/orders
+    return render_template('orders.html', title='Orders')
+
+ORDERS_PAGE_SIZE = 50  # Orders per /api/orders page by default
+ORDERS_PAGE_MAX = 200  # Largest page a client may ask for
+
+def _order_cursor(order):
+    return f"{order.created_at.isoformat()}_{order.id}"
+
+def _parse_order_cursor(cursor):
+    created_at, order_id = cursor.rsplit('_', 1)
+    return datetime.fromisoformat(created_at), int(order_id)
+
+def _order_record(order):
+    return {
+        'id': order.id,
+        'symbol': order.symbol,
+        'order_type': order.order_type,
+        'kind': order.kind or 'MARKET',
+        'quantity': order.quantity,
+        'price': order.price,
+        'trigger_price': order.trigger_price,
+        'total': order.price * order.quantity,
+        'status': order.status,
+        'created_at': order.created_at.isoformat(),
+        'filled_at': order.filled_at.isoformat() if order.filled_at else None,
+    }
+
+@app.route('/api/orders', methods=['GET'])
+@login_required
+def api_orders():
+    """The user's orders newest first, a page at a time.
+
+    Pages are keyset-paginated: cursor is the next_cursor of the previous
+    page, and the page after it is read straight off the (user_id,
+    created_at, id) index, so every page costs the same however long the
+    history is. Optional filters: symbol, order_type, status, and start and
+    end dates (YYYY-MM-DD, inclusive).
+    """
+    limit = min(max(request.args.get('limit', ORDERS_PAGE_SIZE, type=int), 1), ORDERS_PAGE_MAX)
+    query = Order.query.filter(Order.user_id == current_user.id)
+    
+    try:
+        cursor = request.args.get('cursor')
+        if cursor:
+            query = query.filter(db.tuple_(Order.created_at, Order.id) < _parse_order_cursor(cursor))
+        if request.args.get('start'):
+            query = query.filter(Order.created_at >= datetime.strptime(request.args['start'], '%Y-%m-%d'))
+        if request.args.get('end'):
+            end = datetime.strptime(request.args['end'], '%Y-%m-%d') + timedelta(days=1)
+            query = query.filter(Order.created_at < end)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid cursor or date'}), 400
+    
+    for name, column in (('symbol', Order.symbol), ('order_type', Order.order_type), ('status', Order.status)):
+        value = request.args.get(name, '').strip().upper()
+        if value:
+            query = query.filter(column == value)
+    
+    # One extra row tells whether there is a next page
+    rows = query.order_by(Order.created_at.desc(), Order.id.desc()).limit(limit + 1).all()
+    page = rows[:limit]
+    return jsonify({
+        'orders': [_order_record(order) for order in page],
+        'next_cursor': _order_cursor(page[-1]) if len(rows) > limit else None,
+    })
 
 @app.route('/api/place_order', methods=['POST'])
 @login_required
@@ -283,23 +360,27 @@ def place_order():
     if order_type not in ['BUY', 'SELL']:
         return jsonify({'success': False, 'message': 'Invalid order type'}), 400
     
-    # Check if user has enough funds for BUY
+    kind = (data.get('kind') or 'MARKET').upper()
+    if kind not in ['MARKET'] + list(RESTING_KINDS):
+        return jsonify({'success': False, 'message': 'Invalid order kind'}), 400
+    if kind in RESTING_KINDS:
+        return _place_resting_order(symbol, order_type, kind, quantity, price)
+    
+    # Funds and the position are checked and changed by single conditional statements
+    # in one transaction, so concurrent orders from the same user can't both pass a check
+    order_total = price * quantity
     if order_type == 'BUY':
-        order_total = price * quantity
-        if current_user.funds < order_total:
+        if debit_funds(current_user.id, order_total) is None:
+            db.session.rollback()
             return jsonify({'success': False, 'message': 'Insufficient funds'}), 400
-        
-        # Deduct funds from user
-        current_user.funds -= order_total
+        add_position(current_user.id, symbol, quantity, price)
     
-    # Check if user has enough stocks for SELL
     elif order_type == 'SELL':
-        portfolio_item = Portfolio.query.filter_by(user_id=current_user.id, symbol=symbol).first()
-        if not portfolio_item or portfolio_item.quantity < quantity:
+        # Shares claimed by pending SELL orders can't be sold again
+        if not remove_position(current_user.id, symbol, quantity):
+            db.session.rollback()
             return jsonify({'success': False, 'message': 'Insufficient stocks to sell'}), 400
-        
-        # Add funds to user
-        current_user.funds += price * quantity
+        credit_funds(current_user.id, order_total)
     
     # Create order
     order = Order(
@@ -311,51 +392,165 @@ def place_order():
         status='COMPLETED'
     )
     db.session.add(order)
+    db.session.commit()
     
-    # Update portfolio
-    portfolio_item = Portfolio.query.filter_by(user_id=current_user.id, symbol=symbol).first()
-    
+    return jsonify({'success': True, 'message': f'Order {order_type} for {quantity} shares of {symbol} placed successfully'})
+
+def _place_resting_order(symbol, order_type, kind, quantity, price):
+    """Rest a limit or stop order in the order book until a quote crosses price"""
     if order_type == 'BUY':
-        if portfolio_item:
-            # Update average price
-            total_value = (portfolio_item.average_price * portfolio_item.quantity) + (price * quantity)
-            portfolio_item.quantity += quantity
-            portfolio_item.average_price = total_value / portfolio_item.quantity
-        else:
-            # Create new portfolio entry
-            portfolio_item = Portfolio(
-                user_id=current_user.id,
-                symbol=symbol,
-                quantity=quantity,
-                average_price=price
-            )
-            db.session.add(portfolio_item)
+        # Reserve the funds at the trigger price; the difference is settled on fill
+        if debit_funds(current_user.id, price * quantity) is None:
+            db.session.rollback()
+            return jsonify({'success': False, 'message': 'Insufficient funds'}), 400
+    elif not reserve_shares(current_user.id, symbol, quantity):
+        db.session.rollback()
+        return jsonify({'success': False, 'message': 'Insufficient stocks to sell'}), 400
     
-    elif order_type == 'SELL':
-        portfolio_item.quantity -= quantity
-        # Remove from portfolio if quantity becomes zero
-        if portfolio_item.quantity == 0:
-            db.session.delete(portfolio_item)
+    order = Order(
+        user_id=current_user.id,
+        symbol=symbol,
+        order_type=order_type,
+        quantity=quantity,
+        price=price,
+        status='PENDING',
+        kind=kind,
+        trigger_price=price
+    )
+    db.session.add(order)
+    db.session.commit()
+    
+    # The process running the book rests it now; otherwise it's picked up on the book's next sync
+    if order_book.running:
+        order_book.add(order.id, symbol, order_type, kind, price, quantity)
+        # Orders placed through the current price trigger straight away
+        order_book.check(symbol)
+    
+    return jsonify({'success': True, 'order_id': order.id,
+                    'message': f'{kind.capitalize()} {order_type} order for {quantity} shares of {symbol} '
+                               f'at ${price:.2f} placed'})
+
+@app.route('/api/export/<dataset>', methods=['GET'])
+@login_required
+def export_trades(dataset):
+    """Download the user's orders or holdings as CSV or Parquet (?format=), streamed as it is read"""
+    from trade_io import EXPORT_DATASETS, EXPORT_FORMATS, iter_csv, iter_parquet, parquet_available
+    
+    export_format = request.args.get('format', 'csv').lower()
+    if dataset not in EXPORT_DATASETS or export_format not in EXPORT_FORMATS:
+        return jsonify({'success': False, 'message': 'Unknown dataset or format'}), 404
+    if export_format == 'parquet' and not parquet_available():
+        return jsonify({'success': False, 'message': 'Parquet export needs pyarrow installed'}), 501
+    
+    rows = iter_parquet if export_format == 'parquet' else iter_csv
+    response = app.response_class(stream_with_context(rows(dataset, current_user.id)),
+                                  mimetype=EXPORT_FORMATS[export_format])
+    response.headers['Content-Disposition'] = f'attachment; filename={dataset}.{export_format}'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/api/import/orders', methods=['POST'])
+@login_required
+def import_orders():
+    """Import a CSV of historical trades (symbol, order_type, quantity, price, created_at)"""
+    from trade_io import TradeImportError, import_trades
     
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        return jsonify({'success': False, 'message': 'No file uploaded'}), 400
+    try:
+        result = import_trades(current_user.id, upload.stream)
+    except TradeImportError as e:
+        return jsonify({'success': False, 'message': 'Import rejected', 'errors': e.errors}), 400
+    
+    return jsonify({'success': True, 'message': f"Imported {result['imported']} trades",
+                    'imported': result['imported'], 'skipped': result['skipped'], 'positions': result['positions']})
+
+@app.route('/api/orders/<int:order_id>/cancel', methods=['POST'])
+@login_required
+def cancel_order(order_id):
+    order = Order.query.filter_by(id=order_id, user_id=current_user.id).first()
+    if not order:
+        return jsonify({'success': False, 'message': 'Order not found'}), 404
+    
+    # Only one of cancelling and settlement can move the order out of PENDING
+    updated = Order.query.filter_by(id=order_id, status='PENDING').update(
+        {'status': 'CANCELLED'}, synchronize_session=False)
+    if not updated:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': 'Only pending orders can be cancelled'}), 400
+    if order.order_type == 'BUY':
+        credit_funds(current_user.id, order.trigger_price * order.quantity)
+    else:
+        release_shares(current_user.id, order.symbol, order.quantity)
     db.session.commit()
+    if order_book.running:
+        order_book.cancel(order_id)
     
-    return jsonify({'success': True, 'message': f'Order {order_type} for {quantity} shares of {symbol} placed successfully'})
+    return jsonify({'success': True, 'message': f'Order for {order.quantity} shares of {order.symbol} cancelled'})
+
+@app.route('/api/orders/book', methods=['GET'])
+@login_required
+def order_book_stats():
+    return jsonify(order_book.stats())
 
 @app.route('/chart/<symbol>')
 @login_required
 def chart(symbol):
+    period = request.args.get('period', '1mo')
+    interval = request.args.get('interval', '1d')
+    if period not in stock_data.HISTORY_PERIODS or interval not in stock_data.HISTORY_INTERVALS:
+        period, interval = '1mo', '1d'
+    
     try:
         stock_info = stock_data.get_stock_data(symbol)
-        historical_data = get_stock_historical_data(symbol)
+        historical_data = downsample_history(get_stock_historical_data(symbol, period, interval),
+                                             request.args.get('points', stock_data.CHART_DEFAULT_POINTS, type=int))
         return render_template('chart.html', 
                                title=f'{symbol} Chart',
                                symbol=symbol,
+                               period=period,
                                stock_info=stock_info,
                                historical_data=historical_data)
     except Exception as e:
         flash(f'Error loading chart data: {str(e)}', 'danger')
         return redirect(url_for('dashboard'))
 
+@app.route('/api/history/<symbol>', methods=['GET'])
+@login_required
+def history(symbol):
+    period = request.args.get('period', '1mo')
+    interval = request.args.get('interval', '1d')
+    points = request.args.get('points', type=int)
+    
+    if period not in stock_data.HISTORY_PERIODS:
+        return jsonify({'success': False, 'message': 'Invalid period'}), 400
+    if interval not in stock_data.HISTORY_INTERVALS:
+        return jsonify({'success': False, 'message': 'Invalid interval'}), 400
+    
+    historical_data = downsample_history(get_stock_historical_data(symbol, period, interval), points)
+    payload = {
+        'symbol': symbol,
+        'period': period,
+        'interval': interval,
+        'dates': historical_data['dates'],
+        'prices': [round(price, 4) for price in historical_data['prices']],
+        'volumes': historical_data['volumes'],
+    }
+    body = json.dumps(payload, separators=(',', ':'), allow_nan=False)
+    
+    # Clients revalidate with If-None-Match and get a 304 while the series is unchanged
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(hashlib.md5(body.encode()).hexdigest())
+    response.cache_control.private = True
+    response.cache_control.max_age = 60
+    return response.make_conditional(request)
+
+@app.route('/api/movers', methods=['GET'])
+@login_required
+def movers():
+    return jsonify(stock_data.get_top_gainers_losers())
+
 @app.route('/api/search', methods=['GET'])
 @login_required
 def search():
@@ -363,29 +558,17 @@ def search():
     if len(query) < 2:
         return jsonify([])
     
-    results = search_stocks(query)
-    return jsonify(results)
+    # Results come from the local index; let the browser reuse them for repeated queries
+    response = jsonify(search_stocks(query))
+    response.cache_control.private = True
+    response.cache_control.max_age = 300
+    return response
 
 @app.route('/chatbot')
 @login_required
 def chatbot():
     # Get user's portfolio to share with the chatbot
-    portfolio_items = Portfolio.query.filter_by(user_id=current_user.id).all()
-    portfolio_data = []
-    
-    for item in portfolio_items:
-        try:
-            stock_info = stock_data.get_stock_data(item.symbol)
-            current_price = stock_info['price']
-            
-            portfolio_data.append({
-                'symbol': item.symbol,
-                'quantity': item.quantity,
-                'average_price': item.average_price,
-                'current_price': current_price
-            })
-        except Exception as e:
-            app.logger.error(f"Error fetching data for {item.symbol}: {e}")
+    portfolio_data = portfolio_valuator.value(current_user.id).records()
     
     # Get or create a chat session for the user
     from chatbot import get_or_create_chat_session
@@ -407,7 +590,8 @@ def chatbot():
 @app.route('/chatbot/message', methods=['POST'])
 @login_required
 def chatbot_message():
-    from chatbot import generate_response, get_or_create_chat_session
+    from chatbot import get_or_create_chat_session
+    from chat_jobs import chat_job_queue, ChatJobRejected, CHAT_MESSAGE_TIMEOUT
     import logging
     
     logging.basicConfig(level=logging.DEBUG)
@@ -432,33 +616,43 @@ def chatbot_message():
             flash('Please enter a message.', 'warning')
             return redirect(url_for('chatbot'))
     
-    # Get user's portfolio for context
-    portfolio_items = Portfolio.query.filter_by(user_id=current_user.id).all()
-    logger.debug(f"Retrieved {len(portfolio_items)} portfolio items")
-    
     # Get or create a chat session for the user
     chat_session = get_or_create_chat_session(current_user.id)
     logger.debug(f"Using chat session id: {chat_session.id}")
     
     try:
-        # Generate response using our updated chatbot with RAG
+        # Generate the response on the chat worker pool, which enforces the
+        # per-user and queue limits, and wait for it
         # This will store messages in the database
-        logger.debug("Calling generate_response function")
-        response_text, session_id = generate_response(user_message, portfolio_items, chat_session.id)
+        logger.debug("Queueing chat turn")
+        job_id = chat_job_queue.submit(current_user.id, chat_session.id, user_message)
+        job = chat_job_queue.result(job_id, timeout=CHAT_MESSAGE_TIMEOUT)
+        if not job['finished']:
+            # Don't hold the web worker any longer; the client can follow the job instead
+            message = 'The assistant is still working on your answer.'
+            if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+                return jsonify({'success': True, 'message': message, 'job_id': job_id,
+                                'status_url': url_for('chat_job_status', job_id=job_id),
+                                'stream_url': url_for('chat_job_stream', job_id=job_id)}), 202
+            flash(f'{message} It will appear here once it is ready.', 'info')
+            return redirect(url_for('chatbot'))
+        if job['error']:
+            if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+                return jsonify({'success': False, 'message': job['error']}), 502
+            flash(job['error'], 'danger')
+            return redirect(url_for('chatbot'))
+        response_text = job['response']
         logger.debug(f"Received response: {response_text[:50]}...")
         
-        if not session_id:
-            logger.warning("No session ID returned from generate_response")
-            if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-                return jsonify({'success': False, 'message': 'There was an error processing your request.'}), 500
-            else:
-                flash('There was an error processing your request. Please try again.', 'warning')
-                return redirect(url_for('chatbot'))
-                
         # For AJAX requests, return the response as JSON
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
             return jsonify({'success': True, 'response': response_text})
             
+    except ChatJobRejected as e:
+        if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+            return jsonify({'success': False, 'message': str(e)}), 429
+        else:
+            flash(str(e), 'warning')
     except Exception as e:
         logger.error(f"Error generating chatbot response: {str(e)}", exc_info=True)
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
@@ -469,6 +663,147 @@ def chatbot_message():
     # For traditional form submissions, redirect to the chatbot page
     return redirect(url_for('chatbot'))
 
+def _sse(data, event=None):
+    frame = f"event: {event}\n" if event else ""
+    return frame + f"data: {json.dumps(data)}\n\n"
+
+def _chat_job_events(job_id):
+    """Server-Sent Events for a chat job's output: data frames of text as it is generated, then a
+    "done" event with the time to first text and in total, or an "error" event if it failed."""
+    from chat_jobs import chat_job_queue
+    
+    start = time.perf_counter()
+    ttft = None
+    offset = 0
+    while True:
+        job = chat_job_queue.wait(job_id, offset, timeout=15)
+        if job is None:
+            yield _sse({'message': 'Job not found'}, event='error')
+            return
+        if job['response']:
+            if ttft is None:
+                ttft = (time.perf_counter() - start) * 1000
+                app.logger.info(f"Chat time to first token: {ttft:.0f}ms")
+            yield _sse({'token': job['response']})
+            offset = job['length']
+        elif not job['finished']:
+            # Keep the connection open through proxies while the job is queued
+            yield ": keep-alive\n\n"
+        if job['finished'] and offset >= job['length']:
+            break
+    if job['error']:
+        yield _sse({'message': job['error']}, event='error')
+    else:
+        yield _sse({'status': job['status'], 'ttft_ms': round(ttft or 0, 1),
+                    'total_ms': round((time.perf_counter() - start) * 1000, 1)}, event='done')
+
+def _event_stream(events):
+    response = app.response_class(stream_with_context(events), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stop reverse proxies from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/chatbot/stream', methods=['POST'])
+@login_required
+def chatbot_stream():
+    """Queue a chat turn and stream the assistant's reply as Server-Sent Events.
+
+    The turn goes through the chat job queue, and its limits, like any
+    other; see _chat_job_events for the frames sent.
+    """
+    from chatbot import get_or_create_chat_session
+    from chat_jobs import chat_job_queue, ChatJobRejected
+
+    user_message = request.form.get('message')
+    if not user_message:
+        return jsonify({'success': False, 'message': 'Please enter a message.'}), 400
+
+    chat_session = get_or_create_chat_session(current_user.id)
+    try:
+        job_id = chat_job_queue.submit(current_user.id, chat_session.id, user_message)
+    except ChatJobRejected as e:
+        return jsonify({'success': False, 'message': str(e)}), 429
+    return _event_stream(_chat_job_events(job_id))
+
+@app.route('/chatbot/jobs', methods=['POST'])
+@login_required
+def submit_chat_job():
+    """Queue a chat turn and return its job id without waiting for the reply."""
+    from chatbot import get_or_create_chat_session
+    from chat_jobs import chat_job_queue, ChatJobRejected
+    
+    user_message = request.form.get('message')
+    if not user_message:
+        return jsonify({'success': False, 'message': 'Please enter a message.'}), 400
+    
+    chat_session = get_or_create_chat_session(current_user.id)
+    try:
+        job_id = chat_job_queue.submit(current_user.id, chat_session.id, user_message)
+    except ChatJobRejected as e:
+        return jsonify({'success': False, 'message': str(e)}), 429
+    
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'position': chat_job_queue.get(job_id)['position'],
+        'status_url': url_for('chat_job_status', job_id=job_id),
+        'stream_url': url_for('chat_job_stream', job_id=job_id),
+    }), 202
+
+def _get_chat_job(job_id, offset=0):
+    from chat_jobs import chat_job_queue
+    job = chat_job_queue.get(job_id, offset)
+    # Other users' jobs are reported as missing
+    if job is None or job['user_id'] != current_user.id:
+        return None
+    return job
+
+@app.route('/chatbot/jobs/<job_id>', methods=['GET'])
+@login_required
+def chat_job_status(job_id):
+    """Poll a chat job; the response so far is included while it runs.
+    
+    With ?offset=n only the response past its first n characters is sent;
+    length is the whole response's length, the offset for the next poll.
+    """
+    job = _get_chat_job(job_id, max(request.args.get('offset', 0, type=int), 0))
+    if job is None:
+        return jsonify({'success': False, 'message': 'Job not found'}), 404
+    
+    payload = {key: job[key] for key in ('job_id', 'status', 'response', 'length', 'error', 'position')}
+    payload['success'] = True
+    response = jsonify(payload)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/chatbot/jobs/<job_id>/stream', methods=['GET'])
+@login_required
+def chat_job_stream(job_id):
+    """Stream a chat job's output as Server-Sent Events, as /chatbot/stream does."""
+    if _get_chat_job(job_id) is None:
+        return jsonify({'success': False, 'message': 'Job not found'}), 404
+    return _event_stream(_chat_job_events(job_id))
+
+@app.route('/api/chatbot/queue', methods=['GET'])
+@login_required
+def chat_queue_stats():
+    from chat_jobs import chat_job_queue
+    return jsonify(chat_job_queue.stats())
+
+@app.route('/api/chatbot/cache', methods=['GET'])
+@login_required
+def chat_cache_stats():
+    from chatbot import response_cache
+    return jsonify(response_cache.stats())
+
+@app.route('/api/chatbot/backends', methods=['GET'])
+@login_required
+def chat_backend_stats():
+    from llm_providers import get_llm_provider
+    provider = get_llm_provider()
+    return jsonify(provider.stats() if hasattr(provider, 'stats') else [])
+
 @app.route('/chatbot/reset', methods=['POST'])
 @login_required
 def reset_chatbot():
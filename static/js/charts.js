@@ -191,9 +191,43 @@ function setupPeriodSelectors() {
 
 // Update chart with new period data
 function updateChartData(symbol, period, interval) {
-    // For a real app, this would call an API endpoint
-    // Here we'll simulate by reloading the page with query params
-    window.location.href = `/chart/${symbol}?period=${period}&interval=${interval}`;
+    const loading = document.getElementById('chart-loading');
+    
+    // Ask for no more points than the chart has pixels; the server downsamples with LTTB
+    const points = Math.round(document.getElementById('stock-chart').clientWidth) || '';
+    
+    // The browser revalidates with the history endpoint's ETag, so
+    // switching back to a period already viewed is answered with a 304
+    fetch(`/api/history/${encodeURIComponent(symbol)}?period=${period}&interval=${interval}&points=${points}`)
+        .then(response => {
+            if (!response.ok) {
+                throw new Error('Network response was not ok');
+            }
+            return response.json();
+        })
+        .then(data => {
+            if (window.priceChart) {
+                window.priceChart.data.labels = data.dates;
+                window.priceChart.data.datasets[0].data = data.prices;
+                window.priceChart.data.datasets[1].data = calculateMovingAverage(data.prices, 20);
+                window.priceChart.data.datasets[2].data = calculateMovingAverage(data.prices, 50);
+                window.priceChart.update();
+            }
+            if (window.volumeChart) {
+                window.volumeChart.data.labels = data.dates;
+                window.volumeChart.data.datasets[0].data = data.volumes;
+                window.volumeChart.update();
+            }
+            
+            // Keep the URL shareable without reloading the page
+            window.history.replaceState(null, '', `/chart/${symbol}?period=${period}&interval=${interval}`);
+        })
+        .catch(error => {
+            console.error('Error fetching chart data:', error);
+        })
+        .finally(() => {
+            loading.classList.add('d-none');
+        });
 }
 
 // Calculate simple moving average
@@ -293,6 +327,7 @@ function setupOrderForm() {
                 body: JSON.stringify({
                     symbol: symbol,
                     order_type: orderType,
+                    kind: document.getElementById('order-kind').value,
                     quantity: quantity,
                     price: price
                 })
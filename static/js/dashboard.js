@@ -37,6 +37,10 @@ function debounce(func, wait) {
     };
 }
 
+// Recent search results by query, and the request in flight
+const searchCache = new Map();
+let searchController = null;
+
 // Handle stock search
 function handleSearch() {
     const query = document.getElementById('stock-search').value.trim();
@@ -48,36 +52,59 @@ function handleSearch() {
         return;
     }
     
+    // Drop the response to any earlier keystroke still in flight
+    if (searchController) {
+        searchController.abort();
+    }
+    
+    const cached = searchCache.get(query.toLowerCase());
+    if (cached) {
+        renderSearchResults(cached);
+        return;
+    }
+    
+    searchController = new AbortController();
+    
     // Fetch search results from the API
-    fetch(`/api/search?q=${encodeURIComponent(query)}`)
+    fetch(`/api/search?q=${encodeURIComponent(query)}`, { signal: searchController.signal })
         .then(response => response.json())
         .then(data => {
-            searchResults.innerHTML = '';
-            
-            if (data.length === 0) {
-                searchResults.innerHTML = '<p class="text-center p-2">No results found</p>';
-            } else {
-                data.forEach(item => {
-                    const resultItem = document.createElement('a');
-                    resultItem.href = `/chart/${item.symbol}`;
-                    resultItem.classList.add('dropdown-item', 'd-flex', 'justify-content-between', 'align-items-center');
-                    resultItem.innerHTML = `
-                        <span><strong>${item.symbol}</strong></span>
-                        <span class="text-muted">${item.name}</span>
-                    `;
-                    searchResults.appendChild(resultItem);
-                });
-            }
-            
-            searchResults.classList.remove('d-none');
+            searchCache.set(query.toLowerCase(), data);
+            renderSearchResults(data);
         })
         .catch(error => {
+            if (error.name === 'AbortError') {
+                return;
+            }
             console.error('Error searching stocks:', error);
             searchResults.innerHTML = '<p class="text-center p-2 text-danger">Error searching stocks</p>';
             searchResults.classList.remove('d-none');
         });
 }
 
+// Render search results in the dropdown
+function renderSearchResults(data) {
+    const searchResults = document.getElementById('search-results');
+    searchResults.innerHTML = '';
+    
+    if (data.length === 0) {
+        searchResults.innerHTML = '<p class="text-center p-2">No results found</p>';
+    } else {
+        data.forEach(item => {
+            const resultItem = document.createElement('a');
+            resultItem.href = `/chart/${item.symbol}`;
+            resultItem.classList.add('dropdown-item', 'd-flex', 'justify-content-between', 'align-items-center');
+            resultItem.innerHTML = `
+                <span><strong>${item.symbol}</strong></span>
+                <span class="text-muted">${item.name}</span>
+            `;
+            searchResults.appendChild(resultItem);
+        });
+    }
+    
+    searchResults.classList.remove('d-none');
+}
+
 // Initialize market summary charts
 function initMarketCharts() {
     const marketCharts = document.querySelectorAll('.market-chart');
@@ -123,34 +150,24 @@ function initMarketCharts() {
         });
         
         // Fetch data for the chart
-        fetchChartData(symbol, '5d', '1d', chart);
+        fetchChartData(symbol, '5d', '1d', chart, chartElement.clientWidth);
     });
 }
 
 // Fetch chart data from API
-function fetchChartData(symbol, period, interval, chart) {
-    // Using the chart endpoint, but only extracting the data we need
-    fetch(`/chart/${symbol}`)
+function fetchChartData(symbol, period, interval, chart, points) {
+    fetch(`/api/history/${encodeURIComponent(symbol)}?period=${period}&interval=${interval}&points=${points || ''}`)
         .then(response => {
             if (!response.ok) {
                 throw new Error('Network response was not ok');
             }
-            return response.text();
+            return response.json();
         })
-        .then(html => {
-            // Extract the historical data from the HTML
-            const parser = new DOMParser();
-            const doc = parser.parseFromString(html, 'text/html');
-            const dataElement = doc.getElementById('historical-data');
-            
-            if (dataElement) {
-                const historicalData = JSON.parse(dataElement.textContent);
-                
-                // Update chart with the new data
-                chart.data.labels = historicalData.dates;
-                chart.data.datasets[0].data = historicalData.prices;
-                chart.update();
-            }
+        .then(historicalData => {
+            // Update chart with the new data
+            chart.data.labels = historicalData.dates;
+            chart.data.datasets[0].data = historicalData.prices;
+            chart.update();
         })
         .catch(error => {
             console.error('Error fetching chart data:', error);
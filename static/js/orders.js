@@ -1,6 +1,18 @@
 // orders.js - Handles orders functionality
 
+// Order history is loaded from /api/orders a page at a time as the user scrolls
+const ordersState = {
+    filters: {},
+    cursor: null,
+    done: false,
+    loading: false,
+    generation: 0  // Bumped when filters change, so stale pages are dropped
+};
+
 document.addEventListener('DOMContentLoaded', function() {
+    const tableBody = document.querySelector('#orders-table tbody');
+    if (!tableBody) return;
+    
     // Initialize date range picker if it exists
     const dateRangePicker = document.getElementById('date-range');
     if (dateRangePicker) {
@@ -8,14 +20,30 @@ document.addEventListener('DOMContentLoaded', function() {
         // For simplicity, we're using native date inputs
         dateRangePicker.addEventListener('submit', function(e) {
             e.preventDefault();
-            filterOrdersByDate();
+            const startDate = document.getElementById('start-date').value;
+            const endDate = document.getElementById('end-date').value;
+            if (startDate && endDate && startDate > endDate) {
+                showAlert('The start date must not be after the end date', 'warning');
+                return;
+            }
+            setOrderFilter({ start: startDate, end: endDate });
         });
     }
     
-    // Handle order search
+    // Handle symbol search
     const searchInput = document.getElementById('order-search');
     if (searchInput) {
-        searchInput.addEventListener('input', debounce(handleOrderSearch, 300));
+        searchInput.addEventListener('input', debounce(function() {
+            setOrderFilter({ symbol: searchInput.value.trim() });
+        }, 300));
+    }
+    
+    // Handle status filter
+    const statusSelect = document.getElementById('order-status');
+    if (statusSelect) {
+        statusSelect.addEventListener('change', function() {
+            setOrderFilter({ status: this.value });
+        });
     }
     
     // Handle order type filters
@@ -23,79 +51,180 @@ document.addEventListener('DOMContentLoaded', function() {
     typeFilters.forEach(filter => {
         filter.addEventListener('click', function() {
             const type = this.getAttribute('data-type');
-            filterOrdersByType(type);
+            setOrderFilter({ order_type: type === 'ALL' ? '' : type });
             
             // Update active filter button
             typeFilters.forEach(btn => btn.classList.remove('active'));
             this.classList.add('active');
         });
     });
-});
-
-// Filter orders by date range
-function filterOrdersByDate() {
-    const startDate = document.getElementById('start-date').value;
-    const endDate = document.getElementById('end-date').value;
-    
-    if (!startDate || !endDate) {
-        showAlert('Please select both start and end dates', 'warning');
-        return;
-    }
     
-    const start = new Date(startDate);
-    const end = new Date(endDate);
-    end.setHours(23, 59, 59); // Include the full end day
+    // Handle cancelling pending limit and stop orders, including rows loaded later
+    tableBody.addEventListener('click', function(e) {
+        const button = e.target.closest('.cancel-order');
+        if (button) {
+            cancelOrder(button.getAttribute('data-order-id'), button);
+        }
+    });
     
-    const rows = document.querySelectorAll('#orders-table tbody tr');
+    // Import a CSV of historical trades as soon as one is picked
+    const importFile = document.getElementById('import-file');
+    if (importFile) {
+        importFile.addEventListener('change', function() {
+            if (this.files.length) {
+                importTrades(this.files[0]);
+                this.value = '';
+            }
+        });
+    }
     
-    rows.forEach(row => {
-        const dateStr = row.getAttribute('data-date');
-        const orderDate = new Date(dateStr);
-        
-        if (orderDate >= start && orderDate <= end) {
-            row.classList.remove('d-none');
-        } else {
-            row.classList.add('d-none');
+    // Load the next page whenever the end of the table scrolls into view
+    const sentinel = document.getElementById('orders-sentinel');
+    const observer = new IntersectionObserver(entries => {
+        if (entries.some(entry => entry.isIntersecting)) {
+            loadOrders();
         }
-    });
+    }, { rootMargin: '200px' });
+    observer.observe(sentinel);
+    
+    loadOrders();
+});
+
+// Apply filter changes and restart the history from the newest order
+function setOrderFilter(changes) {
+    Object.assign(ordersState.filters, changes);
+    ordersState.cursor = null;
+    ordersState.done = false;
+    ordersState.loading = false;
+    ordersState.generation += 1;
+    document.querySelector('#orders-table tbody').innerHTML = '';
+    loadOrders();
 }
 
-// Filter orders by type (BUY/SELL/ALL)
-function filterOrdersByType(type) {
-    const rows = document.querySelectorAll('#orders-table tbody tr');
-    
-    rows.forEach(row => {
-        if (type === 'ALL') {
-            row.classList.remove('d-none');
-        } else {
-            const orderType = row.getAttribute('data-type');
-            if (orderType === type) {
-                row.classList.remove('d-none');
+// Upload a trades CSV and reload the history once it is imported
+function importTrades(file) {
+    const formData = new FormData();
+    formData.append('file', file);
+    showAlert(`Importing ${escapeHtml(file.name)}...`, 'info');
+    
+    fetch('/api/import/orders', { method: 'POST', body: formData })
+        .then(response => response.json())
+        .then(data => {
+            if (data.success) {
+                showAlert(data.message, 'success');
+                setOrderFilter({});
             } else {
-                row.classList.add('d-none');
+                const errors = (data.errors || []).map(escapeHtml).join('<br>');
+                showAlert(`${data.message}${errors ? '<br>' + errors : ''}`, 'danger');
             }
-        }
-    });
+        })
+        .catch(error => {
+            console.error('Error importing trades:', error);
+            showAlert('An error occurred while importing trades.', 'danger');
+        });
 }
 
-// Handle order search
-function handleOrderSearch() {
-    const query = document.getElementById('order-search').value.trim().toLowerCase();
-    const rows = document.querySelectorAll('#orders-table tbody tr');
-    
-    rows.forEach(row => {
-        const symbol = row.querySelector('.order-symbol').textContent.toLowerCase();
-        const orderType = row.querySelector('.order-type').textContent.toLowerCase();
-        const orderStatus = row.querySelector('.order-status').textContent.toLowerCase();
-        
-        if (symbol.includes(query) || 
-            orderType.includes(query) || 
-            orderStatus.includes(query)) {
-            row.classList.remove('d-none');
-        } else {
-            row.classList.add('d-none');
-        }
+// Fetch the next page of orders and append it to the table
+function loadOrders() {
+    if (ordersState.loading || ordersState.done) return;
+    ordersState.loading = true;
+    const generation = ordersState.generation;
+    
+    const params = new URLSearchParams();
+    Object.entries(ordersState.filters).forEach(([name, value]) => {
+        if (value) params.set(name, value);
     });
+    if (ordersState.cursor) params.set('cursor', ordersState.cursor);
+    
+    const loading = document.getElementById('orders-loading');
+    loading.classList.remove('d-none');
+    
+    fetch(`/api/orders?${params}`)
+        .then(response => response.json().then(data => ({ ok: response.ok, data })))
+        .then(({ ok, data }) => {
+            if (generation !== ordersState.generation) return;
+            if (!ok) throw new Error(data.message || 'Could not load orders');
+            
+            const tableBody = document.querySelector('#orders-table tbody');
+            data.orders.forEach(order => tableBody.appendChild(renderOrderRow(order)));
+            ordersState.cursor = data.next_cursor;
+            ordersState.done = !data.next_cursor;
+            document.getElementById('orders-empty').classList.toggle('d-none', tableBody.children.length > 0);
+        })
+        .catch(error => {
+            if (generation !== ordersState.generation) return;
+            console.error('Error loading orders:', error);
+            ordersState.done = true;
+            showAlert(error.message || 'An error occurred while loading orders.', 'danger');
+        })
+        .finally(() => {
+            if (generation !== ordersState.generation) return;
+            ordersState.loading = false;
+            loading.classList.add('d-none');
+            // Keep loading while the table is too short to scroll
+            const sentinel = document.getElementById('orders-sentinel');
+            if (!ordersState.done && sentinel.getBoundingClientRect().top < window.innerHeight + 200) {
+                loadOrders();
+            }
+        });
+}
+
+// Build a table row for an order from /api/orders
+function renderOrderRow(order) {
+    const row = document.createElement('tr');
+    row.setAttribute('data-order-id', order.id);
+    
+    const created = new Date(order.created_at);
+    const pad = value => String(value).padStart(2, '0');
+    const dateText = `${created.getFullYear()}-${pad(created.getMonth() + 1)}-${pad(created.getDate())} ` +
+        `${pad(created.getHours())}:${pad(created.getMinutes())}`;
+    const trigger = order.kind !== 'MARKET' && order.trigger_price !== null
+        ? ` <small class="text-muted">${order.kind} @ $${order.trigger_price.toFixed(2)}</small>` : '';
+    const cancel = order.status === 'PENDING'
+        ? ` <button type="button" class="btn btn-sm btn-link text-danger cancel-order" data-order-id="${order.id}">Cancel</button>` : '';
+    const symbol = encodeURIComponent(order.symbol);
+    
+    row.innerHTML = `
+        <td>${dateText}</td>
+        <td class="order-symbol"><a href="/chart/${symbol}">${escapeHtml(order.symbol)}</a></td>
+        <td class="order-type ${order.order_type === 'BUY' ? 'text-success' : 'text-danger'}">${order.order_type}${trigger}</td>
+        <td class="text-end">${order.quantity}</td>
+        <td class="text-end">$${order.price.toFixed(2)}</td>
+        <td class="text-end">$${order.total.toFixed(2)}</td>
+        <td class="order-status"><span class="badge status-${order.status.toLowerCase()}">${order.status}</span>${cancel}</td>
+    `;
+    return row;
+}
+
+// Escape text for use in HTML
+function escapeHtml(text) {
+    const div = document.createElement('div');
+    div.textContent = text;
+    return div.innerHTML;
+}
+
+// Cancel a pending order and mark its row cancelled
+function cancelOrder(orderId, button) {
+    button.disabled = true;
+    fetch(`/api/orders/${orderId}/cancel`, { method: 'POST' })
+        .then(response => response.json())
+        .then(data => {
+            if (data.success) {
+                const badge = button.closest('td').querySelector('.badge');
+                badge.className = 'badge status-cancelled';
+                badge.textContent = 'CANCELLED';
+                button.remove();
+                showAlert(data.message, 'success');
+            } else {
+                button.disabled = false;
+                showAlert(data.message, 'danger');
+            }
+        })
+        .catch(error => {
+            console.error('Error cancelling order:', error);
+            button.disabled = false;
+            showAlert('An error occurred while cancelling the order.', 'danger');
+        });
 }
 
 // Show alert message
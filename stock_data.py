@@ -1,50 +1,234 @@
 import yfinance as yf
+import numpy as np
 import pandas as pd
+import os
+import csv
+import time
+import heapq
+import asyncio
 import logging
-from datetime import datetime, timedelta
+import threading
+import weakref
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+from cache import TTLCache, make_backend
+from history_store import history_store
+from symbol_index import symbol_index
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 # Cache for stock data to reduce API calls
-stock_cache = {}
-cache_expiry = {}
 CACHE_DURATION = 300  # Cache duration in seconds (5 minutes)
+CACHE_MAX_SYMBOLS = 2000  # LRU bound on the number of cached quotes
+quote_cache = TTLCache(CACHE_DURATION, make_backend(maxsize=CACHE_MAX_SYMBOLS, table='quotes'))
+CACHE_MAX_STALE = 3600  # Serve expired quotes up to an hour old while they refresh
+BULK_FETCH_WORKERS = 8  # Max concurrent upstream requests for bulk fetches
 
-def get_stock_data(symbol):
-    """Get current stock data for a given symbol."""
-    current_time = datetime.now()
+# Historical bars are kept in a local store; only the tail is refetched
+HISTORY_REFRESH = 300  # Refetch the tail of a cached series at most every 5 minutes
+PERIOD_DAYS = {'1d': 1, '5d': 5, '1mo': 31, '3mo': 92, '6mo': 183,
+               '1y': 366, '2y': 731, '5y': 1827, '10y': 3653}
+INTRADAY_INTERVALS = {'1m', '2m', '5m', '15m', '30m', '60m', '90m', '1h'}
+HISTORY_PERIODS = set(PERIOD_DAYS) | {'ytd', 'max'}
+HISTORY_INTERVALS = INTRADAY_INTERVALS | {'1d', '5d', '1wk', '1mo', '3mo'}
+CHART_DEFAULT_POINTS = 800  # Downsampling target when the client doesn't send its chart width
+
+# Major market indices shown in the market summary
+MARKET_INDICES = {
+    '^GSPC': 'S&P 500',
+    '^DJI': 'Dow Jones',
+    '^IXIC': 'NASDAQ',
+    '^RUT': 'Russell 2000',
+}
+
+# Top gainers/losers are ranked over the symbols listed in MOVERS_UNIVERSE_FILE
+# (the S&P 500 by default), falling back to a few common large caps
+MOVERS_COUNT = 5
+MOVERS_TTL = 300  # seconds a snapshot is served before it counts as stale and cached quotes are re-ranked
+MOVERS_UNIVERSE_FILE = os.environ.get('MOVERS_UNIVERSE_FILE',
+                                      os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'sp500.csv'))
+DEFAULT_MOVERS_UNIVERSE = ['AAPL', 'MSFT', 'GOOGL', 'AMZN', 'TSLA', 'META', 'NVDA', 'JPM', 'V', 'JNJ',
+                           'WMT', 'BAC', 'PG', 'PYPL', 'DIS', 'NFLX', 'INTC', 'CMCSA', 'PFE', 'CSCO']
+
+def _load_universe(path):
+    """Read the symbol column of a listing CSV."""
+    try:
+        with open(path, newline='') as f:
+            symbols = [row['symbol'].strip() for row in csv.DictReader(f) if row.get('symbol')]
+        return list(dict.fromkeys(symbols)) or DEFAULT_MOVERS_UNIVERSE
+    except (OSError, KeyError, csv.Error) as e:
+        logger.error(f"Error loading movers universe from {path}: {e}")
+        return DEFAULT_MOVERS_UNIVERSE
+
+MOVERS_UNIVERSE = _load_universe(MOVERS_UNIVERSE_FILE)
+
+symbol_index.add_many(MARKET_INDICES.items())
+
+_quote_listeners = []
+
+def add_quote_listener(listener):
+    """Call listener(symbol, data) with every quote fetched from upstream.
+    
+    Listeners run on the fetching thread, so they should return quickly.
+    """
+    _quote_listeners.append(listener)
+
+def _notify_quote_listeners(symbol, data):
+    for listener in _quote_listeners:
+        try:
+            listener(symbol, data)
+        except Exception as e:
+            logger.error(f"Quote listener failed for {symbol}: {e}")
+
+def _load_quote(symbol):
+    """Fetch a quote for the cache and pass it to the quote listeners."""
+    data = _fetch_stock_data(symbol)
+    _notify_quote_listeners(symbol, data)
+    return data
+
+def _format_quote(symbol, info):
+    """Extract the fields we use from a Ticker.info dict or a batch quote API result."""
+    return {
+        'symbol': symbol,
+        'name': info.get('shortName', info.get('longName', symbol)),
+        'sector': info.get('sector', ''),
+        'industry': info.get('industry', ''),
+        'price': info.get('currentPrice', info.get('regularMarketPrice', 0)),
+        'change': info.get('regularMarketChange', 0),
+        'change_percent': info.get('regularMarketChangePercent', 0),
+        'volume': info.get('regularMarketVolume', 0),
+        'market_cap': info.get('marketCap', 0),
+        'day_high': info.get('dayHigh', info.get('regularMarketDayHigh', 0)),
+        'day_low': info.get('dayLow', info.get('regularMarketDayLow', 0)),
+        'open': info.get('regularMarketOpen', 0),
+        'prev_close': info.get('regularMarketPreviousClose', 0),
+    }
+
+def _fetch_stock_data(symbol):
+    """Fetch current stock data for a symbol from Yahoo Finance."""
+    ticker = yf.Ticker(symbol)
+    return _format_quote(symbol, ticker.info)
+
+class QuoteRefresher:
+    """Keeps frequently requested quotes warm in the background.
     
-    # Check if we have cached data that's still valid
-    if symbol in stock_cache and symbol in cache_expiry:
-        if current_time < cache_expiry[symbol]:
-            return stock_cache[symbol]
+    Expired quotes are served stale while revalidate() refreshes them on a
+    small worker pool. Once started, a daemon thread also refreshes the
+    market indices, the movers universe and the most requested symbols
+    shortly before they expire, so requests rarely wait on Yahoo Finance.
+    """
     
-    try:
-        ticker = yf.Ticker(symbol)
-        info = ticker.info
-        
-        # Extract relevant information
-        stock_data = {
-            'symbol': symbol,
-            'name': info.get('shortName', info.get('longName', symbol)),
-            'price': info.get('currentPrice', info.get('regularMarketPrice', 0)),
-            'change': info.get('regularMarketChange', 0),
-            'change_percent': info.get('regularMarketChangePercent', 0),
-            'volume': info.get('regularMarketVolume', 0),
-            'market_cap': info.get('marketCap', 0),
-            'day_high': info.get('dayHigh', 0),
-            'day_low': info.get('dayLow', 0),
-            'open': info.get('regularMarketOpen', 0),
-            'prev_close': info.get('regularMarketPreviousClose', 0),
-        }
+    def __init__(self, interval=60, hot_limit=50, workers=8):
+        self.interval = interval
+        self.hot_limit = hot_limit
+        self._requests = Counter()
+        self._pinned = Counter()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='quote-refresh')
+        self._stop = threading.Event()
+        self._thread = None
+    
+    def record(self, symbols):
+        """Count requests for symbols so the hottest ones are kept warm."""
+        with self._lock:
+            self._requests.update(symbols)
+    
+    def pin(self, symbol):
+        """Keep symbol warm regardless of traffic until a matching unpin()."""
+        with self._lock:
+            self._pinned[symbol] += 1
+    
+    def unpin(self, symbol):
+        with self._lock:
+            self._pinned[symbol] -= 1
+            if self._pinned[symbol] <= 0:
+                del self._pinned[symbol]
+    
+    def hot_symbols(self):
+        """Symbols the refresher keeps warm."""
+        with self._lock:
+            hot = [symbol for symbol, _ in self._requests.most_common(self.hot_limit)]
+            pinned = list(self._pinned)
+        return list(dict.fromkeys(list(MARKET_INDICES) + MOVERS_UNIVERSE + pinned + hot))
+    
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+    
+    def revalidate(self, symbol):
+        """Refresh a symbol in the background unless a refresh is already queued.
         
-        # Cache the data
-        stock_cache[symbol] = stock_data
-        cache_expiry[symbol] = current_time + timedelta(seconds=CACHE_DURATION)
+        Returns the refresh's future, or None if one was already queued.
+        """
+        with self._lock:
+            if symbol in self._pending:
+                return None
+            self._pending.add(symbol)
+        return self._executor.submit(self._refresh, symbol)
+    
+    def _refresh(self, symbol):
+        try:
+            quote_cache.refresh(symbol, _load_quote)
+        except Exception as e:
+            logger.error(f"Error refreshing data for {symbol}: {e}")
+        finally:
+            with self._lock:
+                self._pending.discard(symbol)
+    
+    def run_once(self):
+        """Refresh every hot symbol that expires before the next pass, then re-rank movers."""
+        horizon = time.time() + self.interval * 1.5
+        futures = []
+        for symbol in self.hot_symbols():
+            entry = quote_cache.peek(symbol)
+            if entry is None or entry[1] < horizon:
+                future = self.revalidate(symbol)
+                if future is not None:
+                    futures.append(future)
+        wait(futures, timeout=self.interval)
+        compute_movers()
         
-        return stock_data
+        # Decay request counts so the hot set follows recent traffic
+        with self._lock:
+            for symbol in list(self._requests):
+                self._requests[symbol] //= 2
+                if not self._requests[symbol]:
+                    del self._requests[symbol]
+    
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Quote refresher pass failed: {e}")
+            self._stop.wait(self.interval)
+    
+    def start(self):
+        """Start the background refresh thread if it is not already running."""
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='quote-refresher', daemon=True)
+        self._thread.start()
+        logger.info("Started background quote refresher")
+    
+    def stop(self):
+        self._stop.set()
+
+
+quote_refresher = QuoteRefresher()
+
+def _get_stock_data(symbol):
+    try:
+        # Only one upstream fetch runs per symbol; concurrent callers share it.
+        # Expired quotes are returned immediately and refreshed in the background.
+        return quote_cache.get_or_load(symbol, _load_quote,
+                                       max_stale=CACHE_MAX_STALE,
+                                       revalidate=quote_refresher.revalidate)
     except Exception as e:
         logger.error(f"Error fetching data for {symbol}: {e}")
         # Return basic data if fetch fails
@@ -58,16 +242,162 @@ def get_stock_data(symbol):
             'error': str(e)
         }
 
+def quote_version(symbols):
+    """Identify the cached quotes for symbols.
+    
+    The result changes whenever any of the quotes is refreshed, so it can
+    key values derived from them. It never fetches.
+    """
+    entries = (quote_cache.peek(symbol) for symbol in symbols)
+    return tuple(entry[1] if entry is not None else None for entry in entries)
+
+def get_stock_data(symbol):
+    """Get current stock data for a given symbol."""
+    quote_refresher.record([symbol])
+    return _get_stock_data(symbol)
+
+def get_stock_data_bulk(symbols):
+    """Get current stock data for many symbols at once.
+    
+    Symbols are deduplicated, cache hits are served directly and the
+    remaining symbols are fetched concurrently on a bounded worker pool.
+    Stale cache entries are served as hits and refreshed in the background.
+    Returns a dict mapping each requested symbol to its stock data.
+    """
+    unique_symbols = list(dict.fromkeys(s for s in symbols if s))
+    quote_refresher.record(unique_symbols)
+    
+    results = quote_cache.get_many(unique_symbols, max_stale=CACHE_MAX_STALE,
+                                   revalidate=quote_refresher.revalidate)
+    missing = [symbol for symbol in unique_symbols if symbol not in results]
+    
+    if len(missing) == 1:
+        results[missing[0]] = _get_stock_data(missing[0])
+    elif missing:
+        workers = min(BULK_FETCH_WORKERS, len(missing))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for symbol, data in zip(missing, executor.map(_get_stock_data, missing)):
+                results[symbol] = data
+    
+    return results
+
+def _period_start(period):
+    """Earliest epoch second a chart period needs, in UTC."""
+    now = datetime.now(timezone.utc)
+    if period == 'max':
+        return 0
+    if period == 'ytd':
+        return int(datetime(now.year, 1, 1, tzinfo=timezone.utc).timestamp())
+    days = PERIOD_DAYS.get(period, PERIOD_DAYS['1mo'])
+    if period.endswith('d'):
+        # Pad day periods so N trading sessions are covered across weekends and holidays
+        days += 4
+    return int((now - timedelta(days=days)).timestamp())
+
+def _fetch_history(symbol, interval, start):
+    """Download bars since start from Yahoo Finance, indexed by epoch seconds."""
+    ticker = yf.Ticker(symbol)
+    hist = ticker.history(start=datetime.fromtimestamp(start, tz=timezone.utc), interval=interval)
+    
+    index = hist.index
+    if index.tz is not None:
+        # Intraday bars are stored in UTC; daily and longer bars keep the
+        # exchange-local date so they don't shift a day across timezones
+        if interval in INTRADAY_INTERVALS:
+            index = index.tz_convert('UTC')
+        index = index.tz_localize(None)
+    hist.index = index.values.astype('datetime64[s]').astype('int64')
+    return hist
+
+def _load_history(symbol, period, interval):
+    """Return cached bars for a period, fetching only what the store is missing."""
+    start = _period_start(period)
+    
+    with history_store.lock(symbol, interval):
+        coverage = history_store.coverage(symbol, interval)
+        if coverage is None or coverage[0] > start:
+            # Never fetched this far back: download the whole window
+            fetch_from, covered_from = start, start
+        elif coverage[2] is None or time.time() - coverage[1] > HISTORY_REFRESH:
+            # Refetch from the last stored bar, which may still have been forming
+            fetch_from, covered_from = coverage[2] or start, coverage[0]
+        else:
+            fetch_from = None
+        
+        if fetch_from is not None:
+            try:
+                bars = _fetch_history(symbol, interval, fetch_from)
+                history_store.append(symbol, interval, bars, covered_from)
+            except Exception as e:
+                if coverage is None:
+                    raise
+                logger.error(f"Error refreshing historical data for {symbol}, serving cached bars: {e}")
+    
+    bars = history_store.load(symbol, interval, start)
+    if period.endswith('d') and period in PERIOD_DAYS and not bars.empty:
+        # Keep only the last N trading sessions
+        sessions = bars.index.values // 86400
+        last_sessions = pd.unique(sessions)[-PERIOD_DAYS[period]:]
+        bars = bars[sessions >= last_sessions[0]]
+    return bars
+
+def lttb_indices(values, threshold):
+    """Indices of the points kept by Largest-Triangle-Three-Buckets downsampling.
+    
+    The first and last points are always kept; the points in between are
+    split into threshold - 2 buckets and from each bucket the point forming
+    the largest triangle with the previously kept point and the next
+    bucket's average is kept. Bars are treated as evenly spaced on x.
+    Thresholds below 3 are raised to 3, the fewest points LTTB can keep.
+    """
+    n = len(values)
+    threshold = max(int(threshold), 3)
+    if threshold >= n:
+        return np.arange(n)
+    
+    y = pd.Series(values, dtype='float64').ffill().bfill().fillna(0).to_numpy()
+    x = np.arange(n, dtype='float64')
+    
+    # Bucket i covers [edges[i], edges[i + 1]) of the points between the first and last
+    buckets = threshold - 2
+    edges = np.linspace(1, n - 1, buckets + 1).astype(np.int64)
+    counts = np.diff(edges)
+    avg_x = (edges[:-1] + edges[1:] - 1) / 2
+    avg_y = np.add.reduceat(y[:n - 1], edges[:-1]) / counts
+    
+    # Each bucket is compared against the average of the bucket after it
+    next_x = np.append(avg_x[1:], x[-1])
+    next_y = np.append(avg_y[1:], y[-1])
+    
+    kept = np.empty(threshold, dtype=np.int64)
+    kept[0], kept[-1] = 0, n - 1
+    a = 0
+    for i in range(buckets):
+        lo, hi = edges[i], edges[i + 1]
+        areas = np.abs((x[a] - next_x[i]) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (next_y[i] - y[a]))
+        a = lo + int(np.argmax(areas))
+        kept[i + 1] = a
+    return kept
+
+def downsample_history(data, max_points):
+    """Downsample a historical series to at most max_points bars using LTTB on price."""
+    if not max_points or len(data['dates']) <= max_points:
+        return data
+    keep = lttb_indices(data['prices'], max_points)
+    return {key: [values[i] for i in keep] for key, values in data.items()}
+
 def get_stock_historical_data(symbol, period='1mo', interval='1d'):
     """Get historical stock data for charts."""
     try:
-        ticker = yf.Ticker(symbol)
-        hist = ticker.history(period=period, interval=interval)
+        hist = _load_history(symbol, period, interval)
+        # Bars without a close can't be charted, and NaN isn't valid JSON
+        hist = hist[hist['Close'].notna()]
         
         # Convert to list format for Chart.js
-        dates = hist.index.strftime('%Y-%m-%d').tolist()
+        date_format = '%Y-%m-%d %H:%M' if interval in INTRADAY_INTERVALS else '%Y-%m-%d'
+        dates = pd.to_datetime(hist.index, unit='s').strftime(date_format).tolist()
         prices = hist['Close'].tolist()
-        volumes = hist['Volume'].tolist()
+        volumes = hist['Volume'].astype(object).where(hist['Volume'].notna(), None).tolist()
         
         return {
             'dates': dates,
@@ -80,20 +410,14 @@ def get_stock_historical_data(symbol, period='1mo', interval='1d'):
 
 def get_market_summary():
     """Get summary of major market indices."""
-    indices = ['^GSPC', '^DJI', '^IXIC', '^RUT']  # S&P 500, Dow Jones, NASDAQ, Russell 2000
-    
+    return _format_market_summary(get_stock_data_bulk(MARKET_INDICES))
+
+def _format_market_summary(quotes):
     market_data = []
-    for index in indices:
+    for index, name in MARKET_INDICES.items():
         try:
-            data = get_stock_data(index)
-            if '^GSPC' == index:
-                data['name'] = 'S&P 500'
-            elif '^DJI' == index:
-                data['name'] = 'Dow Jones'
-            elif '^IXIC' == index:
-                data['name'] = 'NASDAQ'
-            elif '^RUT' == index:
-                data['name'] = 'Russell 2000'
+            data = dict(quotes[index])
+            data['name'] = name
             market_data.append(data)
         except Exception as e:
             logger.error(f"Error fetching market data for {index}: {e}")
@@ -101,49 +425,217 @@ def get_market_summary():
     return market_data
 
 def search_stocks(query):
-    """Search for stocks based on symbol or name."""
+    """Search for stocks based on symbol or name in the local symbol index."""
     try:
-        # This is a simple implementation. For production, you might want to use a more comprehensive API
-        tickers = yf.Tickers(query).tickers
-        
-        results = []
-        for symbol, ticker in tickers.items():
-            try:
-                info = ticker.info
-                results.append({
-                    'symbol': symbol,
-                    'name': info.get('shortName', info.get('longName', symbol))
-                })
-            except:
-                # Skip tickers that raise errors
-                continue
-                
-        return results[:10]  # Limit to 10 results
+        return symbol_index.search(query, limit=10)
     except Exception as e:
         logger.error(f"Error searching stocks: {e}")
         return []
 
+# Latest movers ranking, replaced as a whole after each refresher pass. It is kept in the
+# cache backend like quotes, so with CACHE_BACKEND=sqlite every worker reads the snapshot
+# the refresher process ranked instead of ranking the universe itself.
+MOVERS_KEY = 'snapshot'
+movers_cache = TTLCache(MOVERS_TTL, make_backend(maxsize=1, table='movers'))
+_movers_recompute = threading.Lock()  # held while a background re-rank runs in this process
+
+def _rank_movers(quotes):
+    stocks_data = [data for data in quotes if data.get('price') and not data.get('error')]
+    
+    def change_percent(data):
+        return data.get('change_percent') or 0
+    
+    return {
+        'gainers': heapq.nlargest(MOVERS_COUNT, stocks_data, key=change_percent),
+        'losers': heapq.nsmallest(MOVERS_COUNT, stocks_data, key=change_percent),
+        'universe_size': len(stocks_data),
+        'as_of': datetime.now(timezone.utc).isoformat(),
+    }
+
+def _cached_movers_quotes():
+    entries = (quote_cache.peek(symbol) for symbol in MOVERS_UNIVERSE)
+    return [entry[0] for entry in entries if entry is not None]
+
+def compute_movers(fetch=False):
+    """Rank the movers universe and store the result as the current snapshot.
+    
+    By default only cached quotes (fresh or stale) are ranked so this never
+    waits on Yahoo Finance; pass fetch=True to load missing quotes first.
+    """
+    quotes = get_stock_data_bulk(MOVERS_UNIVERSE).values() if fetch else _cached_movers_quotes()
+    snapshot = _rank_movers(quotes)
+    movers_cache.set(MOVERS_KEY, snapshot)
+    return snapshot
+
+def _recompute_movers():
+    try:
+        compute_movers()
+    except Exception as e:
+        logger.error(f"Error computing movers: {e}")
+    finally:
+        _movers_recompute.release()
+
 def get_top_gainers_losers():
-    """Get top gainers and losers for the day."""
-    # This is a simplified version. For a real app, you'd use a specific API endpoint
-    # that provides this information directly
+    """Get top gainers and losers for the day.
     
-    # Common large cap stocks for demonstration
-    symbols = ['AAPL', 'MSFT', 'GOOGL', 'AMZN', 'TSLA', 'FB', 'NVDA', 'JPM', 'V', 'JNJ',
-               'WMT', 'BAC', 'PG', 'PYPL', 'DIS', 'NFLX', 'INTC', 'CMCSA', 'PFE', 'CSCO']
+    Serves the snapshot the quote refresher stores after each pass. Only
+    the refresher fetches the universe; other processes just read it. If
+    the snapshot is more than MOVERS_TTL seconds old (no refresher has run
+    since), the cached quotes are re-ranked in the background and the old
+    snapshot is served meanwhile. Until a first snapshot exists, the cached
+    quotes are ranked right away.
+    """
+    entry = movers_cache.peek(MOVERS_KEY)
+    if entry is None:
+        return compute_movers()
+    snapshot, expires_at = entry
+    if time.time() >= expires_at and _movers_recompute.acquire(blocking=False):
+        threading.Thread(target=_recompute_movers, name='movers-recompute', daemon=True).start()
+    return snapshot
+
+
+# Async data layer
+#
+# Views can load the quotes they need concurrently without a thread per
+# upstream call: misses are fetched from Yahoo's batch quote API on one
+# pooled keep-alive AsyncSession per event loop, with a semaphore bounding
+# the requests in flight. curl_cffi is the client yfinance itself uses;
+# Yahoo turns away clients without a browser TLS fingerprint. Cache hits,
+# fresh or stale, are answered without any upstream request, and symbols
+# already being fetched share that request.
+ASYNC_FETCH_CONCURRENCY = 8  # Upstream requests in flight per event loop
+ASYNC_QUOTE_BATCH = 50  # Symbols per batch quote request
+ASYNC_FETCH_TIMEOUT = 10  # Seconds per upstream request
+YAHOO_COOKIE_URL = 'https://fc.yahoo.com'
+YAHOO_CRUMB_URL = 'https://query1.finance.yahoo.com/v1/test/getcrumb'
+YAHOO_QUOTE_URL = 'https://query1.finance.yahoo.com/v7/finance/quote'
+
+class AsyncQuoteClient:
+    """Fetches quotes from Yahoo's batch quote API; used from one event loop only."""
     
-    stocks_data = []
-    for symbol in symbols:
+    def __init__(self, concurrency=ASYNC_FETCH_CONCURRENCY):
+        from curl_cffi.requests import AsyncSession
+        
+        self.session = AsyncSession(impersonate='chrome', max_clients=concurrency,
+                                    timeout=ASYNC_FETCH_TIMEOUT)
+        self.limit = asyncio.Semaphore(concurrency)
+        self._crumb = None
+        self._crumb_lock = asyncio.Lock()
+        self._in_flight = {}  # symbol -> task fetching the batch it is in
+    
+    async def _get_crumb(self, stale=None):
+        """Yahoo's session crumb, renewed if it is still the stale one that was rejected."""
+        async with self._crumb_lock:
+            if self._crumb is None or self._crumb == stale:
+                # fc.yahoo.com only sets the session cookie; its status doesn't matter
+                await self.session.get(YAHOO_COOKIE_URL, allow_redirects=True)
+                response = await self.session.get(YAHOO_CRUMB_URL, allow_redirects=True)
+                if response.status_code != 200 or '<html>' in response.text:
+                    raise RuntimeError(f"Yahoo crumb request failed with HTTP {response.status_code}")
+                self._crumb = response.text
+            return self._crumb
+    
+    async def _fetch_batch(self, symbols):
+        async with self.limit:
+            crumb = await self._get_crumb()
+            params = {'symbols': ','.join(symbols), 'formatted': 'false', 'crumb': crumb}
+            response = await self.session.get(YAHOO_QUOTE_URL, params=params)
+            if response.status_code == 401:
+                params['crumb'] = await self._get_crumb(stale=crumb)
+                response = await self.session.get(YAHOO_QUOTE_URL, params=params)
+            response.raise_for_status()
+            return {info['symbol']: info for info in response.json()['quoteResponse']['result']}
+    
+    async def _load_batch(self, symbols):
+        """Quotes for symbols, cached and passed to the quote listeners; failures become error quotes."""
         try:
-            data = get_stock_data(symbol)
-            stocks_data.append(data)
-        except:
-            continue
-    
-    # Sort by percentage change
-    if stocks_data:
-        gainers = sorted(stocks_data, key=lambda x: x.get('change_percent', 0), reverse=True)[:5]
-        losers = sorted(stocks_data, key=lambda x: x.get('change_percent', 0))[:5]
-        return {'gainers': gainers, 'losers': losers}
-    
-    return {'gainers': [], 'losers': []}
+            results = await self._fetch_batch(symbols)
+        except Exception as e:
+            logger.error(f"Error fetching quotes for {len(symbols)} symbols: {e}")
+            results = {}
+            error = str(e)
+        else:
+            error = 'No quote returned'
+        
+        quotes = {}
+        for symbol in symbols:
+            info = results.get(symbol)
+            if info is None:
+                quotes[symbol] = {'symbol': symbol, 'name': symbol, 'price': 0, 'change': 0,
+                                  'change_percent': 0, 'volume': 0, 'error': error}
+                continue
+            data = _format_quote(symbol, info)
+            # The batch API has no sector or industry; keep what an earlier full fetch found
+            previous = quote_cache.peek(symbol)
+            if previous is not None:
+                data['sector'] = data['sector'] or previous[0].get('sector', '')
+                data['industry'] = data['industry'] or previous[0].get('industry', '')
+            quote_cache.set(symbol, data)
+            _notify_quote_listeners(symbol, data)
+            quotes[symbol] = data
+        return quotes
+    
+    async def get_many(self, symbols):
+        """Fetch quotes for symbols in concurrent batches, joining fetches already in flight."""
+        new = [symbol for symbol in symbols if symbol not in self._in_flight]
+        for start in range(0, len(new), ASYNC_QUOTE_BATCH):
+            batch = new[start:start + ASYNC_QUOTE_BATCH]
+            task = asyncio.ensure_future(self._load_batch(batch))
+            for symbol in batch:
+                self._in_flight[symbol] = task
+            task.add_done_callback(lambda task, batch=batch: [
+                self._in_flight.pop(symbol) for symbol in batch if self._in_flight.get(symbol) is task
+            ])
+        tasks = {symbol: self._in_flight[symbol] for symbol in symbols}
+        await asyncio.gather(*set(tasks.values()))
+        return {symbol: task.result()[symbol] for symbol, task in tasks.items()}
+
+_async_clients = weakref.WeakKeyDictionary()  # event loop -> AsyncQuoteClient
+
+def _async_client():
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = AsyncQuoteClient()
+    return client
+
+async def async_get_stock_data(symbol):
+    """Async variant of get_stock_data."""
+    return (await async_get_stock_data_bulk([symbol]))[symbol]
+
+async def async_get_stock_data_bulk(symbols):
+    """Async variant of get_stock_data_bulk; misses are fetched in concurrent batches."""
+    unique_symbols = list(dict.fromkeys(s for s in symbols if s))
+    quote_refresher.record(unique_symbols)
+    
+    results = quote_cache.get_many(unique_symbols, max_stale=CACHE_MAX_STALE,
+                                   revalidate=quote_refresher.revalidate)
+    missing = [symbol for symbol in unique_symbols if symbol not in results]
+    if missing:
+        results.update(await _async_client().get_many(missing))
+    return results
+
+async def async_get_market_summary():
+    """Async variant of get_market_summary."""
+    return _format_market_summary(await async_get_stock_data_bulk(MARKET_INDICES))
+
+async def async_get_top_gainers_losers():
+    """Async variant of get_top_gainers_losers; it only reads the shared snapshot and cached quotes."""
+    return get_top_gainers_losers()
+
+# Bridge for calling the async layer from sync code such as Flask views
+_bridge_loop = None
+_bridge_lock = threading.Lock()
+
+def run_async(coro, timeout=None):
+    """Run a coroutine on a shared background event loop and wait for its result.
+    
+    Every request's coroutines run on the one loop, so their upstream
+    fetches overlap and share its AsyncQuoteClient.
+    """
+    global _bridge_loop
+    with _bridge_lock:
+        if _bridge_loop is None:
+            _bridge_loop = asyncio.new_event_loop()
+            threading.Thread(target=_bridge_loop.run_forever, name='async-bridge', daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coro, _bridge_loop).result(timeout)
@@ -0,0 +1,134 @@
+import os
+import csv
+import bisect
+import logging
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+LISTINGS_FILE = os.environ.get(
+    "LISTINGS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "sp500.csv")
+)
+
+
+def _trigrams(text: str) -> Set[str]:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class SymbolIndex:
+    """In-memory symbol/name index for search without network calls.
+
+    Exact and prefix matches on symbols and on words of the company name
+    are found by bisecting sorted arrays; if nothing matches literally,
+    names are matched fuzzily by shared character trigrams.
+    """
+
+    def __init__(self):
+        self._names: Dict[str, str] = {}
+        self._symbol_keys: List[str] = []
+        self._word_keys: List[Tuple[str, str]] = []  # (lowercased name word, symbol)
+        self._trigrams: Dict[str, Set[str]] = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def add(self, symbol: str, name: Optional[str] = None) -> None:
+        self.add_many([(symbol, name)])
+
+    def add_many(self, listings: Iterable[Tuple[str, Optional[str]]]) -> None:
+        """Add or rename (symbol, name) pairs"""
+        with self._lock:
+            for symbol, name in listings:
+                if not symbol:
+                    continue
+                symbol = symbol.strip().upper()
+                name = (name or symbol).strip()
+                if self._names.get(symbol) == name:
+                    continue
+                if symbol in self._names:
+                    self._remove(symbol)
+                else:
+                    bisect.insort(self._symbol_keys, symbol)
+                self._names[symbol] = name
+                for word in set(name.lower().split()):
+                    bisect.insort(self._word_keys, (word, symbol))
+                for gram in _trigrams(f"{symbol.lower()} {name.lower()}"):
+                    self._trigrams[gram].add(symbol)
+
+    def _remove(self, symbol: str) -> None:
+        name = self._names[symbol]
+        for word in set(name.lower().split()):
+            i = bisect.bisect_left(self._word_keys, (word, symbol))
+            if i < len(self._word_keys) and self._word_keys[i] == (word, symbol):
+                del self._word_keys[i]
+        for gram in _trigrams(f"{symbol.lower()} {name.lower()}"):
+            self._trigrams[gram].discard(symbol)
+
+    def load_csv(self, path: str) -> None:
+        """Load a listing CSV with symbol and name columns"""
+        try:
+            with open(path, newline="") as f:
+                self.add_many((row.get("symbol"), row.get("name")) for row in csv.DictReader(f))
+        except (OSError, csv.Error) as e:
+            logger.error(f"Error loading listings from {path}: {e}")
+
+    def search(self, query: str, limit: int = 10, min_similarity: float = 0.5) -> List[Dict[str, str]]:
+        """Return up to limit {'symbol', 'name'} matches, best first"""
+        query = query.strip()
+        if not query:
+            return []
+        upper, lower = query.upper(), query.lower()
+        ranked: List[str] = []
+        seen: Set[str] = set()
+
+        def take(symbol: str) -> bool:
+            if symbol not in seen:
+                seen.add(symbol)
+                ranked.append(symbol)
+            return len(ranked) >= limit
+
+        with self._lock:
+            # Exact symbol, then symbol prefix
+            if upper in self._names and take(upper):
+                return self._results(ranked)
+            i = bisect.bisect_left(self._symbol_keys, upper)
+            while i < len(self._symbol_keys) and self._symbol_keys[i].startswith(upper):
+                if take(self._symbol_keys[i]):
+                    return self._results(ranked)
+                i += 1
+
+            # Prefix of any word in the company name (or of the whole name)
+            first = lower.split()[0]
+            i = bisect.bisect_left(self._word_keys, (first, ""))
+            while i < len(self._word_keys) and self._word_keys[i][0].startswith(first):
+                symbol = self._word_keys[i][1]
+                if lower in self._names[symbol].lower() and take(symbol):
+                    return self._results(ranked)
+                i += 1
+
+            # Nothing matched literally: fall back to shared trigrams for typos
+            if ranked:
+                return self._results(ranked)
+            grams = _trigrams(lower)
+            shared = Counter()
+            for gram in grams:
+                shared.update(self._trigrams.get(gram, ()))
+            for symbol, count in shared.most_common():
+                if count / len(grams) < min_similarity:
+                    break
+                if take(symbol):
+                    break
+            return self._results(ranked)
+
+    def _results(self, symbols: List[str]) -> List[Dict[str, str]]:
+        return [{"symbol": symbol, "name": self._names[symbol]} for symbol in symbols]
+
+
+symbol_index = SymbolIndex()
+symbol_index.load_csv(LISTINGS_FILE)
@@ -0,0 +1,297 @@
+import io
+import csv
+import importlib.util
+import logging
+from datetime import datetime
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import delete, insert, select, update
+
+from app import db
+from models import Order, Portfolio, User
+
+# Set up logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+EXPORT_CHUNK_SIZE = 1000  # Rows fetched from the server-side cursor per round trip, and per Parquet row group
+IMPORT_CHUNK_SIZE = 5000  # CSV rows validated and inserted at a time
+IMPORT_MAX_ERRORS = 20  # Invalid rows reported before giving up on listing them
+SYMBOL_PATTERN = r"[A-Z0-9][A-Z0-9.\-^=]{0,19}"  # Ticker symbols as Yahoo Finance spells them
+
+# Columns written per dataset, in order
+EXPORT_DATASETS = {
+    "orders": [Order.id, Order.symbol, Order.order_type, Order.kind, Order.quantity, Order.price,
+               Order.trigger_price, Order.status, Order.created_at, Order.filled_at],
+    "holdings": [Portfolio.symbol, Portfolio.quantity, Portfolio.reserved_quantity, Portfolio.average_price,
+                 Portfolio.last_updated],
+}
+EXPORT_FORMATS = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+
+# Columns an imported trades CSV must have; any others, e.g. those of an orders export, are ignored
+IMPORT_COLUMNS = ["symbol", "order_type", "quantity", "price", "created_at"]
+
+
+class TradeImportError(ValueError):
+    """Raised when an imported trades file is rejected; errors lists what is wrong with it"""
+
+    def __init__(self, errors: List[str]):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+
+def parquet_available() -> bool:
+    """Whether pyarrow, which Parquet export needs, is installed"""
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+def _export_rows(dataset: str, user_id: int) -> Iterator[list]:
+    """A user's rows of a dataset in chunks, streamed from a server-side cursor"""
+    columns = EXPORT_DATASETS[dataset]
+    model = columns[0].class_
+    order_by = (Order.created_at, Order.id) if model is Order else (Portfolio.symbol,)
+    result = db.session.execute(
+        select(*columns).where(model.user_id == user_id).order_by(*order_by)
+        .execution_options(yield_per=EXPORT_CHUNK_SIZE)
+    )
+    try:
+        yield from result.partitions()
+    finally:
+        result.close()
+
+
+def iter_csv(dataset: str, user_id: int) -> Iterator[str]:
+    """A user's orders or holdings as CSV text, one chunk of rows at a time"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([column.key for column in EXPORT_DATASETS[dataset]])
+    for rows in _export_rows(dataset, user_id):
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+class _ChunkSink(io.RawIOBase):
+    # A file that hands back what has been written to it so far, so a Parquet file can be streamed
+    def __init__(self):
+        super().__init__()
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_parquet(dataset: str, user_id: int) -> Iterator[bytes]:
+    """A user's orders or holdings as a Parquet file, one row group per chunk of rows.
+
+    Needs pyarrow; check parquet_available() first.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    arrow_types = {int: pa.int64(), float: pa.float64(), str: pa.string(), datetime: pa.timestamp("us")}
+    columns = EXPORT_DATASETS[dataset]
+    schema = pa.schema([(column.key, arrow_types[column.type.python_type]) for column in columns])
+
+    sink = _ChunkSink()
+    with pq.ParquetWriter(sink, schema) as writer:
+        for rows in _export_rows(dataset, user_id):
+            writer.write_table(pa.Table.from_pylist([row._asdict() for row in rows], schema=schema))
+            yield sink.drain()
+    yield sink.drain()
+
+
+def _validate_trades(chunk: pd.DataFrame, now: pd.Timestamp) -> Tuple[pd.DataFrame, List[str]]:
+    """Normalize a chunk of imported trades and list the lines that are invalid"""
+    trades = pd.DataFrame({
+        "symbol": chunk["symbol"].astype("string").str.strip().str.upper(),
+        "order_type": chunk["order_type"].astype("string").str.strip().str.upper(),
+        "quantity": pd.to_numeric(chunk["quantity"], errors="coerce"),
+        "price": pd.to_numeric(chunk["price"], errors="coerce"),
+        # Stored as naive UTC like every other timestamp; offsets in the file are honoured
+        "created_at": pd.to_datetime(chunk["created_at"], errors="coerce", utc=True, format="ISO8601")
+                      .dt.tz_localize(None),
+    })
+    checks = {
+        "symbol": trades["symbol"].str.fullmatch(SYMBOL_PATTERN).fillna(False).astype(bool),
+        "order_type must be BUY or SELL": trades["order_type"].isin(["BUY", "SELL"]).fillna(False).astype(bool),
+        "quantity must be a positive whole number":
+            (trades["quantity"] > 0) & (trades["quantity"] == np.floor(trades["quantity"])),
+        "price must be positive": (trades["price"] > 0) & np.isfinite(trades["price"]),
+        "created_at must be a date and time in the past": trades["created_at"].notna() & (trades["created_at"] <= now),
+    }
+
+    errors = []
+    for problem, valid in checks.items():
+        # The chunk's index counts rows from the start of the file; line numbers count the header too
+        for row in chunk.index[~valid.to_numpy()]:
+            errors.append((row + 2, 'invalid symbol' if problem == 'symbol' else problem))
+    return trades, [f"line {line}: {problem}" for line, problem in sorted(errors)]
+
+
+def _insert_trades(trades: pd.DataFrame, user_id: int) -> None:
+    # Imported trades are filled market orders, filled when they were placed
+    rows = {
+        "user_id": user_id,
+        "symbol": trades["symbol"].tolist(),
+        "order_type": trades["order_type"].tolist(),
+        "kind": "MARKET",
+        "quantity": trades["quantity"].astype(np.int64).tolist(),
+        "price": trades["price"].tolist(),
+        "status": "COMPLETED",
+        "created_at": list(trades["created_at"].dt.to_pydatetime()),
+    }
+    rows["filled_at"] = rows["created_at"]
+    frame = pd.DataFrame(rows)
+
+    if db.engine.dialect.name == "postgresql" and db.engine.dialect.driver == "psycopg2":
+        # COPY in the session's own transaction, so a rejected import leaves nothing behind
+        buffer = io.StringIO()
+        frame.to_csv(buffer, index=False, header=False, date_format="%Y-%m-%d %H:%M:%S.%f")
+        buffer.seek(0)
+        columns = ", ".join(f'"{column}"' for column in frame.columns)
+        cursor = db.session.connection().connection.cursor()
+        try:
+            cursor.copy_expert(f'COPY "order" ({columns}) FROM STDIN WITH (FORMAT csv)', buffer)
+        finally:
+            cursor.close()
+    else:
+        db.session.execute(insert(Order), frame.to_dict("records"))
+
+
+def recompute_positions(user_id: int, symbols: List[str]) -> Dict[str, int]:
+    """Rebuild a user's positions in symbols from their completed orders, in the order they were placed.
+
+    Prices are averaged over buys as add_position does; sells keep the
+    average. Shares claimed by pending SELL orders are kept claimed.
+    Returns the resulting quantity per symbol. Raises TradeImportError if
+    the history sells shares the user didn't hold at the time.
+    """
+    held: Dict[str, List[float]] = {symbol: [0, 0.0] for symbol in symbols}
+    result = db.session.execute(
+        select(Order.symbol, Order.order_type, Order.quantity, Order.price)
+        .where(Order.user_id == user_id, Order.status == 'COMPLETED', Order.symbol.in_(symbols))
+        .order_by(Order.created_at, Order.id)
+        .execution_options(yield_per=EXPORT_CHUNK_SIZE)
+    )
+    errors = []
+    for symbol, order_type, quantity, price in result:
+        position = held[symbol]
+        if order_type == 'BUY':
+            position[1] = (position[0] * position[1] + quantity * price) / (position[0] + quantity)
+            position[0] += quantity
+        elif quantity > position[0]:
+            errors.append(f"{symbol}: sells {quantity} shares when only {position[0]} are held")
+            position[0] = 0
+        else:
+            position[0] -= quantity
+    if errors:
+        raise TradeImportError(errors[:IMPORT_MAX_ERRORS])
+
+    existing = {
+        symbol: (position_id, reserved or 0) for position_id, symbol, reserved in db.session.execute(
+            select(Portfolio.id, Portfolio.symbol, Portfolio.reserved_quantity)
+            .where(Portfolio.user_id == user_id, Portfolio.symbol.in_(symbols)))
+    }
+    now = datetime.utcnow()
+    updates, inserts, deletes = [], [], []
+    for symbol, (quantity, average_price) in held.items():
+        position_id, reserved = existing.get(symbol, (None, 0))
+        if quantity < reserved:
+            errors.append(f"{symbol}: {reserved} shares are claimed by pending SELL orders but only {quantity} held")
+        elif position_id is None and quantity:
+            inserts.append({"user_id": user_id, "symbol": symbol, "quantity": quantity,
+                            "average_price": average_price, "reserved_quantity": 0, "last_updated": now})
+        elif position_id is not None and quantity:
+            updates.append({"id": position_id, "quantity": quantity, "average_price": average_price,
+                            "last_updated": now})
+        elif position_id is not None:
+            deletes.append(position_id)
+    if errors:
+        raise TradeImportError(errors[:IMPORT_MAX_ERRORS])
+
+    if updates:
+        db.session.execute(update(Portfolio), updates)
+    if inserts:
+        db.session.execute(insert(Portfolio), inserts)
+    if deletes:
+        db.session.execute(delete(Portfolio).where(Portfolio.id.in_(deletes)),
+                           execution_options={"synchronize_session": False})
+    return {symbol: quantity for symbol, (quantity, _) in held.items()}
+
+
+def import_trades(user_id: int, file, chunk_size: int = IMPORT_CHUNK_SIZE) -> Dict[str, object]:
+    """Import a CSV of historical trades as completed orders and rebuild the affected positions.
+
+    The file needs the columns symbol, order_type, quantity, price and
+    created_at. If it has a status column, as an orders export does, only
+    COMPLETED rows are imported. It is read, validated and inserted a chunk
+    at a time, all in one transaction, and positions are recomputed once at
+    the end. Funds are not changed: the trades are history, not new orders.
+    Raises TradeImportError, having rolled back, if any row is invalid.
+    """
+    # Hold the user's row so their orders can't change positions underneath the import
+    db.session.execute(select(User.id).where(User.id == user_id).with_for_update())
+
+    now = pd.Timestamp(datetime.utcnow())
+    imported = skipped = 0
+    symbols = set()
+    errors = []
+    try:
+        reader = pd.read_csv(file, dtype=str, chunksize=chunk_size, skipinitialspace=True)
+        for chunk in reader:
+            chunk.columns = chunk.columns.str.strip().str.lower()
+            missing = [column for column in IMPORT_COLUMNS if column not in chunk.columns]
+            if missing:
+                raise TradeImportError([f"missing column {column}" for column in missing])
+
+            if "status" in chunk.columns:
+                completed = chunk["status"].fillna("COMPLETED").str.strip().str.upper() == "COMPLETED"
+                skipped += int((~completed).sum())
+                chunk = chunk[completed]
+
+            trades, chunk_errors = _validate_trades(chunk, now)
+            if chunk_errors or errors:
+                # Keep validating to report more problems, but insert nothing more
+                errors.extend(chunk_errors)
+                if len(errors) >= IMPORT_MAX_ERRORS:
+                    break
+                continue
+            if trades.empty:
+                continue
+            _insert_trades(trades, user_id)
+            symbols.update(trades["symbol"].unique())
+            imported += len(trades)
+        if errors:
+            raise TradeImportError(errors[:IMPORT_MAX_ERRORS])
+        if not imported:
+            raise TradeImportError(["the file has no trades"])
+
+        positions = recompute_positions(user_id, sorted(symbols))
+    except (TradeImportError, ValueError, pd.errors.ParserError) as e:
+        db.session.rollback()
+        if isinstance(e, TradeImportError):
+            raise
+        raise TradeImportError([f"could not read the file: {e}"]) from e
+
+    db.session.commit()
+    logger.info(f"Imported {imported} trades in {len(symbols)} symbols for user {user_id}, skipped {skipped}")
+    return {"imported": imported, "skipped": skipped, "positions": positions}
@@ -0,0 +1,225 @@
+import os
+import fcntl
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+INITIAL_CAPACITY = 1024  # Rows allocated when the matrix file is first written; it doubles when full
+
+
+class VectorIndex:
+    """Cosine-similarity index over one embedding per symbol.
+
+    Embeddings are L2-normalised and kept as rows of a float32 matrix
+    memory-mapped from a .npy file, so top-k is a single matrix-vector
+    product. Row symbols live in a sidecar text file next to the matrix,
+    one line per row.
+
+    The matrix file has spare rows, so adding embeddings writes only the
+    new rows and appends their symbols to the sidecar. A symbol that is
+    added again gets a new row and its old row is skipped. The file is
+    rebuilt, live rows only, when it runs out of rows (at twice the size)
+    or when most rows are dead, so each added embedding costs amortized
+    O(1) rather than a rewrite of the whole matrix.
+
+    Several processes may share the files. Writers hold an exclusive lock
+    on a .lock file next to them and reload whatever another process
+    wrote; readers reload under a shared lock when the sidecar changes.
+    Rebuilds go to temporary files that replace the originals with
+    os.replace, so readers' existing maps stay valid.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._symbols_path = f"{path}.symbols"
+        self._matrix: Optional[np.memmap] = None
+        self._count = 0  # Rows in use, live or dead
+        self._symbols: List[str] = []  # Symbol of each row in use
+        self._rows: Dict[str, int] = {}  # Live row of each symbol
+        self._dead: np.ndarray = np.empty(0, dtype=np.int64)  # Rows superseded by a later row
+        self._version: Optional[Tuple[int, int, int]] = None
+        self._lock = threading.Lock()
+        with self._file_lock(fcntl.LOCK_SH):
+            self._load()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, symbol: str) -> bool:
+        return symbol in self._rows
+
+    @property
+    def dim(self) -> int:
+        return self._matrix.shape[1] if self._matrix is not None else 0
+
+    @property
+    def capacity(self) -> int:
+        return self._matrix.shape[0] if self._matrix is not None else 0
+
+    @contextmanager
+    def _file_lock(self, operation: int):
+        """Hold a shared (readers) or exclusive (writers) lock across processes"""
+        with open(f"{self.path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, operation)
+            yield
+
+    def _disk_version(self) -> Optional[Tuple[int, int, int]]:
+        """Identifies the sidecar on disk, which every write appends to or replaces"""
+        try:
+            stat = os.stat(self._symbols_path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _refresh(self) -> None:
+        """Reload if another process has written since we last loaded. Caller holds self._lock."""
+        if self._disk_version() != self._version:
+            with self._file_lock(fcntl.LOCK_SH):
+                self._load()
+
+    def _set_rows(self, matrix: Optional[np.memmap], symbols: List[str]) -> None:
+        rows = {symbol: row for row, symbol in enumerate(symbols)}  # Later rows win
+        live = np.zeros(len(symbols), dtype=bool)
+        live[list(rows.values())] = True
+        self._matrix, self._count, self._symbols, self._rows = matrix, len(symbols), symbols, rows
+        self._dead = np.flatnonzero(~live)
+
+    def _load(self) -> None:
+        self._version = self._disk_version()
+        try:
+            matrix = np.load(self.path, mmap_mode="r")
+            with open(self._symbols_path) as f:
+                lines = f.read().split("\n")
+        except (OSError, ValueError):
+            return
+        if matrix.ndim != 2 or matrix.dtype != np.float32:
+            logger.warning(f"Ignoring malformed vector index at {self.path}")
+            return
+        # A crash while appending leaves an unterminated last line, or symbols for rows
+        # that were never written; drop them
+        symbols = lines[:-1][:matrix.shape[0]]
+        self._set_rows(matrix, symbols)
+        logger.debug(f"Loaded {len(self)} vectors of dimension {self.dim} from {self.path}")
+
+    def _temp_path(self, path: str) -> str:
+        """A fresh file next to path, so os.replace onto path stays on one filesystem"""
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                        prefix=f"{os.path.basename(path)}.", suffix=".tmp")
+        os.close(fd)
+        return tmp_path
+
+    def _rebuild(self, symbols: List[str], vectors: np.ndarray, dim: int) -> np.memmap:
+        """Write rows as a new matrix with room to grow, then the sidecar, each replacing the old file"""
+        capacity = max(INITIAL_CAPACITY, 2 * len(symbols))
+        tmp_path = self._temp_path(self.path)
+        try:
+            matrix = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(capacity, dim))
+            matrix[:len(symbols)] = vectors
+            matrix.flush()
+            os.replace(tmp_path, self.path)
+
+            # Replaced after the matrix: a reader truncates symbols to the rows it finds
+            tmp_path = self._temp_path(self._symbols_path)
+            with open(tmp_path, "w") as f:
+                f.writelines(f"{symbol}\n" for symbol in symbols)
+            os.replace(tmp_path, self._symbols_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        logger.debug(f"Rebuilt vector index at {self.path} with {len(symbols)} of {capacity} rows")
+        return np.load(self.path, mmap_mode="r")
+
+    def _append(self, symbols: List[str], vectors: np.ndarray) -> None:
+        """Write rows into the matrix file's spare rows, then name them in the sidecar"""
+        matrix = np.load(self.path, mmap_mode="r+")
+        matrix[self._count:self._count + len(symbols)] = vectors
+        matrix.flush()
+        del matrix
+        with open(self._symbols_path, "a") as f:
+            f.writelines(f"{symbol}\n" for symbol in symbols)
+
+    def add(self, symbol: str, embedding: Sequence[float]) -> None:
+        self.add_many([(symbol, embedding)])
+
+    def add_many(self, items: Iterable[Tuple[str, Sequence[float]]]) -> int:
+        """Add or replace (symbol, embedding) pairs, returning how many were stored"""
+        new: Dict[str, np.ndarray] = {}  # Last embedding given for each symbol
+        dim = None
+        for symbol, embedding in items:
+            vector = np.asarray(embedding, dtype=np.float32)
+            norm = float(np.linalg.norm(vector)) if vector.ndim == 1 else 0.0
+            if not symbol or norm == 0.0:
+                continue
+            if dim is not None and vector.size != dim:
+                # Only the newest model's embeddings are comparable with each other
+                new.clear()
+            dim = vector.size
+            new.pop(symbol, None)
+            new[symbol] = vector / norm
+        if not new:
+            return 0
+
+        with self._lock, self._file_lock(fcntl.LOCK_EX):
+            # Start from what's on disk, which may include other processes' rows
+            if self._disk_version() != self._version:
+                self._load()
+            symbols, vectors = list(new), np.stack(list(new.values()))
+
+            if self._matrix is not None and dim != self.dim:
+                # A different embedding model makes every stored vector incomparable
+                logger.warning(f"Embedding dimension changed from {self.dim} to {dim}; resetting index")
+                self._set_rows(None, [])
+
+            replaced = sum(symbol in self._rows for symbol in symbols)
+            count = self._count + len(symbols)
+            dead = len(self._dead) + replaced
+            if self._matrix is None or count > self.capacity or dead > count // 2:
+                # Keep the live rows that aren't being replaced, in row order
+                kept = sorted(row for symbol, row in self._rows.items() if symbol not in new)
+                symbols = [self._symbols[row] for row in kept] + symbols
+                vectors = np.concatenate([self._matrix[kept], vectors]) if kept else vectors
+                matrix = self._rebuild(symbols, vectors, dim)
+                self._set_rows(matrix, symbols)
+            else:
+                self._append(symbols, vectors)
+                self._set_rows(self._matrix, self._symbols + symbols)
+            self._version = self._disk_version()
+        return len(new)
+
+    def search(self, embedding: Sequence[float], k: int = 5, exclude: Iterable[str] = ()) -> List[Tuple[str, float]]:
+        """Return up to k (symbol, cosine similarity) pairs, most similar first"""
+        with self._lock:
+            self._refresh()
+            matrix, symbols, count, dead = self._matrix, self._symbols, self._count, self._dead
+            live = len(self._rows)
+            excluded_rows = list({self._rows[symbol] for symbol in exclude if symbol in self._rows})
+
+        query = np.asarray(embedding, dtype=np.float32)
+        if matrix is None or not live or query.ndim != 1 or query.size != matrix.shape[1]:
+            return []
+        norm = float(np.linalg.norm(query))
+        if norm == 0.0:
+            return []
+
+        scores = matrix[:count] @ (query / norm)
+        scores[dead] = -np.inf
+        scores[excluded_rows] = -np.inf
+        k = min(k, live - len(excluded_rows))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(symbols[row], float(scores[row])) for row in top]
+
+
+vector_index = VectorIndex(os.environ.get("VECTOR_INDEX_PATH", "/tmp/stocksphere_vectors.npy"))